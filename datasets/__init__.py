@@ -9,6 +9,7 @@ from .clevrref import build as build_clevrref
 from .coco import build as build_coco
 from .flickr import build as build_flickr, build_mmdialogue
 from .gqa import build as build_gqa
+from .image_shards import load_image_shards, set_image_source
 from .lvis import LvisDetectionBase
 from .lvis import build as build_lvis
 from .lvis_modulation import build as build_modulated_lvis
@@ -31,6 +32,16 @@ def get_coco_api_from_dataset(dataset):
 
 
 def build_dataset(dataset_file: str, image_set: str, args):
+    dataset = _build_dataset(dataset_file, image_set, args)
+    image_shards = load_image_shards(tuple(args.image_shards)) if getattr(args, "image_shards", None) else None
+    jpeg_draft = getattr(args, "jpeg_draft", False)
+    if image_shards is not None or jpeg_draft:
+        # read the images from the packed shards and/or decode them at a reduced scale, see datasets.image_shards
+        set_image_source(dataset, image_shards, jpeg_draft)
+    return dataset
+
+
+def _build_dataset(dataset_file: str, image_set: str, args):
     if "clevrref" in dataset_file:
         return build_clevrref(image_set, args)
     if "clevr" in dataset_file:
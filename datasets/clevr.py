@@ -14,12 +14,12 @@ import numpy as np
 import torch
 import torch.utils.data
 import torchvision
-from PIL import Image
 from transformers import AutoTokenizer
 
 import datasets.transforms as T
 
-from .coco import ConvertCocoPolysToMask, create_positive_map
+from .coco import ConvertCocoPolysToMask, positive_map_from_token_spans, resolve_token_spans, token_spans_to_tensor
+from .image_shards import open_image
 
 ALL_ATTRIBUTES = [
     "small",
@@ -67,6 +67,12 @@ class ClevrDetection(torchvision.datasets.CocoDetection):
         self.tokenizer = tokenizer
         self.return_tokens = return_tokens
         self.do_qa = do_qa
+        self.image_shards = None
+        self.jpeg_draft = False
+
+    def _load_image(self, id):
+        path = os.path.join(self.root, self.coco.loadImgs(id)[0]["file_name"])
+        return open_image(path, self.image_shards, self.jpeg_draft)
 
     def __getitem__(self, idx):
         img, target = super(ClevrDetection, self).__getitem__(idx)
@@ -83,7 +89,9 @@ class ClevrDetection(torchvision.datasets.CocoDetection):
             assert len(target["boxes"]) == len(target["tokens_positive"])
             tokenized = self.tokenizer(caption, return_tensors="pt")
             # construct a map such that positive_map[i,j] = True iff box i is associated to token j
-            target["positive_map"] = create_positive_map(tokenized, target["tokens_positive"])
+            token_spans = resolve_token_spans(tokenized, target["tokens_positive"])
+            target["positive_map"] = positive_map_from_token_spans(token_spans)
+            target["token_spans"] = token_spans_to_tensor(token_spans)
 
         if self._transforms is not None:
             img, target = self._transforms(img, target)
@@ -99,13 +107,15 @@ class ClevrQuestion(torch.utils.data.Dataset):
         self.root = img_folder
         with open(ann_file, "r") as f:
             self.questions = json.load(f)["questions"]
+        self.image_shards = None
+        self.jpeg_draft = False
 
     def __len__(self):
         return len(self.questions)
 
     def __getitem__(self, idx):
         question = self.questions[idx]
-        img = Image.open(os.path.join(self.root, question["image_filename"])).convert("RGB")
+        img = open_image(os.path.join(self.root, question["image_filename"]), self.image_shards, self.jpeg_draft)
         target = {
             "questionId": question["question_index"] if "question_index" in question else idx,
             "caption": question["question"],
@@ -5,6 +5,7 @@ COCO dataset which returns image_id for evaluation.
 
 Mostly copy-paste from https://github.com/pytorch/vision/blob/13b35ff/references/detection/coco_utils.py
 """
+import os
 from pathlib import Path
 
 import torch
@@ -14,13 +15,29 @@ from pycocotools import mask as coco_mask
 
 import datasets.transforms as T
 
+from .image_shards import open_image
+
 
 class ModulatedDetection(torchvision.datasets.CocoDetection):
-    def __init__(self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False):
+    """Modulated detection dataset. If a token_store (see datasets.token_store) is given, the token spans of the boxes
+    are read from it instead of tokenizing the caption."""
+
+    def __init__(
+        self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, is_train=False, token_store=None
+    ):
         super(ModulatedDetection, self).__init__(img_folder, ann_file)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks, return_tokens, tokenizer=tokenizer)
         self.is_train = is_train
+        self.token_store = token_store
+        if token_store is not None:
+            assert len(token_store) == len(self.ids), f"the token store does not match {ann_file}"
+        self.image_shards = None
+        self.jpeg_draft = False
+
+    def _load_image(self, id):
+        path = os.path.join(self.root, self.coco.loadImgs(id)[0]["file_name"])
+        return open_image(path, self.image_shards, self.jpeg_draft)
 
     def __getitem__(self, idx):
         img, target = super(ModulatedDetection, self).__getitem__(idx)
@@ -29,6 +46,8 @@ class ModulatedDetection(torchvision.datasets.CocoDetection):
         caption = coco_img["caption"]
         dataset_name = coco_img["dataset_name"] if "dataset_name" in coco_img else None
         target = {"image_id": image_id, "annotations": target, "caption": caption}
+        if self.token_store is not None:
+            target["token_spans"] = self.token_store.token_spans(image_id)
         img, target = self.prepare(img, target)
         if self._transforms is not None:
             img, target = self._transforms(img, target)
@@ -38,8 +57,12 @@ class ModulatedDetection(torchvision.datasets.CocoDetection):
                 target[extra_key] = coco_img[extra_key]
 
         if "tokens_positive_eval" in coco_img and not self.is_train:
-            tokenized = self.prepare.tokenizer(caption, return_tensors="pt")
-            target["positive_map_eval"] = create_positive_map(tokenized, coco_img["tokens_positive_eval"])
+            if self.token_store is not None:
+                eval_token_spans = self.token_store.eval_token_spans(image_id)
+            else:
+                tokenized = self.prepare.tokenizer(caption, return_tensors="pt")
+                eval_token_spans = resolve_token_spans(tokenized, coco_img["tokens_positive_eval"])
+            target["positive_map_eval"] = positive_map_from_token_spans(eval_token_spans)
             target["nb_eval"] = len(target["positive_map_eval"])
 
         return img, target
@@ -50,6 +73,12 @@ class CocoDetection(torchvision.datasets.CocoDetection):
         super(CocoDetection, self).__init__(img_folder, ann_file)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks)
+        self.image_shards = None
+        self.jpeg_draft = False
+
+    def _load_image(self, id):
+        path = os.path.join(self.root, self.coco.loadImgs(id)[0]["file_name"])
+        return open_image(path, self.image_shards, self.jpeg_draft)
 
     def __getitem__(self, idx):
         img, target = super(CocoDetection, self).__getitem__(idx)
@@ -78,10 +107,15 @@ def convert_coco_poly_to_mask(segmentations, height, width):
     return masks
 
 
-def create_positive_map(tokenized, tokens_positive):
-    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-    for j, tok_list in enumerate(tokens_positive):
+def resolve_token_spans(tokenized, tokens_positive):
+    """Resolves the character spans of each box to token spans of the tokenized caption.
+
+    Returns, for each box, the list of its (beg, end) token ranges, end excluded. Character spans that cannot be mapped
+    to tokens are dropped.
+    """
+    token_spans = []
+    for tok_list in tokens_positive:
+        cur_spans = []
         for (beg, end) in tok_list:
             beg_pos = tokenized.char_to_token(beg)
             end_pos = tokenized.char_to_token(end - 1)
@@ -103,10 +137,38 @@ def create_positive_map(tokenized, tokens_positive):
                 continue
 
             assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos : end_pos + 1].fill_(1)
+            cur_spans.append((beg_pos, end_pos + 1))
+        token_spans.append(cur_spans)
+    return token_spans
+
+
+def positive_map_from_token_spans(token_spans):
+    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
+    positive_map = torch.zeros((len(token_spans), 256), dtype=torch.float)
+    for j, cur_spans in enumerate(token_spans):
+        for (beg, end) in cur_spans:
+            positive_map[j, beg:end].fill_(1)
     return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
 
 
+def token_spans_to_tensor(token_spans):
+    """Pads the token spans of the boxes into a (num_boxes, max_spans, 2) long tensor.
+
+    Boxes with less spans are padded with empty (0, 0) spans. See SetCriterion.loss_contrastive_align.
+    """
+    max_spans = max([len(cur_spans) for cur_spans in token_spans], default=0)
+    spans_tensor = torch.zeros((len(token_spans), max(max_spans, 1), 2), dtype=torch.long)
+    for j, cur_spans in enumerate(token_spans):
+        if len(cur_spans) > 0:
+            spans_tensor[j, : len(cur_spans)] = torch.as_tensor(cur_spans, dtype=torch.long)
+    return spans_tensor
+
+
+def create_positive_map(tokenized, tokens_positive):
+    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
+    return positive_map_from_token_spans(resolve_token_spans(tokenized, tokens_positive))
+
+
 class ConvertCocoPolysToMask(object):
     def __init__(self, return_masks=False, return_tokens=False, tokenizer=None):
         self.return_masks = return_masks
@@ -121,8 +183,13 @@ class ConvertCocoPolysToMask(object):
 
         anno = target["annotations"]
         caption = target["caption"] if "caption" in target else None
+        # token spans of each annotation, pre-computed by a token store
+        token_spans = target.get("token_spans")
 
-        anno = [obj for obj in anno if "iscrowd" not in obj or obj["iscrowd"] == 0]
+        not_crowd = ["iscrowd" not in obj or obj["iscrowd"] == 0 for obj in anno]
+        anno = [obj for obj, k in zip(anno, not_crowd) if k]
+        if token_spans is not None:
+            token_spans = [spans for spans, k in zip(token_spans, not_crowd) if k]
 
         boxes = [obj["bbox"] for obj in anno]
         # guard against no boxes via resizing
@@ -194,10 +261,16 @@ class ConvertCocoPolysToMask(object):
         target["orig_size"] = torch.as_tensor([int(h), int(w)])
         target["size"] = torch.as_tensor([int(h), int(w)])
 
-        if self.return_tokens and self.tokenizer is not None:
+        if self.return_tokens and (token_spans is not None or self.tokenizer is not None):
             assert len(target["boxes"]) == len(target["tokens_positive"])
-            tokenized = self.tokenizer(caption, return_tensors="pt")
-            target["positive_map"] = create_positive_map(tokenized, target["tokens_positive"])
+            if token_spans is not None:
+                token_spans = [spans for spans, k in zip(token_spans, keep) if k]
+            else:
+                tokenized = self.tokenizer(caption, return_tensors="pt")
+                token_spans = resolve_token_spans(tokenized, target["tokens_positive"])
+            # the spans are resolved once, and shipped along the positive map for the contrastive align loss
+            target["positive_map"] = positive_map_from_token_spans(token_spans)
+            target["token_spans"] = token_spans_to_tensor(token_spans)
         return image, target
 
 
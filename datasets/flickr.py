@@ -7,6 +7,7 @@ from pathlib import Path
 from transformers import AutoTokenizer
 
 from .coco import ModulatedDetection, make_coco_transforms
+from .token_store import load_token_store
 
 
 class FlickrDetection(ModulatedDetection):
@@ -37,7 +38,8 @@ def build(image_set, args):
         return_masks=False,
         return_tokens=True,  # args.contrastive_align_loss,
         tokenizer=tokenizer,
-        is_train=image_set == "train"
+        is_train=image_set == "train",
+        token_store=load_token_store(args, ann_file, tokenizer),
     )
     return dataset
 
@@ -66,6 +68,7 @@ def build_mmdialogue(image_set, args):
         return_masks=False,
         return_tokens=True,  # args.contrastive_align_loss,
         tokenizer=tokenizer,
-        is_train=image_set == "train"
+        is_train=image_set == "train",
+        token_store=load_token_store(args, ann_file, tokenizer),
     )
     return dataset
@@ -5,6 +5,7 @@ COCO dataset which returns image_id for evaluation.
 Mostly copy-paste from https://github.com/pytorch/vision/blob/13b35ff/references/detection/coco_utils.py
 """
 import json
+import os
 from pathlib import Path
 
 import torch
@@ -12,6 +13,8 @@ import torchvision
 from transformers import AutoTokenizer
 
 from .coco import ConvertCocoPolysToMask, ModulatedDetection, make_coco_transforms
+from .image_shards import open_image
+from .token_store import load_token_store
 
 
 class GQADetection(ModulatedDetection):
@@ -19,15 +22,26 @@ class GQADetection(ModulatedDetection):
 
 
 class GQAQuestionAnswering(torchvision.datasets.CocoDetection):
-    def __init__(self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, ann_folder):
+    def __init__(
+        self, img_folder, ann_file, transforms, return_masks, return_tokens, tokenizer, ann_folder, token_store=None
+    ):
         super(GQAQuestionAnswering, self).__init__(img_folder, ann_file)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks, return_tokens, tokenizer=tokenizer)
+        self.token_store = token_store
+        if token_store is not None:
+            assert len(token_store) == len(self.ids), f"the token store does not match {ann_file}"
         with open(ann_folder / "gqa_answer2id.json", "r") as f:
             self.answer2id = json.load(f)
         with open(ann_folder / "gqa_answer2id_by_type.json", "r") as f:
             self.answer2id_by_type = json.load(f)
         self.type2id = {"obj": 0, "attr": 1, "rel": 2, "global": 3, "cat": 4}
+        self.image_shards = None
+        self.jpeg_draft = False
+
+    def _load_image(self, id):
+        path = os.path.join(self.root, self.coco.loadImgs(id)[0]["file_name"])
+        return open_image(path, self.image_shards, self.jpeg_draft)
 
     def __getitem__(self, idx):
         img, target = super(GQAQuestionAnswering, self).__getitem__(idx)
@@ -37,6 +51,8 @@ class GQAQuestionAnswering(torchvision.datasets.CocoDetection):
         dataset_name = coco_img["dataset_name"]
         questionId = coco_img["questionId"]
         target = {"image_id": image_id, "annotations": target, "caption": caption}
+        if self.token_store is not None:
+            target["token_spans"] = self.token_store.token_spans(image_id)
         img, target = self.prepare(img, target)
         if self._transforms is not None:
             img, target = self._transforms(img, target)
@@ -121,6 +137,7 @@ def build(image_set, args):
                         return_tokens=True,
                         tokenizer=tokenizer,
                         ann_folder=Path(args.gqa_ann_path),
+                        token_store=load_token_store(args, ann_file, tokenizer),
                     )
                 )
 
@@ -136,6 +153,7 @@ def build(image_set, args):
                 return_tokens=True,
                 tokenizer=tokenizer,
                 ann_folder=Path(args.gqa_ann_path),
+                token_store=load_token_store(args, ann_file, tokenizer),
             )
         elif image_set in ["test", "challenge", "testdev", "submission"]:
             ann_file = Path(args.gqa_ann_path) / f"finetune_gqa_{image_set}_{args.gqa_split_type}.json"
@@ -148,6 +166,7 @@ def build(image_set, args):
                 return_tokens=True,
                 tokenizer=tokenizer,
                 ann_folder=Path(args.gqa_ann_path),
+                token_store=load_token_store(args, ann_file, tokenizer),
             )
 
         else:
@@ -163,5 +182,6 @@ def build(image_set, args):
             return_masks=args.masks,
             return_tokens=True,
             tokenizer=tokenizer,
+            token_store=load_token_store(args, ann_file, tokenizer),
         )
         return dataset
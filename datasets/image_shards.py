@@ -0,0 +1,152 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Packed image shards, to read the images of the datasets from a few large files instead of one file per image.
+
+A shard set is a directory holding shard_00000.bin, shard_00001.bin, ... which are the concatenated bytes of the
+image files, and index.json, mapping the path of each packed image to its (shard, offset, length). The paths are the
+absolute normalized paths of the image files, as the datasets open them (the image folder of the dataset config joined
+with the file name of the annotation), so that packed images are found whatever the dataset.
+
+The images are still decoded by PIL, from the memory-mapped shards. Reading is random access, images that are not in
+the shards are read from the disk.
+
+Use scripts/pack_image_shards.py to write a shard set.
+"""
+import io
+import json
+import mmap
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import torch.utils.data
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def image_key(path: Union[str, Path]) -> str:
+    return os.path.normpath(os.path.abspath(str(path)))
+
+
+def list_images(image_dirs: Iterable[Union[str, Path]]) -> List[str]:
+    """Returns the sorted paths of the image files found under the directories."""
+    paths = []
+    for image_dir in image_dirs:
+        for dirpath, _, filenames in os.walk(image_dir):
+            paths.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def write_image_shards(paths: Sequence[str], out_path: Union[str, Path], shard_size: int = 1 << 30) -> int:
+    """Packs the image files into shards of about shard_size bytes under out_path, and writes their index.
+
+    Returns the number of shards.
+    """
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    shards: List[str] = []
+    files: Dict[str, Tuple[int, int, int]] = {}
+    shard_file, offset = None, 0
+    for path in paths:
+        if shard_file is None or offset >= shard_size:
+            if shard_file is not None:
+                shard_file.close()
+            shards.append(f"shard_{len(shards):05d}.bin")
+            shard_file, offset = open(out_path / shards[-1], "wb"), 0
+        with open(path, "rb") as f:
+            data = f.read()
+        shard_file.write(data)
+        files[image_key(path)] = (len(shards) - 1, offset, len(data))
+        offset += len(data)
+    if shard_file is not None:
+        shard_file.close()
+    with open(out_path / "index.json", "w") as f:
+        json.dump({"shards": shards, "files": files}, f)
+    return len(shards)
+
+
+class ImageShards:
+    """Reads images from one or more shard sets written by write_image_shards.
+
+    The shards are memory-mapped on first access, in each data loader worker, and are not pickled with the datasets.
+    """
+
+    def __init__(self, shard_dirs: Sequence[Union[str, Path]]):
+        self.shard_paths: List[Path] = []
+        self.files: Dict[str, Tuple[int, int, int]] = {}
+        for shard_dir in shard_dirs:
+            shard_dir = Path(shard_dir)
+            with open(shard_dir / "index.json", "r") as f:
+                index = json.load(f)
+            first_shard = len(self.shard_paths)
+            self.shard_paths.extend(shard_dir / name for name in index["shards"])
+            for key, (shard, offset, length) in index["files"].items():
+                self.files[key] = (first_shard + shard, offset, length)
+        self._shards: Optional[List[Optional[mmap.mmap]]] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return image_key(path) in self.files
+
+    def _shard(self, shard: int) -> mmap.mmap:
+        if self._shards is None:
+            self._shards = [None] * len(self.shard_paths)
+        if self._shards[shard] is None:
+            with open(self.shard_paths[shard], "rb") as f:
+                self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[shard]
+
+    def read(self, path: Union[str, Path]) -> bytes:
+        """Returns the bytes of the image file, read from the shards."""
+        shard, offset, length = self.files[image_key(path)]
+        return self._shard(shard)[offset : offset + length]
+
+    def open(self, path: Union[str, Path]) -> Image.Image:
+        """Opens the image from the shards if it was packed, else from the disk."""
+        if path in self:
+            return Image.open(io.BytesIO(self.read(path)))
+        return Image.open(path)
+
+
+def open_image(
+    path: Union[str, Path], image_shards: Optional[ImageShards] = None, jpeg_draft: bool = False
+) -> Image.Image:
+    """Opens the image at path as RGB, from the shards if given.
+
+    With jpeg_draft, RGB JPEG images are returned before being decoded, so that the first resize of the transforms can
+    have them decoded at a reduced scale (see datasets.transforms.resize).
+    """
+    img = image_shards.open(path) if image_shards is not None else Image.open(path)
+    if jpeg_draft and img.format == "JPEG" and img.mode == "RGB":
+        return img
+    return img.convert("RGB")
+
+
+@lru_cache(maxsize=None)
+def load_image_shards(shard_dirs: Tuple[str, ...]) -> ImageShards:
+    """Returns the reader of the shard sets, shared by all the datasets of the process."""
+    return ImageShards(shard_dirs)
+
+
+def set_image_source(dataset, image_shards: Optional[ImageShards] = None, jpeg_draft: bool = False) -> None:
+    """Makes the dataset (traversing ConcatDataset and Subset) read its images from the shards, and with jpeg_draft,
+    decode its JPEG images at a reduced scale (see open_image)."""
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        for ds in dataset.datasets:
+            set_image_source(ds, image_shards, jpeg_draft)
+    elif isinstance(dataset, torch.utils.data.Subset):
+        set_image_source(dataset.dataset, image_shards, jpeg_draft)
+    elif hasattr(dataset, "image_shards"):
+        dataset.image_shards = image_shards
+        dataset.jpeg_draft = jpeg_draft
+    else:
+        raise ValueError(f"{type(dataset).__name__} does not support image shards nor reduced decoding")
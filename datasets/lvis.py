@@ -7,9 +7,9 @@ from collections import defaultdict
 
 import pycocotools.mask as mask_utils
 import torchvision
-from PIL import Image
 
 from .coco import ConvertCocoPolysToMask, make_coco_transforms
+from .image_shards import open_image
 
 
 def _isArrayLike(obj):
@@ -212,6 +212,8 @@ class LvisDetectionBase(torchvision.datasets.VisionDataset):
         super(LvisDetectionBase, self).__init__(root, transforms, transform, target_transform)
         self.lvis = LVIS(annFile)
         self.ids = list(sorted(self.lvis.imgs.keys()))
+        self.image_shards = None
+        self.jpeg_draft = False
 
     def __getitem__(self, index):
         """
@@ -227,7 +229,7 @@ class LvisDetectionBase(torchvision.datasets.VisionDataset):
 
         path = "/".join(self.lvis.load_imgs(img_id)[0]["coco_url"].split("/")[-2:])
 
-        img = Image.open(os.path.join(self.root, path)).convert("RGB")
+        img = open_image(os.path.join(self.root, path), self.image_shards, self.jpeg_draft)
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
@@ -9,11 +9,12 @@ import os.path
 from pathlib import Path
 from typing import Any, Callable, Optional, Tuple
 
-from PIL import Image
 from torchvision.datasets.vision import VisionDataset
 from transformers import AutoTokenizer
 
 from .coco import ConvertCocoPolysToMask, make_coco_transforms
+from .image_shards import open_image
+from .token_store import load_token_store
 
 
 class CustomCocoDetection(VisionDataset):
@@ -49,6 +50,8 @@ class CustomCocoDetection(VisionDataset):
         self.ids = list(sorted(self.coco.imgs.keys()))
         self.root_coco = root_coco
         self.root_vg = root_vg
+        self.image_shards = None
+        self.jpeg_draft = False
 
     def __getitem__(self, index: int) -> Tuple[Any, Any]:
         """
@@ -68,7 +71,7 @@ class CustomCocoDetection(VisionDataset):
         dataset = img_info["data_source"]
 
         cur_root = self.root_coco if dataset == "coco" else self.root_vg
-        img = Image.open(os.path.join(cur_root, path)).convert("RGB")
+        img = open_image(os.path.join(cur_root, path), self.image_shards, self.jpeg_draft)
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
@@ -81,16 +84,31 @@ class CustomCocoDetection(VisionDataset):
 class MixedDetection(CustomCocoDetection):
     """Same as the modulated detection dataset, except with multiple img sources"""
 
-    def __init__(self, img_folder_coco, img_folder_vg, ann_file, transforms, return_masks, return_tokens, tokenizer):
+    def __init__(
+        self,
+        img_folder_coco,
+        img_folder_vg,
+        ann_file,
+        transforms,
+        return_masks,
+        return_tokens,
+        tokenizer,
+        token_store=None,
+    ):
         super(MixedDetection, self).__init__(img_folder_coco, img_folder_vg, ann_file)
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(return_masks, return_tokens, tokenizer=tokenizer)
+        self.token_store = token_store
+        if token_store is not None:
+            assert len(token_store) == len(self.ids), f"the token store does not match {ann_file}"
 
     def __getitem__(self, idx):
         img, target = super(MixedDetection, self).__getitem__(idx)
         image_id = self.ids[idx]
         caption = self.coco.loadImgs(image_id)[0]["caption"]
         target = {"image_id": image_id, "annotations": target, "caption": caption}
+        if self.token_store is not None:
+            target["token_spans"] = self.token_store.token_spans(image_id)
         img, target = self.prepare(img, target)
         if self._transforms is not None:
             img, target = self._transforms(img, target)
@@ -114,6 +132,7 @@ def build(image_set, args):
         return_masks=args.masks,
         return_tokens=True,
         tokenizer=tokenizer,
+        token_store=load_token_store(args, ann_file, tokenizer),
     )
 
     return dataset
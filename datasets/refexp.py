@@ -11,6 +11,7 @@ import util.dist as dist
 from util.box_ops import generalized_box_iou
 
 from .coco import ModulatedDetection, make_coco_transforms
+from .token_store import load_token_store
 
 
 class RefExpDetection(ModulatedDetection):
@@ -113,5 +114,6 @@ def build(image_set, args):
         return_masks=args.masks,
         return_tokens=True,
         tokenizer=tokenizer,
+        token_store=load_token_store(args, ann_file, tokenizer),
     )
     return dataset
@@ -0,0 +1,189 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Batch sampler grouping the samples of similar image aspect ratio and caption length, to reduce padding.
+"""
+import itertools
+import math
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+import torch.utils.data
+import torchvision
+from torch.utils.data import Sampler
+
+import util.dist as dist
+
+from .lvis import LvisDetectionBase
+from .mixed import CustomCocoDetection
+
+
+def get_image_metadata(dataset) -> List[Tuple[int, int, str]]:
+    """Returns the (width, height, caption) of each sample of the dataset, read from its annotations only.
+
+    ConcatDataset and Subset are traversed. For datasets without annotations of the image size, (1, 1, "") is returned.
+    """
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        return [meta for ds in dataset.datasets for meta in get_image_metadata(ds)]
+    if isinstance(dataset, torch.utils.data.Subset):
+        metadata = get_image_metadata(dataset.dataset)
+        return [metadata[i] for i in dataset.indices]
+    if isinstance(dataset, (torchvision.datasets.CocoDetection, CustomCocoDetection)):
+        imgs = dataset.coco.imgs
+    elif isinstance(dataset, LvisDetectionBase):
+        imgs = dataset.lvis.imgs
+    else:
+        return [(1, 1, "")] * len(dataset)
+    return [(imgs[i]["width"], imgs[i]["height"], imgs[i].get("caption", "")) for i in dataset.ids]
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler forming batches of samples with a similar image aspect ratio and caption length.
+
+    Each epoch, the indices are shuffled, then split into groups of `group_batches` batches per process. Inside a group,
+    the samples are sorted by aspect ratio bucket, then by caption length, and cut into batches, so that the images are
+    padded to a similar size by NestedTensor.from_tensor_list, and the captions by the tokenizer. The batches are then
+    shuffled again, and dealt to the processes, which all get the same number of batches.
+
+    Like DistributedSampler, set_epoch must be called at the beginning of each epoch to change the shuffling.
+
+    Args:
+        aspect_ratios: width / height of the image of each sample
+        lengths: number of tokens of the caption of each sample
+        batch_size: number of samples per batch of each process
+        aspect_ratio_bins: boundaries of the aspect ratio buckets
+        group_batches: number of batches per process sorted together. Larger groups pad less but are less random.
+        num_replicas: number of processes, defaults to the world size
+        rank: rank of the current process, defaults to the current rank
+        seed: seed of the shuffling, which must be the same on all processes
+        drop_last: if False, the last incomplete batch of the epoch is kept
+    """
+
+    def __init__(
+        self,
+        aspect_ratios: Sequence[float],
+        lengths: Sequence[int],
+        batch_size: int,
+        aspect_ratio_bins: Sequence[float] = (0.5, 0.75, 1.0, 1.33, 2.0),
+        group_batches: int = 50,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        seed: int = 0,
+        drop_last: bool = True,
+    ):
+        assert len(aspect_ratios) == len(lengths)
+        self.aspect_ratios = torch.as_tensor(aspect_ratios, dtype=torch.float)
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+        self.buckets = torch.as_tensor([bisect_right(aspect_ratio_bins, ar) for ar in aspect_ratios], dtype=torch.long)
+        self.batch_size = batch_size
+        self.group_batches = group_batches
+        self.num_replicas = num_replicas if num_replicas is not None else dist.get_world_size()
+        self.rank = rank if rank is not None else dist.get_rank()
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _global_batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator)
+        group_size = self.batch_size * self.group_batches * self.num_replicas
+        batches = []
+        max_length = int(self.lengths.max()) + 1 if len(self.lengths) > 0 else 1
+        for group in indices.split(group_size):
+            # sort by aspect ratio bucket, then by caption length
+            group = group[(self.buckets[group] * max_length + self.lengths[group]).argsort()]
+            batches.extend(group.split(self.batch_size))
+        if len(batches) > 0 and len(batches[-1]) < self.batch_size and self.drop_last:
+            batches.pop()
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i].tolist() for i in order]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._global_batches()
+        num_batches = len(self)
+        return iter(batches[self.rank :: self.num_replicas][:num_batches])
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            num_global_batches = len(self.lengths) // self.batch_size
+        else:
+            num_global_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return num_global_batches // self.num_replicas
+
+    def padding_ratio(self, batches: Optional[List[List[int]]] = None) -> Dict[str, float]:
+        """Returns the fraction of padding of the images and of the captions in the batches of the current epoch (or in
+        the given batches), estimated from the annotations.
+
+        The images are assumed to be resized to the same shortest side, as done by the training transforms.
+        """
+        if batches is None:
+            batches = self._global_batches()
+        image_area, image_padded, text_tokens, text_padded = 0.0, 0.0, 0, 0
+        for batch in batches:
+            batch = torch.as_tensor(batch, dtype=torch.long)
+            aspect_ratios = self.aspect_ratios[batch]
+            # (w, h) of each image with a shortest side of 1
+            widths, heights = aspect_ratios.clamp(min=1), (1 / aspect_ratios).clamp(min=1)
+            image_area += float((widths * heights).sum())
+            image_padded += len(batch) * float(widths.max() * heights.max())
+            lengths = self.lengths[batch]
+            text_tokens += int(lengths.sum())
+            text_padded += len(batch) * int(lengths.max())
+        return {
+            "image": 1 - image_area / max(image_padded, 1e-6),
+            "text": 1 - text_tokens / max(text_padded, 1),
+        }
+
+    def random_padding_ratio(self) -> Dict[str, float]:
+        """Returns the padding ratio of random batches of the same size, for comparison."""
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator)
+        return self.padding_ratio([batch.tolist() for batch in indices.split(self.batch_size)])
+
+    def padding_report(self) -> str:
+        """Describes the padding ratios of the current epoch against those of random batches."""
+        padding, random_padding = self.padding_ratio(), self.random_padding_ratio()
+        return (
+            f"estimated image padding {padding['image']:.1%} (random batches: {random_padding['image']:.1%}), "
+            f"caption padding {padding['text']:.1%} (random batches: {random_padding['text']:.1%})"
+        )
+
+
+class ResumableBatchSampler(Sampler):
+    """Wraps a batch sampler so that an epoch can be resumed: after skip(n), the next iteration starts at batch n.
+
+    The wrapped batch sampler must give the same batches when iterated again for the same epoch, e.g. a BatchSampler
+    over a DistributedSampler, or a BucketBatchSampler. The skipped batches are not loaded. The length is always that
+    of a full epoch.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def skip(self, num_batches: int) -> None:
+        self.start = num_batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        start, self.start = self.start, 0
+        return itertools.islice(iter(self.batch_sampler), start, None)
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
+
+
+def build_bucket_batch_sampler(dataset, tokenizer, batch_size: int, **kwargs) -> BucketBatchSampler:
+    """Builds a BucketBatchSampler over the dataset, from the image sizes and the tokenized captions of its
+    annotations."""
+    metadata = get_image_metadata(dataset)
+    aspect_ratios = [width / height for width, height, _ in metadata]
+    lengths = []
+    captions = [caption for _, _, caption in metadata]
+    for i in range(0, len(captions), 10000):
+        lengths.extend(len(ids) for ids in tokenizer(captions[i : i + 10000])["input_ids"])
+    return BucketBatchSampler(aspect_ratios, lengths, batch_size, **kwargs)
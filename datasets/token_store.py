@@ -0,0 +1,215 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Offline store of the tokenized captions of a modulated detection annotation file.
+
+The modulated datasets (coco.ModulatedDetection and its subclasses, mixed.MixedDetection, gqa.GQAQuestionAnswering)
+only run the tokenizer to resolve the character spans of the boxes ("tokens" / "tokens_positive", and
+"tokens_positive_eval") to token spans. write_token_store does it once for a whole annotation file, and TokenStore
+reads the result from memory-mapped arrays, so that the data loader workers no longer tokenize.
+
+A store is a directory <root>/<tokenizer>/<annotation file stem>-<hash>/, where hash starts the sha1 of the content of
+the annotation file, so that an edited annotation file or another one with the same name never reads a wrong store.
+It holds:
+    meta.json: tokenizer name, annotation file, its sha1 and number of images
+    image_ids.npy: (images,) sorted image ids
+    input_ids.npy, offsets.npy: (tokens,) token ids and (tokens, 2) character offsets of all the captions
+    token_index.npy: (images + 1,) start of the tokens of each image
+    spans.npy: (spans, 2) token spans [beg, end) of the annotations, end excluded
+    span_index.npy: (annotations + 1,) start of the spans of each annotation
+    ann_index.npy: (images + 1,) start of the annotations of each image, in the order of coco.getAnnIds
+    eval_spans.npy, eval_span_index.npy, eval_box_index.npy: same for the "tokens_positive_eval" boxes of the images
+
+Use scripts/pretokenize_annotations.py to write the stores.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from .coco import resolve_token_spans
+
+STORE_ARRAYS = (
+    "image_ids",
+    "input_ids",
+    "offsets",
+    "token_index",
+    "spans",
+    "span_index",
+    "ann_index",
+    "eval_spans",
+    "eval_span_index",
+    "eval_box_index",
+)
+
+
+def tokenizer_key(tokenizer) -> str:
+    """Name of the directory of the stores of a tokenizer."""
+    return tokenizer.name_or_path.rstrip("/").replace("/", "--")
+
+
+def annotation_hash(ann_file: Union[str, Path]) -> str:
+    """Returns the sha1 of the content of the annotation file."""
+    sha1 = hashlib.sha1()
+    with open(ann_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def token_store_dir(root: Union[str, Path], tokenizer, ann_file: Union[str, Path], ann_hash: str) -> Path:
+    return Path(root) / tokenizer_key(tokenizer) / f"{Path(ann_file).stem}-{ann_hash[:16]}"
+
+
+def get_tokens_positive(anns: List[Dict]) -> List:
+    """Returns the character spans of each annotation, read from the same key as ConvertCocoPolysToMask."""
+    if anns and "tokens" in anns[0]:
+        return [obj["tokens"] for obj in anns]
+    if anns and "tokens_positive" in anns[0]:
+        return [obj["tokens_positive"] for obj in anns]
+    return [[] for _ in anns]
+
+
+def _append_spans(token_spans, spans: List, span_index: List[int]) -> None:
+    for cur_spans in token_spans:
+        spans.extend(cur_spans)
+        span_index.append(len(spans))
+
+
+def write_token_store(coco, ann_file: Union[str, Path], tokenizer, root: Union[str, Path], batch_size: int = 1000):
+    """Tokenizes the captions of the coco api object loaded from ann_file, and writes their store under root.
+
+    The tokenizer must be a fast tokenizer, whose encodings give the token of a character. Returns the directory of
+    the store.
+    """
+    assert tokenizer.is_fast, "a fast tokenizer is needed to map characters to tokens"
+    image_ids = sorted(coco.imgs.keys())
+    input_ids, offsets, token_index = [], [], [0]
+    spans, span_index, ann_index = [], [0], [0]
+    eval_spans, eval_span_index, eval_box_index = [], [0], [0]
+    for start in range(0, len(image_ids), batch_size):
+        batch_ids = image_ids[start : start + batch_size]
+        imgs = coco.loadImgs(batch_ids)
+        encodings = tokenizer([img["caption"] for img in imgs], return_offsets_mapping=True).encodings
+        for image_id, img, encoding in zip(batch_ids, imgs, encodings):
+            input_ids.extend(encoding.ids)
+            offsets.extend(encoding.offsets)
+            token_index.append(len(input_ids))
+
+            anns = coco.loadAnns(coco.getAnnIds(imgIds=image_id))
+            _append_spans(resolve_token_spans(encoding, get_tokens_positive(anns)), spans, span_index)
+            ann_index.append(len(span_index) - 1)
+
+            eval_tokens_positive = img.get("tokens_positive_eval", [])
+            _append_spans(resolve_token_spans(encoding, eval_tokens_positive), eval_spans, eval_span_index)
+            eval_box_index.append(len(eval_span_index) - 1)
+
+    arrays = {
+        "image_ids": np.asarray(image_ids, dtype=np.int64),
+        "input_ids": np.asarray(input_ids, dtype=np.int32),
+        "offsets": np.asarray(offsets, dtype=np.int32).reshape(-1, 2),
+        "token_index": np.asarray(token_index, dtype=np.int64),
+        "spans": np.asarray(spans, dtype=np.int32).reshape(-1, 2),
+        "span_index": np.asarray(span_index, dtype=np.int64),
+        "ann_index": np.asarray(ann_index, dtype=np.int64),
+        "eval_spans": np.asarray(eval_spans, dtype=np.int32).reshape(-1, 2),
+        "eval_span_index": np.asarray(eval_span_index, dtype=np.int64),
+        "eval_box_index": np.asarray(eval_box_index, dtype=np.int64),
+    }
+    ann_hash = annotation_hash(ann_file)
+    store_dir = token_store_dir(root, tokenizer, ann_file, ann_hash)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(store_dir / f"{name}.npy", array)
+    meta = {
+        "tokenizer": tokenizer.name_or_path,
+        "ann_file": Path(ann_file).name,
+        "ann_sha1": ann_hash,
+        "num_images": len(image_ids),
+    }
+    with open(store_dir / "meta.json", "w") as f:
+        json.dump(meta, f)
+    return store_dir
+
+
+class TokenStore:
+    """Reads the token spans of the annotations of an image from a store written by write_token_store.
+
+    The arrays are memory-mapped on first access, in each data loader worker, and are not pickled with the dataset.
+    If ann_hash is given, the store must have been written from an annotation file with this sha1.
+    """
+
+    def __init__(self, store_dir: Union[str, Path], ann_hash: Optional[str] = None):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        if ann_hash is not None and self.meta.get("ann_sha1") != ann_hash:
+            raise ValueError(f"the token store {self.store_dir} was written from another version of its annotations")
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.store_dir / f"{name}.npy", mmap_mode="r") for name in STORE_ARRAYS}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.meta["num_images"]
+
+    def _row(self, image_id: int) -> int:
+        image_ids = self.arrays["image_ids"]
+        row = int(np.searchsorted(image_ids, image_id))
+        if row >= len(image_ids) or image_ids[row] != image_id:
+            raise KeyError(f"image {image_id} is not in the token store {self.store_dir}")
+        return row
+
+    def _box_spans(self, spans: np.ndarray, span_index: np.ndarray, beg: int, end: int) -> List[List[List[int]]]:
+        bounds = span_index[beg : end + 1].tolist()
+        return [spans[bounds[i] : bounds[i + 1]].tolist() for i in range(end - beg)]
+
+    def _tokens(self, name: str, image_id: int) -> np.ndarray:
+        row = self._row(image_id)
+        token_index = self.arrays["token_index"]
+        return np.asarray(self.arrays[name][token_index[row] : token_index[row + 1]])
+
+    def input_ids(self, image_id: int) -> np.ndarray:
+        """Returns the token ids of the caption of the image."""
+        return self._tokens("input_ids", image_id)
+
+    def offsets(self, image_id: int) -> np.ndarray:
+        """Returns the (tokens, 2) character offsets of the tokens of the caption of the image."""
+        return self._tokens("offsets", image_id)
+
+    def token_spans(self, image_id: int) -> List[List[List[int]]]:
+        """Returns the token spans of each annotation of the image, in the order of coco.getAnnIds."""
+        row = self._row(image_id)
+        arrays = self.arrays
+        beg, end = int(arrays["ann_index"][row]), int(arrays["ann_index"][row + 1])
+        return self._box_spans(arrays["spans"], arrays["span_index"], beg, end)
+
+    def eval_token_spans(self, image_id: int) -> List[List[List[int]]]:
+        """Returns the token spans of each "tokens_positive_eval" box of the image."""
+        row = self._row(image_id)
+        arrays = self.arrays
+        beg, end = int(arrays["eval_box_index"][row]), int(arrays["eval_box_index"][row + 1])
+        return self._box_spans(arrays["eval_spans"], arrays["eval_span_index"], beg, end)
+
+
+def load_token_store(args, ann_file: Union[str, Path], tokenizer) -> Optional[TokenStore]:
+    """Returns the store of the annotation file for the tokenizer if args.token_store_path is set, else None."""
+    if not getattr(args, "token_store_path", ""):
+        return None
+    ann_hash = annotation_hash(ann_file)
+    store_dir = token_store_dir(args.token_store_path, tokenizer, ann_file, ann_hash)
+    if not (store_dir / "meta.json").exists():
+        raise FileNotFoundError(
+            f"no token store for the current content of {ann_file} in {store_dir}, "
+            "create it with scripts/pretokenize_annotations.py"
+        )
+    return TokenStore(store_dir, ann_hash)
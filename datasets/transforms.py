@@ -23,7 +23,7 @@ def crop(image, target, region):
     # should we do something wrt the original size?
     target["size"] = torch.tensor([h, w])
 
-    fields = ["labels", "area", "iscrowd", "positive_map", "isfinal"]
+    fields = ["labels", "area", "iscrowd", "positive_map", "token_spans", "isfinal"]
 
     if "boxes" in target:
         boxes = target["boxes"]
@@ -108,13 +108,19 @@ def resize(image, target, size, max_size=None):
         else:
             return get_size_with_aspect_ratio(image_size, size, max_size)
 
+    original_size = image.size
     size = get_size(image.size, size, max_size)
+    if isinstance(image, PIL.Image.Image):
+        # a JPEG image that is not decoded yet (see datasets.image_shards.open_image) is decoded at the smallest DCT
+        # scale (1/2, 1/4 or 1/8) still covering the target size. It is a no-op on decoded images.
+        image.draft("RGB", size[::-1])
     rescaled_image = F.resize(image, size)
 
     if target is None:
         return rescaled_image, None
 
-    ratios = tuple(float(s) / float(s_orig) for s, s_orig in zip(rescaled_image.size, image.size))
+    # the boxes are scaled from the original size, whatever the decoded size
+    ratios = tuple(float(s) / float(s_orig) for s, s_orig in zip(rescaled_image.size, original_size))
     ratio_width, ratio_height = ratios
 
     target = target.copy()
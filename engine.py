@@ -3,9 +3,10 @@
 """
 Train and eval functions used in main.py
 """
+import contextlib
 import math
 import sys
-from typing import Dict, Iterable, Optional
+from typing import Callable, Dict, Iterable, Optional
 
 import torch
 import torch.nn
@@ -17,9 +18,25 @@ from datasets.coco_eval import CocoEvaluator
 from datasets.flickr_eval import FlickrEvaluator
 from datasets.phrasecut_eval import PhrasecutEvaluator
 from datasets.refexp import RefExpEvaluator
-from util.metrics import MetricLogger, SmoothedValue
-from util.misc import targets_to
-from util.optim import adjust_learning_rate, update_ema
+from util.amp import autocast, to_float
+from util.metrics import DeferredReducer, MetricLogger, SmoothedValue
+from util.misc import DevicePrefetcher, targets_to
+from util.optim import ModelEma, adjust_learning_rate
+
+
+def _log_losses(loss_reducer: DeferredReducer, metric_logger: MetricLogger, weight_dict: Dict[str, float]):
+    """Logs the losses accumulated in loss_reducer, and stops the training if one of them is not finite."""
+    for loss_dict_reduced in loss_reducer.flush():
+        loss_dict_reduced_unscaled = {f"{k}_unscaled": v for k, v in loss_dict_reduced.items()}
+        loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in loss_dict_reduced.items() if k in weight_dict}
+        loss_value = sum(loss_dict_reduced_scaled.values())
+
+        if not math.isfinite(loss_value):
+            print("Loss is {}, stopping training".format(loss_value))
+            print(loss_dict_reduced)
+            sys.exit(1)
+
+        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
 
 
 def train_one_epoch(
@@ -34,8 +51,23 @@ def train_one_epoch(
     epoch: int,
     args,
     max_norm: float = 0,
-    model_ema: Optional[torch.nn.Module] = None,
+    ema: Optional[ModelEma] = None,
+    scaler: Optional[torch.cuda.amp.GradScaler] = None,
+    max_steps: int = 0,
+    start_step: int = 0,
+    on_step_end: Optional[Callable[[int], None]] = None,
 ):
+    """Trains the model for one epoch, or for the first max_steps optimizer steps of it if max_steps > 0.
+
+    The gradients of args.grad_accum_steps consecutive batches are accumulated before each optimizer step. The forward
+    and the losses run under autocast if args.amp is set. A scaler (see util.amp.build_grad_scaler) is then used to
+    scale the loss for fp16. Unless args.no_prefetch is set, the batches are copied to the device ahead of time.
+    The losses are only reduced over the processes and logged every args.metrics_interval optimizer steps.
+
+    To resume an epoch, start_step is the number of optimizer steps already done in it, and data_loader must skip the
+    corresponding batches (see datasets.samplers.ResumableBatchSampler). on_step_end is called after each optimizer step
+    with the number of optimizer steps done in the epoch, e.g. to save a checkpoint.
+    """
     model.train()
     if criterion is not None:
         criterion.train()
@@ -50,57 +82,102 @@ def train_one_epoch(
     header = "Epoch: [{}]".format(epoch)
     print_freq = 10
 
-    num_training_steps = int(len(data_loader) * args.epochs)
-    for i, batch_dict in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
-        curr_step = epoch * len(data_loader) + i
-        samples = batch_dict["samples"].to(device)
-        positive_map = batch_dict["positive_map"].to(device) if "positive_map" in batch_dict else None
-        targets = batch_dict["targets"]
-        answers = {k: v.to(device) for k, v in batch_dict["answers"].items()} if "answers" in batch_dict else None
-        captions = [t["caption"] for t in targets]
-
-        targets = targets_to(targets, device)
-
-        memory_cache = None
-        if args.masks:
-            outputs = model(samples, captions)
-        else:
-            memory_cache = model(samples, captions, encode_and_save=True)
-            outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
-
-        loss_dict = {}
+    if not args.no_prefetch:
+        data_loader = DevicePrefetcher(data_loader, device)
+    accum_steps = args.grad_accum_steps
+    # the learning rate schedule counts optimizer steps, not micro-batches
+    steps_per_epoch = math.ceil(len(data_loader) / accum_steps)
+    num_training_steps = int(steps_per_epoch * args.epochs)
+    micro_batches = []
+    loss_reducer = DeferredReducer()
+    for i, batch_dict in enumerate(metric_logger.log_every(data_loader, print_freq, header), start_step * accum_steps):
+        if max_steps > 0 and i >= max_steps * accum_steps:
+            break
+        micro_batches.append(batch_dict)
+        if len(micro_batches) < accum_steps and i + 1 < len(data_loader):
+            continue
+        curr_step = epoch * steps_per_epoch + i // accum_steps
+
+        # Normalize the box losses of every micro-batch by the average number of boxes per micro-batch and process
+        # over the whole optimizer step, so that the accumulated gradient matches that of a single large batch
+        num_boxes = None
         if criterion is not None:
-            loss_dict.update(criterion(outputs, targets, positive_map))
-
-        if contrastive_criterion is not None:
-            assert memory_cache is not None
-            contrastive_loss = contrastive_criterion(memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
-            loss_dict["contrastive_loss"] = contrastive_loss
-
-        if qa_criterion is not None:
-            answer_losses = qa_criterion(outputs, answers)
-            loss_dict.update(answer_losses)
-
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
-
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = dist.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f"{k}_unscaled": v for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
-
-        loss_value = losses_reduced_scaled.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+            all_targets = [t for micro_batch in micro_batches for t in micro_batch["targets"]]
+            num_boxes = criterion.get_num_boxes(all_targets, device) / len(micro_batches)
 
         optimizer.zero_grad()
-        losses.backward()
-        if max_norm > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        optimizer.step()
+        for j, micro_batch in enumerate(micro_batches):
+            is_last = j == len(micro_batches) - 1
+            samples = micro_batch["samples"].to(device)
+            positive_map = micro_batch["positive_map"].to(device) if "positive_map" in micro_batch else None
+            targets = micro_batch["targets"]
+            answers = (
+                {k: v.to(device) for k, v in micro_batch["answers"].items()} if "answers" in micro_batch else None
+            )
+            captions = [t["caption"] for t in targets]
+
+            targets = targets_to(targets, device)
+
+            # DDP only needs to all-reduce the gradients once they are fully accumulated
+            sync_context = (
+                model.no_sync()
+                if not is_last and isinstance(model, torch.nn.parallel.DistributedDataParallel)
+                else contextlib.nullcontext()
+            )
+            with sync_context:
+                with autocast(device, args.amp):
+                    memory_cache = None
+                    if args.masks:
+                        outputs = model(samples, captions)
+                    else:
+                        memory_cache = model(samples, captions, encode_and_save=True)
+                        outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
+
+                    loss_dict = {}
+                    if criterion is not None:
+                        loss_dict.update(criterion(outputs, targets, positive_map, num_boxes=num_boxes))
+
+                    if contrastive_criterion is not None:
+                        assert memory_cache is not None
+                        contrastive_loss = contrastive_criterion(
+                            memory_cache["text_pooled_op"], memory_cache["img_pooled_op"]
+                        )
+                        loss_dict["contrastive_loss"] = contrastive_loss
+
+                    if qa_criterion is not None:
+                        answer_losses = qa_criterion(outputs, answers)
+                        loss_dict.update(answer_losses)
+
+                    losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+
+                # the losses are reduced over all GPUs for logging purposes every args.metrics_interval steps
+                loss_reducer.add(loss_dict)
+
+                # the losses of the micro-batches are averaged
+                losses = losses / len(micro_batches)
+                if scaler is not None:
+                    scaler.scale(losses).backward()
+                else:
+                    losses.backward()
+        micro_batches = []
+        if len(loss_reducer) >= args.metrics_interval * accum_steps:
+            # checked before the optimizer step, so that a diverged step is not applied with args.metrics_interval 1
+            _log_losses(loss_reducer, metric_logger, weight_dict)
+
+        if ema is not None:
+            # the previous average update may still be reading the weights on its own stream
+            ema.wait()
+        if scaler is not None:
+            if max_norm > 0:
+                # the gradients must be unscaled for the norm to be compared with max_norm
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            if max_norm > 0:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+            optimizer.step()
 
         adjust_learning_rate(
             optimizer,
@@ -109,13 +186,17 @@ def train_one_epoch(
             num_training_steps=num_training_steps,
             args=args,
         )
-        if model_ema is not None:
-            update_ema(model, model_ema, args.ema_decay)
+        if ema is not None:
+            ema.update()
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(lr_backbone=optimizer.param_groups[1]["lr"])
         metric_logger.update(lr_text_encoder=optimizer.param_groups[2]["lr"])
+        if on_step_end is not None:
+            on_step_end(i // accum_steps + 1)
+    _log_losses(loss_reducer, metric_logger, weight_dict)
+    if ema is not None:
+        ema.wait()
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -146,6 +227,9 @@ def evaluate(
     metric_logger = MetricLogger(delimiter="  ")
     header = "Test:"
 
+    if not args.no_prefetch:
+        data_loader = DevicePrefetcher(data_loader, device)
+
     for batch_dict in metric_logger.log_every(data_loader, 10, header):
         samples = batch_dict["samples"].to(device)
         positive_map = batch_dict["positive_map"].to(device) if "positive_map" in batch_dict else None
@@ -155,25 +239,28 @@ def evaluate(
 
         targets = targets_to(targets, device)
 
-        memory_cache = None
-        if args.masks:
-            outputs = model(samples, captions)
-        else:
-            memory_cache = model(samples, captions, encode_and_save=True)
-            outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
-
-        loss_dict = {}
-        if criterion is not None:
-            loss_dict.update(criterion(outputs, targets, positive_map))
-
-        if contrastive_criterion is not None:
-            assert memory_cache is not None
-            contrastive_loss = contrastive_criterion(memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
-            loss_dict["contrastive_loss"] = contrastive_loss
-
-        if qa_criterion is not None:
-            answer_losses = qa_criterion(outputs, answers)
-            loss_dict.update(answer_losses)
+        with autocast(device, args.amp):
+            memory_cache = None
+            if args.masks:
+                outputs = model(samples, captions)
+            else:
+                memory_cache = model(samples, captions, encode_and_save=True)
+                outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
+
+            loss_dict = {}
+            if criterion is not None:
+                loss_dict.update(criterion(outputs, targets, positive_map))
+
+            if contrastive_criterion is not None:
+                assert memory_cache is not None
+                contrastive_loss = contrastive_criterion(memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
+                loss_dict["contrastive_loss"] = contrastive_loss
+
+            if qa_criterion is not None:
+                answer_losses = qa_criterion(outputs, answers)
+                loss_dict.update(answer_losses)
+        # box post-processing and evaluation run in fp32
+        outputs = to_float(outputs)
 
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = dist.reduce_dict(loss_dict)
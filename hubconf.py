@@ -5,6 +5,7 @@ from models.backbone import Backbone, Joiner, TimmBackbone
 from models.mdetr import MDETR
 from models.position_encoding import PositionEmbeddingSine
 from models.postprocessors import PostProcess, PostProcessSegm
+from models.quantization import quantize_dynamic
 from models.segmentation import DETRsegm
 from models.transformer import Transformer
 
@@ -56,7 +57,12 @@ def _make_detr(
     return detr
 
 
-def mdetr_resnet101(pretrained=False, return_postprocessor=False):
+def _maybe_quantize(model, quantize: bool):
+    # after loading the pretrained weights, which are those of the float model
+    return quantize_dynamic(model) if quantize else model
+
+
+def mdetr_resnet101(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Pretrained on our combined aligned dataset of 1.3 million images paired with text.
@@ -70,12 +76,13 @@ def mdetr_resnet101(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB3(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB3(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB3 with 6 encoder and 6 decoder layers.
     Pretrained on our combined aligned dataset of 1.3 million images paired with text.
@@ -89,12 +96,13 @@ def mdetr_efficientnetB3(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB5(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB5(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB5 with 6 encoder and 6 decoder layers.
     Pretrained on our combined aligned dataset of 1.3 million images paired with text.
@@ -108,12 +116,13 @@ def mdetr_efficientnetB5(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_clevr(pretrained=False, return_postprocessor=False):
+def mdetr_clevr(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R18 with 6 encoder and 6 decoder layers.
     Trained on CLEVR, achieves 99.7% accuracy
@@ -125,12 +134,13 @@ def mdetr_clevr(pretrained=False, return_postprocessor=False):
             url="https://zenodo.org/record/4721981/files/clevr_checkpoint.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_clevr_humans(pretrained=False, return_postprocessor=False):
+def mdetr_clevr_humans(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R18 with 6 encoder and 6 decoder layers.
     Trained on CLEVR-Humans, achieves 81.7% accuracy
@@ -144,12 +154,13 @@ def mdetr_clevr_humans(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_resnet101_gqa(pretrained=False, return_postprocessor=False):
+def mdetr_resnet101_gqa(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Trained on GQA, achieves 61.99 on test-std
@@ -163,12 +174,13 @@ def mdetr_resnet101_gqa(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB5_gqa(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB5_gqa(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB5 with 6 encoder and 6 decoder layers.
     Trained on GQA, achieves 61.99 on test-std
@@ -180,12 +192,13 @@ def mdetr_efficientnetB5_gqa(pretrained=False, return_postprocessor=False):
             url="https://zenodo.org/record/4721981/files/gqa_EB5_checkpoint.pth", map_location="cpu", check_hash=True
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_resnet101_phrasecut(pretrained=False, threshold=0.5, return_postprocessor=False):
+def mdetr_resnet101_phrasecut(pretrained=False, threshold=0.5, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Trained on Phrasecut, achieves 53.1 M-IoU on the test set
@@ -198,12 +211,13 @@ def mdetr_resnet101_phrasecut(pretrained=False, threshold=0.5, return_postproces
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, [PostProcess(), PostProcessSegm(threshold=threshold)]
     return model
 
 
-def mdetr_efficientnetB3_phrasecut(pretrained=False, threshold=0.5, return_postprocessor=False):
+def mdetr_efficientnetB3_phrasecut(pretrained=False, threshold=0.5, return_postprocessor=False, quantize=False):
     """
     MDETR ENB3 with 6 encoder and 6 decoder layers.
     Trained on Phrasecut, achieves 53.7 M-IoU on the test set
@@ -216,12 +230,13 @@ def mdetr_efficientnetB3_phrasecut(pretrained=False, threshold=0.5, return_postp
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, [PostProcess(), PostProcessSegm(threshold=threshold)]
     return model
 
 
-def mdetr_resnet101_refcoco(pretrained=False, return_postprocessor=False):
+def mdetr_resnet101_refcoco(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Trained on refcoco, achieves 86.75 val accuracy
@@ -234,12 +249,13 @@ def mdetr_resnet101_refcoco(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB3_refcoco(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB3_refcoco(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB3 with 6 encoder and 6 decoder layers.
     Trained on refcoco, achieves 86.75 val accuracy
@@ -252,12 +268,13 @@ def mdetr_efficientnetB3_refcoco(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_resnet101_refcocoplus(pretrained=False, return_postprocessor=False):
+def mdetr_resnet101_refcocoplus(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Trained on refcoco+, achieves 79.52 val accuracy
@@ -270,12 +287,13 @@ def mdetr_resnet101_refcocoplus(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB3_refcocoplus(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB3_refcocoplus(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB3 with 6 encoder and 6 decoder layers.
     Trained on refcoco+, achieves 81.13 val accuracy
@@ -288,12 +306,13 @@ def mdetr_efficientnetB3_refcocoplus(pretrained=False, return_postprocessor=Fals
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_resnet101_refcocog(pretrained=False, return_postprocessor=False):
+def mdetr_resnet101_refcocog(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR R101 with 6 encoder and 6 decoder layers.
     Trained on refcocog, achieves 81.64 val accuracy
@@ -306,12 +325,13 @@ def mdetr_resnet101_refcocog(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
 
 
-def mdetr_efficientnetB3_refcocog(pretrained=False, return_postprocessor=False):
+def mdetr_efficientnetB3_refcocog(pretrained=False, return_postprocessor=False, quantize=False):
     """
     MDETR ENB3 with 6 encoder and 6 decoder layers.
     Trained on refcocog, achieves 83.35 val accuracy
@@ -324,6 +344,7 @@ def mdetr_efficientnetB3_refcocog(pretrained=False, return_postprocessor=False):
             check_hash=True,
         )
         model.load_state_dict(checkpoint["model"])
+    model = _maybe_quantize(model, quantize)
     if return_postprocessor:
         return model, PostProcess()
     return model
@@ -3,6 +3,7 @@
 import argparse
 import datetime
 import json
+import math
 import os
 import random
 import time
@@ -20,7 +21,11 @@ from torch.utils.data import ConcatDataset, DataLoader, DistributedSampler
 from transformers import AutoTokenizer
 import util.dist as dist
 import util.misc as utils
+from util.amp import autocast_support_error, build_grad_scaler, load_grad_scaler_state
+from util.checkpoint import AsyncCheckpointWriter, get_rng_states, load_checkpoint, set_rng_states
+from util.optim import ModelEma
 from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.samplers import ResumableBatchSampler, build_bucket_batch_sampler
 from datasets.clevrref import ClevrRefEvaluator
 from datasets.coco_eval import CocoEvaluator
 from datasets.flickr_eval import FlickrEvaluator
@@ -66,12 +71,39 @@ def get_args_parser():
         default="",
     )
     parser.add_argument("--modulated_lvis_ann_path", type=str, default="")
+    parser.add_argument(
+        "--image_shards",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Shard sets written by scripts/pack_image_shards.py. The images packed in them are read from the shards "
+        "instead of the image folders.",
+    )
+    parser.add_argument(
+        "--jpeg_draft",
+        action="store_true",
+        help="Let the JPEG decoder downscale the images (by 1/2, 1/4 or 1/8) to the smallest scale still covering the "
+        "size sampled by the first resize of the transforms, instead of decoding them at full resolution",
+    )
+    parser.add_argument(
+        "--token_store_path",
+        type=str,
+        default="",
+        help="Root of the token stores written by scripts/pretokenize_annotations.py. "
+        "If set, the modulated datasets read the token spans of the boxes from it instead of tokenizing the captions.",
+    )
 
     # Training hyper-parameters
     parser.add_argument("--lr", default=1e-4, type=float)
     parser.add_argument("--lr_backbone", default=1e-5, type=float)
     parser.add_argument("--text_encoder_lr", default=5e-5, type=float)
     parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument(
+        "--grad_accum_steps",
+        default=1,
+        type=int,
+        help="Number of batches whose gradients are accumulated before each optimizer step",
+    )
     parser.add_argument("--weight_decay", default=1e-4, type=float)
     parser.add_argument("--epochs", default=40, type=int)
     parser.add_argument("--lr_drop", default=35, type=int)
@@ -96,9 +128,34 @@ def get_args_parser():
         type=str,
         choices=("step", "multistep", "linear_with_warmup", "all_linear_with_warmup"),
     )
+    parser.add_argument(
+        "--checkpoint_activations",
+        nargs="*",
+        default=[],
+        choices=("backbone", "text_encoder", "encoder", "decoder"),
+        help="Submodules whose activations are recomputed in backward instead of being stored, to save memory",
+    )
     parser.add_argument("--ema", action="store_true")
     parser.add_argument("--ema_decay", type=float, default=0.9998)
+    parser.add_argument(
+        "--ema_interval",
+        type=int,
+        default=1,
+        help="Update the EMA every this many steps, with the decay adjusted to average over the same horizon",
+    )
+    parser.add_argument("--ema_cpu", action="store_true", help="Keep the EMA weights on CPU to save device memory")
+    parser.add_argument(
+        "--ema_stream", action="store_true", help="Update the EMA on a side cuda stream, overlapping with the forward"
+    )
     parser.add_argument("--fraction_warmup_steps", default=0.01, type=float, help="Fraction of total number of steps")
+    parser.add_argument(
+        "--amp",
+        type=str,
+        default=None,
+        choices=("fp16", "bf16"),
+        help="Run the forward and the losses under autocast with this dtype "
+        "(bf16 needs torch >= 1.10, then also works on CPU)",
+    )
 
     # Model parameters
     parser.add_argument(
@@ -253,6 +310,12 @@ def get_args_parser():
         type=float,
         help="giou box coefficient in the matching cost",
     )
+    parser.add_argument(
+        "--matcher_workers",
+        default=4,
+        type=int,
+        help="Number of threads solving the Hungarian matchings of the images and decoder layers (<= 1: sequential)",
+    )
     # Loss coefficients
     parser.add_argument("--ce_loss_coef", default=1, type=float)
     parser.add_argument("--mask_loss_coef", default=1, type=float)
@@ -277,10 +340,46 @@ def get_args_parser():
     parser.add_argument("--device", default="cuda", help="device to use for training / testing")
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument("--resume", default="", help="resume from checkpoint")
+    parser.add_argument(
+        "--checkpoint_steps",
+        default=0,
+        type=int,
+        help="If > 0, also save a resumable checkpoint every this many optimizer steps, in the middle of the epochs",
+    )
+    parser.add_argument("--keep_checkpoints", default=2, type=int, help="Number of step checkpoints kept on disk")
     parser.add_argument("--load", default="", help="resume from checkpoint")
     parser.add_argument("--start-epoch", default=0, type=int, metavar="N", help="start epoch")
     parser.add_argument("--eval", action="store_true", help="Only run evaluation")
     parser.add_argument("--num_workers", default=5, type=int)
+    parser.add_argument(
+        "--metrics_interval",
+        default=10,
+        type=int,
+        help="Reduce and log the training losses (and check that they are finite) every this many optimizer steps",
+    )
+    parser.add_argument(
+        "--bucket_batches",
+        action="store_true",
+        help="Group the training samples of similar image aspect ratio and caption length in batches to reduce padding",
+    )
+    parser.add_argument(
+        "--bucket_group_batches",
+        default=50,
+        type=int,
+        help="Number of batches per process sorted together by --bucket_batches (larger: less padding, less random)",
+    )
+    parser.add_argument(
+        "--no_prefetch",
+        action="store_true",
+        help="Copy each batch to the device synchronously, instead of pinning it and prefetching it on a side stream",
+    )
+    parser.add_argument(
+        "--benchmark_steps",
+        default=0,
+        type=int,
+        help="If > 0, only measure the training throughput over this many steps, then exit",
+    )
+    parser.add_argument("--benchmark_warmup_steps", default=5, type=int, help="Steps run before measuring throughput")
 
     # Distributed training parameters
     parser.add_argument("--world-size", default=1, type=int, help="number of distributed processes")
@@ -333,6 +432,10 @@ def main(args):
     model_without_ddp = model
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
+        if len(args.checkpoint_activations) > 0:
+            # the parameters of the checkpointed modules only get their gradients during the recomputation in
+            # backward, which DDP only supports with a static graph
+            model._set_static_graph()
         model_without_ddp = model.module
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print("number of params:", n_parameters)
@@ -361,6 +464,9 @@ def main(args):
         optimizer = torch.optim.AdamW(param_dicts, lr=args.lr, weight_decay=args.weight_decay)
     else:
         raise RuntimeError(f"Unsupported optimizer {args.optimizer}")
+    scaler = build_grad_scaler(device, args.amp)
+    # pinned batches can be copied to the gpu asynchronously by the prefetcher (see util.misc.DevicePrefetcher)
+    pin_memory = device.type == "cuda" and not args.no_prefetch
 
     # Train dataset
     if len(args.combine_datasets) == 0 and not args.eval:
@@ -372,6 +478,10 @@ def main(args):
             [build_dataset(name, image_set="train", args=args) for name in args.combine_datasets]
         )
 
+        if args.bucket_batches:
+            tokenizer = AutoTokenizer.from_pretrained(args.text_encoder_type)
+            bucket_kwargs = dict(group_batches=args.bucket_group_batches, seed=args.seed)
+
         # To handle very big datasets, we chunk it into smaller parts.
         if args.epoch_chunks > 0:
             print(
@@ -380,36 +490,63 @@ def main(args):
             )
             chunks = torch.chunk(torch.arange(len(dataset_train)), args.epoch_chunks)
             datasets = [torch.utils.data.Subset(dataset_train, chunk.tolist()) for chunk in chunks]
-            if args.distributed:
-                samplers_train = [DistributedSampler(ds) for ds in datasets]
+            if args.bucket_batches:
+                # the bucketed batch samplers shuffle and shard the chunks themselves
+                samplers_train = [
+                    build_bucket_batch_sampler(ds, tokenizer, args.batch_size, **bucket_kwargs) for ds in datasets
+                ]
+                batch_samplers_train = samplers_train
+                for i, sampler_train in enumerate(samplers_train):
+                    print(f"Bucketed batches of chunk {i}: {sampler_train.padding_report()}")
             else:
-                samplers_train = [torch.utils.data.RandomSampler(ds) for ds in datasets]
-
-            batch_samplers_train = [
-                torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
-                for sampler_train in samplers_train
-            ]
+                if args.distributed or args.checkpoint_steps > 0:
+                    # the shuffling of DistributedSampler only depends on the seed and the epoch, so that epochs can be
+                    # resumed. The seed is the same on all ranks.
+                    samplers_train = [
+                        DistributedSampler(
+                            ds, num_replicas=dist.get_world_size(), rank=dist.get_rank(), seed=args.seed
+                        )
+                        for ds in datasets
+                    ]
+                else:
+                    samplers_train = [torch.utils.data.RandomSampler(ds) for ds in datasets]
+
+                batch_samplers_train = [
+                    torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
+                    for sampler_train in samplers_train
+                ]
             assert len(batch_samplers_train) == len(datasets)
             data_loaders_train = [
                 DataLoader(
                     ds,
-                    batch_sampler=batch_sampler_train,
+                    batch_sampler=ResumableBatchSampler(batch_sampler_train),
                     collate_fn=partial(utils.collate_fn, False),
+                    pin_memory=pin_memory,
                     num_workers=args.num_workers,
                 )
                 for ds, batch_sampler_train in zip(datasets, batch_samplers_train)
             ]
         else:
-            if args.distributed:
-                sampler_train = DistributedSampler(dataset_train)
+            if args.bucket_batches:
+                sampler_train = build_bucket_batch_sampler(dataset_train, tokenizer, args.batch_size, **bucket_kwargs)
+                batch_sampler_train = sampler_train
+                print(f"Bucketed batches: {sampler_train.padding_report()}")
             else:
-                sampler_train = torch.utils.data.RandomSampler(dataset_train)
-
-            batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
+                if args.distributed or args.checkpoint_steps > 0:
+                    # the shuffling of DistributedSampler only depends on the seed and the epoch, so that epochs can be
+                    # resumed. The seed is the same on all ranks.
+                    sampler_train = DistributedSampler(
+                        dataset_train, num_replicas=dist.get_world_size(), rank=dist.get_rank(), seed=args.seed
+                    )
+                else:
+                    sampler_train = torch.utils.data.RandomSampler(dataset_train)
+
+                batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, args.batch_size, drop_last=True)
             data_loader_train = DataLoader(
                 dataset_train,
-                batch_sampler=batch_sampler_train,
+                batch_sampler=ResumableBatchSampler(batch_sampler_train),
                 collate_fn=partial(utils.collate_fn, False),
+                pin_memory=pin_memory,
                 num_workers=args.num_workers,
             )
 
@@ -431,16 +568,14 @@ def main(args):
             sampler=sampler,
             drop_last=False,
             collate_fn=partial(utils.collate_fn, False),
+            pin_memory=pin_memory,
             num_workers=args.num_workers,
         )
         base_ds = get_coco_api_from_dataset(dset)
         val_tuples.append(Val_all(dataset_name=dset_name, dataloader=dataloader, base_ds=base_ds, evaluator_list=None))
 
     if args.frozen_weights is not None:
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        checkpoint = load_checkpoint(args.resume)
         if "model_ema" in checkpoint and checkpoint["model_ema"] is not None:
             model_without_ddp.detr.load_state_dict(checkpoint["model_ema"], strict=False)
         else:
@@ -453,7 +588,7 @@ def main(args):
     # loading into a model with different functionality.
     if args.load:
         print("loading from", args.load)
-        checkpoint = torch.load(args.load, map_location="cpu")
+        checkpoint = load_checkpoint(args.load)
         if "model_ema" in checkpoint:
             state_dict = checkpoint["model_ema"]
         else:
@@ -470,15 +605,23 @@ def main(args):
             model_ema = deepcopy(model_without_ddp)
 
     # Used for resuming training from the checkpoint of a model. Used when training times-out or is pre-empted.
+    start_step, ema_num_steps = 0, 0
     if args.resume:
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        checkpoint = load_checkpoint(args.resume)
         model_without_ddp.load_state_dict(checkpoint["model"])
         if not args.eval and "optimizer" in checkpoint and "epoch" in checkpoint:
             optimizer.load_state_dict(checkpoint["optimizer"])
             args.start_epoch = checkpoint["epoch"] + 1
+            if checkpoint.get("step_in_epoch") is not None:
+                # step checkpoint, saved in the middle of the epoch
+                args.start_epoch = checkpoint["epoch"]
+                start_step = checkpoint["step_in_epoch"]
+                ema_num_steps = checkpoint.get("ema_num_steps", 0)
+                rng_states = checkpoint["rng_states"]
+                if len(rng_states) == dist.get_world_size():
+                    set_rng_states(rng_states[dist.get_rank()])
+                print(f"Resuming epoch {args.start_epoch} after {start_step} steps")
+            load_grad_scaler_state(scaler, checkpoint.get("scaler"))
         if args.ema:
             if "model_ema" not in checkpoint:
                 print("WARNING: ema model not found in checkpoint, resetting to current model")
@@ -559,6 +702,90 @@ def main(args):
         print(log_stats)
         return
 
+    ema = None
+    if model_ema is not None:
+        if args.ema_cpu:
+            model_ema.to("cpu")
+        ema = ModelEma(
+            model_without_ddp, model_ema, args.ema_decay, interval=args.ema_interval, use_stream=args.ema_stream
+        )
+        ema.num_steps = ema_num_steps
+
+    # Measures the training throughput on the first steps of an epoch, without saving anything
+    if args.benchmark_steps > 0:
+        train_kwargs = dict(
+            model=model,
+            criterion=criterion,
+            contrastive_criterion=contrastive_criterion,
+            qa_criterion=qa_criterion,
+            data_loader=data_loader_train,
+            weight_dict=weight_dict,
+            optimizer=optimizer,
+            device=device,
+            epoch=args.start_epoch,
+            args=args,
+            max_norm=args.clip_max_norm,
+            ema=ema,
+            scaler=scaler,
+        )
+        if args.benchmark_warmup_steps > 0:
+            train_one_epoch(**train_kwargs, max_steps=args.benchmark_warmup_steps)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        start_time = time.time()
+        train_one_epoch(**train_kwargs, max_steps=args.benchmark_steps)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = time.time() - start_time
+        num_images = args.benchmark_steps * args.grad_accum_steps * args.batch_size * dist.get_world_size()
+        benchmark_stats = {
+            "amp": args.amp,
+            "grad_accum_steps": args.grad_accum_steps,
+            "prefetch": not args.no_prefetch,
+            "checkpoint_activations": args.checkpoint_activations,
+            "bucket_batches": args.bucket_batches,
+            "steps": args.benchmark_steps,
+            "seconds_per_step": elapsed / args.benchmark_steps,
+            "images_per_second": num_images / elapsed,
+        }
+        if device.type == "cuda":
+            benchmark_stats["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 1024**2
+        print("Benchmark:", json.dumps(benchmark_stats))
+        if args.output_dir and dist.is_main_process():
+            with (output_dir / "benchmark.txt").open("a") as f:
+                f.write(json.dumps(benchmark_stats) + "\n")
+        return
+
+    checkpoint_writer = AsyncCheckpointWriter()
+
+    def save_step_checkpoint(epoch: int, step_in_epoch: int):
+        """Saves a checkpoint from which the epoch can be resumed after step_in_epoch optimizer steps."""
+        if args.checkpoint_steps <= 0 or step_in_epoch % args.checkpoint_steps != 0 or not args.output_dir:
+            return
+        # the random states of all the processes are needed to resume, so every process takes part
+        rng_states = dist.all_gather(get_rng_states())
+        if not dist.is_main_process():
+            return
+        if ema is not None:
+            ema.wait()
+        steps_per_epoch = math.ceil(len(data_loader_train) / args.grad_accum_steps)
+        checkpoint_writer.save(
+            {
+                "model": model_without_ddp.state_dict(),
+                "model_ema": model_ema.state_dict() if args.ema else None,
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "epoch": epoch,
+                "step_in_epoch": step_in_epoch,
+                "ema_num_steps": ema.num_steps if ema is not None else 0,
+                "rng_states": rng_states,
+                "args": args,
+            },
+            output_dir / f"checkpoint_step{epoch * steps_per_epoch + step_in_epoch:09d}.pth",
+            rotate=("checkpoint_step*.pth", args.keep_checkpoints),
+        )
+
     # Runs training and evaluates after every --eval_skip epochs
     print("Start training")
     start_time = time.time()
@@ -570,8 +797,10 @@ def main(args):
             print(f"Starting epoch {epoch // len(data_loaders_train)}, sub_epoch {epoch % len(data_loaders_train)}")
         else:
             print(f"Starting epoch {epoch}")
-        if args.distributed:
+        if args.distributed or args.bucket_batches or args.checkpoint_steps > 0:
             sampler_train.set_epoch(epoch)
+        if start_step > 0:
+            data_loader_train.batch_sampler.skip(start_step * args.grad_accum_steps)
         train_stats = train_one_epoch(
             model=model,
             criterion=criterion,
@@ -584,14 +813,19 @@ def main(args):
             epoch=epoch,
             args=args,
             max_norm=args.clip_max_norm,
-            model_ema=model_ema,
+            ema=ema,
+            scaler=scaler,
+            start_step=start_step,
+            on_step_end=partial(save_step_checkpoint, epoch),
         )
-        if args.output_dir:
-            dist.save_on_master(
+        start_step = 0
+        if args.output_dir and dist.is_main_process():
+            checkpoint_writer.save(
                 {
                     "model": model_without_ddp.state_dict(),
                     "model_ema": model_ema.state_dict() if args.ema else None,
                     "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
                     "epoch": epoch,
                     "args": args,
                 },
@@ -601,6 +835,8 @@ def main(args):
         if epoch % args.eval_skip == 0:
             test_stats = {}
             test_model = model_ema if model_ema is not None else model
+            if args.ema_cpu and model_ema is not None:
+                test_model = deepcopy(model_ema).to(device)
             for i, item in enumerate(val_tuples):
                 evaluator_list = build_evaluator_list(item.base_ds, item.dataset_name)
                 item = item._replace(evaluator_list=evaluator_list)
@@ -651,6 +887,7 @@ def main(args):
                     output_dir / "BEST_checkpoint.pth",
                 )
 
+    checkpoint_writer.wait()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print("Training time {}".format(total_time_str))
@@ -659,6 +896,10 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("DETR training and evaluation script", parents=[get_args_parser()])
     _args = parser.parse_args()
+    # e.g. bf16 needs torch >= 1.10, fail before building the model and the datasets
+    _amp_error = autocast_support_error(torch.device(_args.device).type, _args.amp)
+    if _amp_error is not None:
+        parser.error(f"--amp {_args.amp}: {_amp_error}")
     if _args.output_dir:
         Path(_args.output_dir).mkdir(parents=True, exist_ok=True)
     main(_args)
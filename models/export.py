@@ -0,0 +1,202 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Tensor-only wrappers of the two phases of MDETR, for export to TorchScript (tracing) and ONNX.
+
+MDETR.forward switches between the encoding and the decoding phase with a flag and passes a dict holding a
+BatchEncoding between them, neither of which can be exported. MDETREncoder and MDETRDecoder split the model into two
+graphs whose inputs and outputs are plain tensors. Tokenization happens outside of the graphs.
+"""
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple, Union
+
+import torch
+from torch import Tensor, nn
+
+from util.misc import NestedTensor
+
+from .mdetr import MDETR
+
+ENCODER_INPUTS = ("images", "image_mask", "input_ids", "attention_mask")
+ENCODER_OUTPUTS = ("img_memory", "memory_mask", "pos_embed", "text_memory", "text_attention_mask")
+DECODER_INPUTS = ENCODER_OUTPUTS
+DECODER_OUTPUTS = ("pred_logits", "pred_boxes")
+CONTRASTIVE_ALIGN_OUTPUTS = ("proj_queries", "proj_tokens")
+
+
+class MDETREncoder(nn.Module):
+    """Encoding phase of MDETR: backbone, text encoder and cross-modal encoder.
+
+    Inputs:
+        images: (b, 3, H, W) normalized images, zero-padded to a common size
+        image_mask: (b, H, W) boolean mask, True on padded pixels
+        input_ids: (b, seq) token ids of the captions
+        attention_mask: (b, seq) attention mask of the tokenizer, 1 on tokens and 0 on padding
+    Outputs:
+        img_memory: (img+seq, b, hid) output of the cross-modal encoder
+        memory_mask: (b, img+seq) boolean mask, True on padding
+        pos_embed: (img+seq, b, hid) position encoding of the memory
+        text_memory: (seq, b, hid) text part of img_memory
+        text_attention_mask: (b, seq) boolean mask, True on padding tokens
+    """
+
+    def __init__(self, model: MDETR):
+        super().__init__()
+        assert isinstance(model, MDETR), "segmentation models are not supported"
+        self.model = model
+
+    def forward(self, images: Tensor, image_mask: Tensor, input_ids: Tensor, attention_mask: Tensor):
+        transformer = self.model.transformer
+        text_attention_mask, text_memory_resized, _ = transformer.encode_tokens(
+            {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+        memory_cache = self.model(
+            NestedTensor(images, image_mask), (text_attention_mask, text_memory_resized, None), encode_and_save=True
+        )
+        return (
+            memory_cache["img_memory"],
+            memory_cache["mask"],
+            memory_cache["pos_embed"],
+            memory_cache["text_memory"],
+            memory_cache["text_attention_mask"],
+        )
+
+
+class MDETRDecoder(nn.Module):
+    """Decoding phase of MDETR: transformer decoder and prediction heads of the last decoder layer.
+
+    Takes the outputs of MDETREncoder as inputs, and returns pred_logits (b, queries, seq) and pred_boxes
+    (b, queries, 4), followed by proj_queries (b, queries, hdim) and proj_tokens (b, seq, hdim) if the model was
+    trained with the contrastive align loss.
+    """
+
+    def __init__(self, model: MDETR):
+        super().__init__()
+        assert isinstance(model, MDETR), "segmentation models are not supported"
+        self.model = model
+
+    def forward(
+        self,
+        img_memory: Tensor,
+        memory_mask: Tensor,
+        pos_embed: Tensor,
+        text_memory: Tensor,
+        text_attention_mask: Tensor,
+    ):
+        query_embed = self.model.query_embed.weight
+        if self.model.qa_dataset is not None:
+            query_embed = torch.cat([query_embed, self.model.qa_embed.weight], 0)
+        memory_cache = {
+            "img_memory": img_memory,
+            "mask": memory_mask,
+            "pos_embed": pos_embed,
+            "query_embed": query_embed.unsqueeze(1).repeat(1, img_memory.shape[1], 1),
+            # the decoder layers do not attend to the text memory on its own, it is only used for its shape
+            "text_memory_resized": text_memory,
+            "text_memory": text_memory,
+            "text_attention_mask": text_attention_mask,
+            "tokenized": None,
+        }
+        out = self.model(None, None, encode_and_save=False, memory_cache=memory_cache, inference=True)
+        outputs = (out["pred_logits"], out["pred_boxes"])
+        if self.model.contrastive_align_loss:
+            outputs += (out["proj_queries"], out["proj_tokens"])
+        return outputs
+
+
+def decoder_output_names(model: MDETR) -> Tuple[str, ...]:
+    return DECODER_OUTPUTS + (CONTRASTIVE_ALIGN_OUTPUTS if model.contrastive_align_loss else ())
+
+
+def prepare_inputs(
+    model: MDETR, images: Sequence[Tensor], captions: List[str], image_size: Tuple[int, int]
+) -> Dict[str, Tensor]:
+    """Returns the inputs of MDETREncoder for the given transformed images and captions.
+
+    Images are zero-padded to the fixed `image_size` canvas (H, W): some backbones (e.g. the timm tf_* models with
+    "same" padding) compute their padding from the input size in Python, so the exported graphs are only valid for the
+    image size they were traced with.
+    """
+    assert all(image.shape[-2] <= image_size[0] and image.shape[-1] <= image_size[1] for image in images)
+    tensors = torch.zeros((len(images), 3) + tuple(image_size))
+    mask = torch.ones((len(images),) + tuple(image_size), dtype=torch.bool)
+    for image, pad_image, m in zip(images, tensors, mask):
+        pad_image[:, : image.shape[1], : image.shape[2]].copy_(image)
+        m[: image.shape[1], : image.shape[2]] = False
+    tokenized = model.transformer.tokenizer.batch_encode_plus(captions, padding="longest", return_tensors="pt")
+    return {
+        "images": tensors,
+        "image_mask": mask,
+        "input_ids": tokenized["input_ids"],
+        "attention_mask": tokenized["attention_mask"],
+    }
+
+
+@torch.no_grad()
+def export_torchscript(model: MDETR, inputs: Dict[str, Tensor], output_dir: Union[str, Path]) -> Tuple[Path, Path]:
+    """Traces the encoder and decoder graphs with the example inputs and saves them as encoder.pt and decoder.pt."""
+    model.eval()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    encoder_inputs = tuple(inputs[name] for name in ENCODER_INPUTS)
+    encoder = torch.jit.trace(MDETREncoder(model), encoder_inputs, strict=False)
+    decoder = torch.jit.trace(MDETRDecoder(model), encoder(*encoder_inputs), strict=False)
+    encoder_path, decoder_path = output_dir / "encoder.pt", output_dir / "decoder.pt"
+    torch.jit.save(encoder, str(encoder_path))
+    torch.jit.save(decoder, str(decoder_path))
+    return encoder_path, decoder_path
+
+
+@torch.no_grad()
+def export_onnx(
+    model: MDETR, inputs: Dict[str, Tensor], output_dir: Union[str, Path], opset_version: int = 12
+) -> Tuple[Path, Path]:
+    """Exports the encoder and decoder graphs as encoder.onnx and decoder.onnx.
+
+    The batch size and the caption length are dynamic, the image size is fixed to that of the example inputs.
+    """
+    model.eval()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    encoder_inputs = tuple(inputs[name] for name in ENCODER_INPUTS)
+    encoder_path, decoder_path = output_dir / "encoder.onnx", output_dir / "decoder.onnx"
+    torch.onnx.export(
+        MDETREncoder(model),
+        encoder_inputs,
+        str(encoder_path),
+        input_names=list(ENCODER_INPUTS),
+        output_names=list(ENCODER_OUTPUTS),
+        dynamic_axes={
+            "images": {0: "batch"},
+            "image_mask": {0: "batch"},
+            "input_ids": {0: "batch", 1: "seq"},
+            "attention_mask": {0: "batch", 1: "seq"},
+            "img_memory": {0: "memory", 1: "batch"},
+            "memory_mask": {0: "batch", 1: "memory"},
+            "pos_embed": {0: "memory", 1: "batch"},
+            "text_memory": {0: "seq", 1: "batch"},
+            "text_attention_mask": {0: "batch", 1: "seq"},
+        },
+        opset_version=opset_version,
+    )
+    output_names = decoder_output_names(model)
+    dynamic_axes = {
+        "img_memory": {0: "memory", 1: "batch"},
+        "memory_mask": {0: "batch", 1: "memory"},
+        "pos_embed": {0: "memory", 1: "batch"},
+        "text_memory": {0: "seq", 1: "batch"},
+        "text_attention_mask": {0: "batch", 1: "seq"},
+        "pred_logits": {0: "batch"},
+        "pred_boxes": {0: "batch"},
+        "proj_queries": {0: "batch"},
+        "proj_tokens": {0: "batch", 1: "seq"},
+    }
+    torch.onnx.export(
+        MDETRDecoder(model),
+        MDETREncoder(model)(*encoder_inputs),
+        str(decoder_path),
+        input_names=list(DECODER_INPUTS),
+        output_names=list(output_names),
+        dynamic_axes={name: axes for name, axes in dynamic_axes.items() if name in DECODER_INPUTS + output_names},
+        opset_version=opset_version,
+    )
+    return encoder_path, decoder_path
@@ -3,9 +3,13 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
 import torch
 from scipy.optimize import linear_sum_assignment
-from torch import nn
+from torch import Tensor, nn
+from torch.nn.utils.rnn import pad_sequence
 
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
@@ -18,19 +22,23 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, num_workers: int = 0):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_workers: Number of threads solving the LSAPs of the images (and decoder layers) concurrently. SciPy
+                releases the GIL while solving. With 0 or 1, they are solved sequentially.
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        self.num_workers = num_workers
         self.norm = nn.Softmax(-1)
+        self._executor = None
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
     @torch.no_grad()
@@ -54,21 +62,48 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        return self.match_layers([outputs], targets, positive_map)[0]
+
+    @torch.no_grad()
+    def match_layers(
+        self, outputs_list: List[Dict[str, Tensor]], targets, positive_map
+    ) -> List[List[Tuple[Tensor, Tensor]]]:
+        """Matches the outputs of several decoder layers to the same targets at once.
 
-        # We flatten to compute the cost matrices in a batch
-        out_prob = self.norm(outputs["pred_logits"].flatten(0, 1))  # [batch_size * num_queries, num_classes]
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
+        Only the per-image blocks of the cost matrix are computed: the targets are padded to the largest number of boxes
+        of an image, giving a [num_layers * batch_size, num_queries, max_target_boxes] cost, instead of the dense
+        [batch_size * num_queries, total_target_boxes] one. It is copied to CPU in one go, and the LSAPs of all the
+        images and layers are solved on a thread pool.
 
-        # Also concat the target labels and boxes
-        tgt_bbox = torch.cat([v["boxes"] for v in targets])
-        assert len(tgt_bbox) == len(positive_map)
+        Returns the indices of forward for each element of outputs_list.
+        """
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
+        sizes = [len(v["boxes"]) for v in targets]
+        assert sum(sizes) == len(positive_map)
+
+        # We stack the layers to compute the cost matrices in a batch
+        out_prob = self.norm(torch.cat([out["pred_logits"] for out in outputs_list]))  # [L * bs, queries, classes]
+        out_bbox = torch.cat([out["pred_boxes"] for out in outputs_list])  # [L * bs, queries, 4]
+
+        # Pad the target boxes and positive maps of each image to the same number of boxes. Padding boxes are valid
+        # boxes for the giou, their costs are dropped before solving.
+        max_size = max(max(sizes), 1)
+        tgt_bbox = pad_sequence([v["boxes"] for v in targets], batch_first=True)
+        tgt_bbox = torch.cat([tgt_bbox, tgt_bbox.new_zeros((bs, max_size - tgt_bbox.shape[1], 4))], 1)
+        num_boxes = torch.as_tensor(sizes, device=tgt_bbox.device)
+        valid = torch.arange(max_size, device=tgt_bbox.device)[None] < num_boxes[:, None]  # [bs, max_size]
+        tgt_bbox = torch.where(valid[..., None], tgt_bbox, tgt_bbox.new_tensor([0.5, 0.5, 1.0, 1.0]))
+        tgt_map = positive_map.new_zeros((bs, max_size, positive_map.shape[-1]))
+        tgt_map[valid] = positive_map
+        tgt_bbox = tgt_bbox.repeat(num_layers, 1, 1)  # [L * bs, max_size, 4]
+        tgt_map = tgt_map.repeat(num_layers, 1, 1)  # [L * bs, max_size, classes]
 
         # Compute the soft-cross entropy between the predicted token alignment and the GT one for each box
-        cost_class = -(out_prob.unsqueeze(1) * positive_map.unsqueeze(0)).sum(-1)
+        cost_class = -torch.bmm(out_prob, tgt_map.transpose(1, 2).to(out_prob.dtype))
 
         # Compute the L1 cost between boxes
-        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+        cost_bbox = torch.cdist(out_bbox, tgt_bbox.to(out_bbox.dtype), p=1)
         assert cost_class.shape == cost_bbox.shape
 
         # Compute the giou cost betwen boxes
@@ -76,11 +111,24 @@ class HungarianMatcher(nn.Module):
 
         # Final cost matrix
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
+        C = C.view(num_layers, bs, num_queries, max_size).float().cpu().numpy()
 
-        sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        indices = self._solve([C[l, i, :, :size] for l in range(num_layers) for i, size in enumerate(sizes)])
+        indices = [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        return [indices[l * bs : (l + 1) * bs] for l in range(num_layers)]
+
+    def _solve(self, cost_matrices):
+        if self.num_workers <= 1 or len(cost_matrices) <= 1:
+            return [linear_sum_assignment(c) for c in cost_matrices]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.num_workers, thread_name_prefix="lsap")
+        return list(self._executor.map(linear_sum_assignment, cost_matrices))
+
+    def __getstate__(self):
+        # the thread pool cannot be pickled nor copied, it is created again when needed
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
 
 
 def build_matcher(args):
@@ -89,6 +137,7 @@ def build_matcher(args):
             cost_class=args.set_cost_class,
             cost_bbox=args.set_cost_bbox,
             cost_giou=args.set_cost_giou,
+            num_workers=args.matcher_workers,
         )
     else:
         raise ValueError(f"Only hungarian accepted, got {args.set_loss}")
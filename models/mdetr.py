@@ -13,7 +13,7 @@ from torch import nn
 import util.dist as dist
 from util import box_ops
 from util.metrics import accuracy
-from util.misc import NestedTensor, interpolate
+from util.misc import NestedTensor, checkpoint_module, interpolate
 
 from .backbone import build_backbone
 from .matcher import build_matcher
@@ -106,10 +106,38 @@ class MDETR(nn.Module):
                 assert qa_dataset == "gqa", "Clevr QA is not supported with unified head"
                 self.answer_head = nn.Linear(hidden_dim, 1853)
 
-    def forward(self, samples: NestedTensor, captions, encode_and_save=True, memory_cache=None):
+    def encode_image(self, samples: NestedTensor) -> NestedTensor:
+        """Runs the backbone and returns its last feature map, the only part of the encoding that does not depend on
+        the captions. The result can be cached and passed back to forward() as `image_features`, so that grounding
+        another caption on the same images skips the backbone.
+        """
+        if not isinstance(samples, NestedTensor):
+            samples = NestedTensor.from_tensor_list(samples)
+        features, _ = self.backbone(samples)
+        return features[-1]
+
+    def forward(
+        self,
+        samples: NestedTensor,
+        captions,
+        encode_and_save=True,
+        memory_cache=None,
+        image_features: Optional[NestedTensor] = None,
+        image_index: Optional[torch.Tensor] = None,
+        inference: bool = False,
+        return_projections: bool = True,
+    ):
         """The forward expects a NestedTensor, which consists of:
            - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
            - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+        When encoding, the backbone output of encode_image() can be given as `image_features` instead, in which case
+        samples is ignored (and may be None).
+        To ground several captions on the same image, `image_index` (a long tensor with one entry per caption) gives
+        the image of the batch each caption is paired with. The backbone then runs once per image and its output is
+        broadcast over the captions of the image before the cross-modal encoder; all the outputs are per caption.
+        When decoding with `inference` set, the intermediate decoder states are not kept and the heads only run on the
+        last decoder layer, so "aux_outputs" is never returned. The contrastive align projections ("proj_queries",
+        "proj_tokens") are skipped if `return_projections` is False.
 
         It returns a dict with the following elements:
            - "pred_logits": the classification logits (including no-object) for all queries.
@@ -121,21 +149,30 @@ class MDETR(nn.Module):
            - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
                             dictionnaries containing the two above keys for each decoder layer.
         """
-        if not isinstance(samples, NestedTensor):
+        if samples is not None and not isinstance(samples, NestedTensor):
             samples = NestedTensor.from_tensor_list(samples)  # (b, 3, H, W)
 
         if encode_and_save:
             assert memory_cache is None
-            features, pos = self.backbone(samples)  # [(b, hid, 25, 45)], [(b, 384, 25, 45)]
-            src, mask = features[-1].decompose()  # (b, 384, 25, 45), (b, 25, 45)
+            if image_features is None:
+                features, pos = self.backbone(samples)  # [(b, hid, 25, 45)], [(b, 384, 25, 45)]
+                image_features, pos_embed = features[-1], pos[-1]
+            else:
+                # the position encoding only depends on the padding mask, it is recomputed for the given batch
+                pos_embed = self.backbone[1](image_features).to(image_features.tensors.dtype)
+            src, mask = image_features.decompose()  # (b, 384, 25, 45), (b, 25, 45)
+            src = self.input_proj(src)  # (b, 256, 25, 45)
+            if image_index is not None:
+                # (images, ...) -> (captions, ...)
+                src, mask, pos_embed = src[image_index], mask[image_index], pos_embed[image_index]
             query_embed = self.query_embed.weight
             if self.qa_dataset is not None:
                 query_embed = torch.cat([query_embed, self.qa_embed.weight], 0)
             memory_cache = self.transformer(
-                self.input_proj(src),  # (b, 256, 25, 45)
+                src,
                 mask,
                 query_embed,
-                pos[-1],
+                pos_embed,
                 captions,
                 encode_and_save=True,
                 text_memory=None,
@@ -144,7 +181,9 @@ class MDETR(nn.Module):
             )
 
             if self.contrastive_loss:
-                memory_cache["text_pooled_op"] = self.contrastive_projection_text(memory_cache["text_pooled_op"])
+                # the pooled text output is not available when the captions are given pre-encoded
+                if memory_cache["text_pooled_op"] is not None:
+                    memory_cache["text_pooled_op"] = self.contrastive_projection_text(memory_cache["text_pooled_op"])
                 memory_cache["img_pooled_op"] = self.contrastive_projection_image(memory_cache["img_pooled_op"])
 
             return memory_cache
@@ -159,6 +198,8 @@ class MDETR(nn.Module):
                 text_memory=memory_cache["text_memory_resized"],
                 img_memory=memory_cache["img_memory"],
                 text_attention_mask=memory_cache["text_attention_mask"],
+                # the QA heads read the output of the first decoder layer
+                return_intermediate=False if inference and self.qa_dataset is None else None,
             )
             out = {}
             if self.qa_dataset is not None:
@@ -187,6 +228,8 @@ class MDETR(nn.Module):
                     hs = hs[:, :, :-1]
                     out["pred_answer"] = self.answer_head(answer_embeds)
 
+            if inference:
+                hs = hs[-1:]
             outputs_class = self.class_embed(hs)  # token distribution 予測のヘッド
             outputs_coord = self.bbox_embed(hs).sigmoid()  # bounding box 座標の予測ヘッド
             out.update(
@@ -200,7 +243,7 @@ class MDETR(nn.Module):
                 outputs_isfinal = self.isfinal_embed(hs)
                 out["pred_isfinal"] = outputs_isfinal[-1]
             proj_queries, proj_tokens = None, None
-            if self.contrastive_align_loss:
+            if self.contrastive_align_loss and return_projections:
                 proj_queries = F.normalize(self.contrastive_align_projection_image(hs), p=2, dim=-1)
                 proj_tokens = F.normalize(
                     self.contrastive_align_projection_text(memory_cache["text_memory"]).transpose(0, 1), p=2, dim=-1
@@ -212,8 +255,8 @@ class MDETR(nn.Module):
                         "tokenized": memory_cache["tokenized"],
                     }
                 )
-            if self.aux_loss:
-                if self.contrastive_align_loss:
+            if self.aux_loss and not inference:
+                if self.contrastive_align_loss and return_projections:
                     assert proj_tokens is not None and proj_queries is not None
                     out["aux_outputs"] = [
                         {
@@ -505,39 +548,47 @@ class SetCriterion(nn.Module):
         )  # BS x (num_queries) x (num_tokens)
 
         # construct a map such that positive_map[k, i,j] = True iff query i is associated to token j in batch item k
-        # For efficency, the construction happens on CPU, then the whole matrix is transferred to GPU in one go.
-        positive_map = torch.zeros(logits.shape, dtype=torch.bool)
-        for i, ((idx_src, idx_tgt), tgt) in enumerate(zip(indices, targets)):
-            if "tokens_positive" in tgt:
-                cur_tokens = [tgt["tokens_positive"][j] for j in idx_tgt]
-            else:
-                cur_tokens = [tgt["tokens"][j] for j in idx_tgt]
-
-            for j, tok_list in enumerate(cur_tokens):
-                for (beg, end) in tok_list:
-                    beg_pos = tokenized.char_to_token(i, beg)
-                    end_pos = tokenized.char_to_token(i, end - 1)
-                    if beg_pos is None:
-                        try:
-                            beg_pos = tokenized.char_to_token(beg + 1)
-                            if beg_pos is None:
-                                beg_pos = tokenized.char_to_token(beg + 2)
-                        except:
-                            beg_pos = None
-                    if end_pos is None:
-                        try:
-                            end_pos = tokenized.char_to_token(end - 2)
-                            if end_pos is None:
-                                end_pos = tokenized.char_to_token(end - 3)
-                        except:
-                            end_pos = None
-                    if beg_pos is None or end_pos is None:
-                        continue
-
-                    assert beg_pos is not None and end_pos is not None
-                    positive_map[i, idx_src[j], beg_pos : end_pos + 1].fill_(True)
-
-        positive_map = positive_map.to(logits.device)
+        if "token_spans" in targets[0]:
+            # the token spans of the boxes are resolved by the dataset, the map is built on the device with one scatter
+            positive_map = torch.zeros(logits.shape, dtype=torch.bool, device=logits.device)
+            batch_idx, src_idx = self._get_src_permutation_idx(indices)
+            spans = torch.cat([t["token_spans"][j] for t, (_, j) in zip(targets, indices)])  # (num_matched, spans, 2)
+            token_idx = torch.arange(logits.shape[-1], device=logits.device)
+            span_map = ((token_idx >= spans[..., :1]) & (token_idx < spans[..., 1:])).any(1)
+            positive_map[batch_idx, src_idx] = span_map
+        else:
+            # For efficency, the construction happens on CPU, then the whole matrix is transferred to GPU in one go.
+            positive_map = torch.zeros(logits.shape, dtype=torch.bool)
+            for i, ((idx_src, idx_tgt), tgt) in enumerate(zip(indices, targets)):
+                if "tokens_positive" in tgt:
+                    cur_tokens = [tgt["tokens_positive"][j] for j in idx_tgt]
+                else:
+                    cur_tokens = [tgt["tokens"][j] for j in idx_tgt]
+
+                for j, tok_list in enumerate(cur_tokens):
+                    for (beg, end) in tok_list:
+                        beg_pos = tokenized.char_to_token(i, beg)
+                        end_pos = tokenized.char_to_token(i, end - 1)
+                        if beg_pos is None:
+                            try:
+                                beg_pos = tokenized.char_to_token(beg + 1)
+                                if beg_pos is None:
+                                    beg_pos = tokenized.char_to_token(beg + 2)
+                            except:
+                                beg_pos = None
+                        if end_pos is None:
+                            try:
+                                end_pos = tokenized.char_to_token(end - 2)
+                                if end_pos is None:
+                                    end_pos = tokenized.char_to_token(end - 3)
+                            except:
+                                end_pos = None
+                        if beg_pos is None or end_pos is None:
+                            continue
+
+                        assert beg_pos is not None and end_pos is not None
+                        positive_map[i, idx_src[j], beg_pos : end_pos + 1].fill_(True)
+            positive_map = positive_map.to(logits.device)
         positive_logits = -logits.masked_fill(~positive_map, 0)
         negative_logits = logits  # .masked_fill(positive_map, -1000000)
 
@@ -654,24 +705,33 @@ class SetCriterion(nn.Module):
         assert loss in loss_map, f"do you really want to compute {loss} loss?"
         return loss_map[loss](outputs, targets, positive_map, indices, num_boxes, **kwargs)
 
-    def forward(self, outputs, targets, positive_map):
+    @staticmethod
+    def get_num_boxes(targets, device) -> float:
+        """Returns the average number of target boxes accross all nodes, for normalization purposes"""
+        num_boxes = sum(len(t["labels"]) for t in targets)
+        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=device)
+        if dist.is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(num_boxes)
+        return torch.clamp(num_boxes / dist.get_world_size(), min=1).item()
+
+    def forward(self, outputs, targets, positive_map, num_boxes: Optional[float] = None):
         """This performs the loss computation.
         Parameters:
             outputs: dict of tensors, see the output specification of the model for the format
             targets: list of dicts, such that len(targets) == batch_size.
                 The expected keys in each dict depends on the losses applied, see each loss' doc
+            num_boxes: number of boxes the losses are normalized by. Defaults to the average number of target boxes
+                accross all nodes. Set it when accumulating gradients over several batches.
         """
         outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets, positive_map)
+        # Retrieve the matching between the outputs of the last layer (and of each intermediate layer) and the targets.
+        # All the layers are matched at once.
+        outputs_list = [outputs_without_aux] + list(outputs.get("aux_outputs", []))
+        indices, *aux_indices = self.matcher.match_layers(outputs_list, targets, positive_map)
 
-        # Compute the average number of target boxes accross all nodes, for normalization purposes
-        num_boxes = sum(len(t["labels"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
-        if dist.is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / dist.get_world_size(), min=1).item()
+        if num_boxes is None:
+            num_boxes = self.get_num_boxes(targets, next(iter(outputs.values())).device)
 
         # Compute all the requested losses
         losses = {}
@@ -680,8 +740,7 @@ class SetCriterion(nn.Module):
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if "aux_outputs" in outputs:
-            for i, aux_outputs in enumerate(outputs["aux_outputs"]):
-                indices = self.matcher(aux_outputs, targets, positive_map)
+            for i, (aux_outputs, indices) in enumerate(zip(outputs["aux_outputs"], aux_indices)):
                 for loss in self.losses:
                     if loss == "masks":
                         # Intermediate masks losses are too costly to compute, we ignore them.
@@ -709,6 +768,38 @@ class MLP(nn.Module):
         return x
 
 
+CHECKPOINTABLE_SUBMODULES = ("backbone", "text_encoder", "encoder", "decoder")
+
+
+def enable_activation_checkpointing(model, submodules):
+    """Enables activation checkpointing in training for the given submodules of the model (see
+    CHECKPOINTABLE_SUBMODULES): the stages of the backbone, the text encoder, and the layers of the transformer encoder
+    and decoder. Their activations are recomputed during backward instead of being stored, which lowers the peak memory
+    at the cost of an extra forward of these submodules.
+    """
+    detr = model.detr if isinstance(model, DETRsegm) else model
+    for name in submodules:
+        assert name in CHECKPOINTABLE_SUBMODULES, f"cannot checkpoint the activations of {name}"
+    if "backbone" in submodules:
+        body = detr.backbone[0].body
+        # stages of the timm efficientnets, or layers of the resnets
+        stages = body.blocks if hasattr(body, "blocks") else [m for n, m in body.named_children() if "layer" in n]
+        for stage in stages:
+            checkpoint_module(stage)
+    if "text_encoder" in submodules:
+        text_encoder = detr.transformer.text_encoder
+        if hasattr(text_encoder, "gradient_checkpointing_enable"):
+            text_encoder.gradient_checkpointing_enable()
+        else:
+            text_encoder.config.gradient_checkpointing = True
+    if "encoder" in submodules:
+        for layer in detr.transformer.encoder.layers:
+            checkpoint_module(layer)
+    if "decoder" in submodules:
+        for layer in detr.transformer.decoder.layers:
+            checkpoint_module(layer)
+
+
 def build(args):
     num_classes = 255
     device = torch.device(args.device)
@@ -751,6 +842,7 @@ def build(args):
             mask_head=args.mask_model,
             freeze_detr=(args.frozen_weights is not None),
         )
+    enable_activation_checkpointing(model, args.checkpoint_activations)
     matcher = build_matcher(args)
     weight_dict = {"loss_ce": args.ce_loss_coef, "loss_bbox": args.bbox_loss_coef}
     if args.contrastive_loss:
@@ -0,0 +1,29 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Dynamic int8 quantization of MDETR for CPU inference.
+"""
+import torch
+from torch import nn
+
+from .segmentation import DETRsegm
+
+# Submodules whose nn.Linear layers are quantized. The convolutional backbone is left in fp32.
+QUANTIZED_SUBMODULES = (
+    "transformer.encoder",
+    "transformer.decoder",
+    "transformer.resizer",
+    "transformer.text_encoder",
+    "class_embed",
+    "bbox_embed",
+)
+
+
+def quantize_dynamic(model: nn.Module, dtype=torch.qint8) -> nn.Module:
+    """Returns a copy of the model where the nn.Linear layers of the text encoder, the transformer, the feature
+    resizer and the prediction heads use dynamically quantized int8 weights.
+
+    Dynamically quantized modules only run on CPU, and weights must be loaded before quantizing.
+    """
+    prefix = "detr." if isinstance(model, DETRsegm) else ""
+    qconfig_spec = {prefix + name for name in QUANTIZED_SUBMODULES}
+    return torch.quantization.quantize_dynamic(model.cpu().eval(), qconfig_spec, dtype=dtype)
@@ -73,6 +73,40 @@ class Transformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def _encode_text(self, text: List[str], device):
+        tokenized = self.tokenizer.batch_encode_plus(text, padding="longest", return_tensors="pt").to(device)
+        text_attention_mask, text_memory_resized, pooler_output = self.encode_tokens(tokenized)
+        return text_attention_mask, text_memory_resized, tokenized, pooler_output
+
+    def encode_tokens(self, tokenized):
+        """Runs the text encoder on already tokenized captions (a mapping with at least input_ids and attention_mask).
+
+        Returns the (text_attention_mask, text_memory_resized, pooler_output) tensors. Unlike encode_text(), this only
+        involves tensors, so that it can be traced.
+        """
+        encoded_text = self.text_encoder(**tokenized)
+
+        # Transpose memory because pytorch's attention expects sequence first
+        # As text is not truncated, the length of the text is that of the longest text in the batch
+        text_memory = encoded_text.last_hidden_state.transpose(0, 1)  # (b, text, hid) -> (text, b, hid)
+        # Invert attention mask that we get from huggingface because its the opposite in pytorch transformer
+        text_attention_mask = tokenized["attention_mask"].ne(1).bool()
+
+        # Resize the encoder hidden states to be of the same d_model as the decoder
+        text_memory_resized = self.resizer(text_memory)  # (text, b, hid)
+        return text_attention_mask, text_memory_resized, encoded_text.pooler_output
+
+    def encode_text(self, text: List[str], device=None):
+        """Encodes the given captions with the text encoder.
+
+        Returns the (text_attention_mask, text_memory_resized, tokenized) tuple that forward() accepts in place of
+        the raw captions, so that the text encoding can be computed once and reused.
+        """
+        if device is None:
+            device = next(self.text_encoder.parameters()).device
+        text_attention_mask, text_memory_resized, tokenized, _ = self._encode_text(text, device)
+        return text_attention_mask, text_memory_resized, tokenized
+
     def forward(
         self,
         src=None,
@@ -84,6 +118,7 @@ class Transformer(nn.Module):
         text_memory=None,
         img_memory=None,
         text_attention_mask=None,
+        return_intermediate: Optional[bool] = None,
     ):
         if encode_and_save:
             # flatten NxCxHxW to HWxNxC
@@ -114,19 +149,10 @@ class Transformer(nn.Module):
                 src, tgt, query_embed, pos_embed = src + 0.1 * pos_embed, query_embed, None, None
 
             device = src.device
+            text_pooled_op = None
             if isinstance(text[0], str):
                 # Encode the text
-                tokenized = self.tokenizer.batch_encode_plus(text, padding="longest", return_tensors="pt").to(device)
-                encoded_text = self.text_encoder(**tokenized)
-
-                # Transpose memory because pytorch's attention expects sequence first
-                # As text is not truncated, the length of the text is that of the longest text in the batch
-                text_memory = encoded_text.last_hidden_state.transpose(0, 1)  # (b, text, hid) -> (text, b, hid)
-                # Invert attention mask that we get from huggingface because its the opposite in pytorch transformer
-                text_attention_mask = tokenized.attention_mask.ne(1).bool()
-
-                # Resize the encoder hidden states to be of the same d_model as the decoder
-                text_memory_resized = self.resizer(text_memory)  # (text, b, hid)
+                text_attention_mask, text_memory_resized, tokenized, text_pooled_op = self._encode_text(text, device)
             else:
                 # The text is already encoded, use as is.
                 text_attention_mask, text_memory_resized, tokenized = text
@@ -147,7 +173,7 @@ class Transformer(nn.Module):
                 "text_memory_resized": text_memory_resized,
                 "text_memory": text_memory,
                 "img_memory": img_memory,
-                "text_pooled_op": encoded_text.pooler_output if self.CLS is not None else None,
+                "text_pooled_op": text_pooled_op if self.CLS is not None else None,
                 "img_pooled_op": img_memory[0] if self.CLS is not None else None,  # Return the CLS token
                 "mask": mask,
                 "text_attention_mask": text_attention_mask,
@@ -173,7 +199,11 @@ class Transformer(nn.Module):
                 text_memory_key_padding_mask=text_attention_mask,
                 pos=pos_embed,
                 query_pos=query_embed,
+                return_intermediate=return_intermediate,
             )  # (6, bb, b, hid)
+            if hs.dim() == 3:
+                # only the last layer was returned
+                hs = hs.unsqueeze(0)  # (1, bb, b, hid)
             return hs.transpose(1, 2)
 
 
@@ -222,7 +252,13 @@ class TransformerDecoder(nn.Module):
         memory_key_padding_mask: Optional[Tensor] = None,
         pos: Optional[Tensor] = None,
         query_pos: Optional[Tensor] = None,
+        return_intermediate: Optional[bool] = None,
     ):
+        """Returns the stacked outputs of all the layers if return_intermediate (which defaults to the value given at
+        construction) is set, and only the output of the last layer otherwise. The latter is enough at inference and
+        avoids normalizing and keeping the intermediate outputs."""
+        if return_intermediate is None:
+            return_intermediate = self.return_intermediate
         output = tgt
 
         intermediate = []
@@ -240,16 +276,16 @@ class TransformerDecoder(nn.Module):
                 pos=pos,
                 query_pos=query_pos,
             )
-            if self.return_intermediate:
+            if return_intermediate:
                 intermediate.append(self.norm(output))
 
         if self.norm is not None:
             output = self.norm(output)
-            if self.return_intermediate:
+            if return_intermediate:
                 intermediate.pop()
                 intermediate.append(output)
 
-        if self.return_intermediate:
+        if return_intermediate:
             return torch.stack(intermediate)
 
         return output
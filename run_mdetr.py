@@ -1,8 +1,11 @@
 import argparse
-import math
+import hashlib
+import io
+import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,11 +13,16 @@ import torch
 import torchvision.transforms as tt
 from PIL import Image, ImageFile
 from rhoknp import Document, Jumanpp
+from torch.utils.data import DataLoader
 from transformers import BatchEncoding, CharSpan
 
+from util.cache import LRUCache
+from util.checkpoint import load_checkpoint, resolve_detr_config
+from util.misc import NestedTensor
 from util.util import CamelCaseDataClassJsonMixin, Rectangle
 
 from hubconf import _make_detr  # noqa: E402
+from models.quantization import quantize_dynamic
 
 torch.set_grad_enabled(False)
 
@@ -39,6 +47,220 @@ class MDETRPrediction(CamelCaseDataClassJsonMixin):
     words: List[str]
 
 
+class TextMemoryCache:
+    """Caches the text encoder output of captions, keyed by (text_encoder, caption).
+
+    Each caption is encoded once and padded or broadcast to the batches it appears in afterwards, so that the text
+    encoder does not run again for every image batch grounded against the same caption.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2):
+        self.cache = LRUCache(max_bytes)
+        self.morpheme_indices = LRUCache(max_bytes // 16)
+
+    def get(
+        self, model: torch.nn.Module, text_encoder: str, captions: List[str]
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[BatchEncoding]]:
+        """Returns the text attention mask (b, seq) and the resized text memory (seq, b, hid) of the captions, padded to
+        the longest one, along with the unpadded tokenization of each caption (a batch of one).
+
+        Captions that are not cached yet are encoded together in one batch.
+        """
+        entries = {}
+        for caption in dict.fromkeys(captions):
+            entry = self.cache.get((text_encoder, caption))
+            if entry is not None:
+                entries[caption] = entry
+        missing = [caption for caption in dict.fromkeys(captions) if caption not in entries]
+        if len(missing) > 0:
+            text_attention_mask, text_memory_resized, tokenized = model.transformer.encode_text(missing)
+            lengths = tokenized['attention_mask'].sum(dim=1).tolist()
+            for i, (caption, length) in enumerate(zip(missing, lengths)):
+                # clone the slices of the caption, so that the cache does not keep the whole padded batch alive and
+                # the byte budget is only charged for the caption
+                caption_tokenized = BatchEncoding(
+                    {key: tokenized[key][i : i + 1, :length].clone() for key in ('input_ids', 'attention_mask')},
+                    encoding=[tokenized.encodings[i]],
+                )
+                entries[caption] = (
+                    text_attention_mask[i : i + 1, :length].clone(),  # (1, seq)
+                    text_memory_resized[:length, i : i + 1].clone(),  # (seq, 1, hid)
+                    caption_tokenized,
+                )
+                self.cache.put((text_encoder, caption), entries[caption])
+
+        b = len(captions)
+        tokenizations = [entries[caption][2] for caption in captions]
+        if len(entries) == 1:
+            # a single caption is broadcast over the batch without copy
+            text_attention_mask, text_memory_resized, _ = entries[captions[0]]
+            return text_attention_mask.expand(b, -1), text_memory_resized.expand(-1, b, -1), tokenizations
+        seq = max(entry[0].shape[1] for entry in entries.values())
+        text_memory_resized = entries[captions[0]][1]
+        text_attention_mask = torch.ones((b, seq), dtype=torch.bool, device=text_memory_resized.device)
+        padded_memory = text_memory_resized.new_zeros((seq, b, text_memory_resized.shape[2]))
+        for j, caption in enumerate(captions):
+            mask, memory, _ = entries[caption]
+            text_attention_mask[j, : mask.shape[1]] = mask[0]
+            padded_memory[: memory.shape[0], j] = memory[:, 0]
+        return text_attention_mask, padded_memory, tokenizations
+
+    def get_morpheme_index(self, text_encoder: str, caption: Document, tokenized: BatchEncoding) -> torch.Tensor:
+        # token positions do not depend on the padding of the batch, so the index can be shared between batches
+        key = (text_encoder, caption.text, tuple(m.text for m in caption.morphemes))
+        morpheme_index = self.morpheme_indices.get(key)
+        if morpheme_index is None:
+            morpheme_index = build_morpheme_index(tokenized, caption)
+            self.morpheme_indices.put(key, morpheme_index)
+        return morpheme_index
+
+
+class ImageFeatureCache:
+    """Caches the backbone features of images, keyed by a hash of the image content.
+
+    Grounding a new caption on an already seen image then only runs the text encoder, the cross-modal encoder and the
+    decoder. Features are stored cropped to the valid (unpadded) area of each image and on the device of the model, so
+    a cache must only be used with a single model.
+    """
+
+    def __init__(self, max_bytes: int = 1024**3):
+        self.cache = LRUCache(max_bytes)
+
+    def get(self, model: torch.nn.Module, samples: NestedTensor, image_keys: List[Hashable]) -> NestedTensor:
+        features: List[Optional[torch.Tensor]] = [self.cache.get(key) for key in image_keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        if len(missing) > 0:
+            index = torch.as_tensor(missing, device=samples.tensors.device)
+            computed = model.encode_image(NestedTensor(samples.tensors[index], samples.mask[index]))
+            tensors, mask = computed.decompose()  # (m, hid, h, w), (m, h, w)
+            valid = ~mask
+            heights, widths = valid.any(dim=2).sum(dim=1).tolist(), valid.any(dim=1).sum(dim=1).tolist()
+            for i, tensor, h, w in zip(missing, tensors, heights, widths):
+                # clone so that the cache does not keep the whole padded batch alive
+                features[i] = tensor[:, :h, :w].clone()
+                self.cache.put(image_keys[i], features[i])
+        return NestedTensor.from_tensor_list(features)
+
+
+class CaptionAnalyzer:
+    """Analyzes raw captions with a single long-lived Juman++ process.
+
+    Parsed captions are cached in memory and, if `cache_dir` is given, on disk as Juman++ output keyed by a hash of
+    the caption text, so that utterances that recur within or across runs are analyzed once.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None, jumanpp: Optional[Jumanpp] = None):
+        self.jumanpp = jumanpp if jumanpp is not None else Jumanpp()
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._parsed: Dict[str, str] = {}
+
+    def _cache_path(self, text: str) -> Path:
+        return self.cache_dir / f'{hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()}.jumanpp'
+
+    def _load(self, text: str) -> Optional[str]:
+        if text not in self._parsed and self.cache_dir is not None and self._cache_path(text).exists():
+            self._parsed[text] = self._cache_path(text).read_text()
+        return self._parsed.get(text)
+
+    def _store(self, text: str, parsed: str) -> None:
+        self._parsed[text] = parsed
+        if self.cache_dir is not None:
+            # write atomically so that concurrent runs sharing the cache never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(parsed)
+            os.replace(tmp_path, self._cache_path(text))
+
+    def analyze(self, text: str) -> Document:
+        return self.analyze_batch([text])[0]
+
+    def analyze_batch(self, texts: List[str]) -> List[Document]:
+        """Returns a new Document for each text. Each distinct text is analyzed at most once."""
+        for text in dict.fromkeys(texts):
+            if self._load(text) is None:
+                self._store(text, self.jumanpp.apply_to_document(text).to_jumanpp())
+        return [Document.from_jumanpp(self._parsed[text]) for text in texts]
+
+
+def read_captions(captions_file: Path) -> Tuple[List[str], List[str]]:
+    """Reads one caption per line, optionally prefixed by its id and a tab. Returns the ids and the captions."""
+    doc_ids, texts = [], []
+    for i, line in enumerate(captions_file.read_text().splitlines()):
+        if line.strip() == '':
+            continue
+        doc_id, _, text = line.rpartition('\t')
+        doc_ids.append(doc_id or str(i))
+        texts.append(text)
+    return doc_ids, texts
+
+
+def build_morpheme_index(
+    tokenized: BatchEncoding, caption: Document, batch_index: int = 0
+) -> torch.Tensor:  # (morphemes, k)
+    """Maps each morpheme of the caption to the positions of the tokens that overlap it.
+
+    The index is padded with -1, which points to an extra zero column appended to the token probabilities, so that the
+    probability of a morpheme is the maximum of the probabilities of its subword tokens (0 if it has none).
+    """
+    # for each character, the last token that covers it
+    char_tokens: List[Optional[int]] = [None] * len(caption.text)
+    for pos in range(len(tokenized.input_ids[batch_index])):
+        try:
+            span: CharSpan = tokenized.token_to_chars(batch_index, pos)
+        except TypeError:
+            # special tokens are not aligned to any character
+            continue
+        if span is None:
+            continue
+        char_tokens[span.start : span.end] = [pos] * (span.end - span.start)
+    morpheme_tokens: List[List[int]] = []
+    char_span = CharSpan(0, 0)
+    for morpheme in caption.morphemes:
+        char_span = CharSpan(char_span.end, char_span.end + len(morpheme.text))
+        tokens = {pos for pos in char_tokens[char_span.start : char_span.end] if pos is not None}
+        morpheme_tokens.append(sorted(tokens))
+    max_tokens = max((len(tokens) for tokens in morpheme_tokens), default=0)
+    index = torch.full((len(morpheme_tokens), max(max_tokens, 1)), -1, dtype=torch.long)
+    for i, tokens in enumerate(morpheme_tokens):
+        index[i, : len(tokens)] = torch.as_tensor(tokens, dtype=torch.long)
+    return index
+
+
+def project_to_morphemes(
+    token_probs: torch.Tensor,  # (..., seq)
+    morpheme_index: torch.Tensor,  # (morphemes, k)
+) -> torch.Tensor:  # (..., morphemes)
+    """Segment-max of the token probabilities over the tokens of each morpheme."""
+    padded = torch.cat([token_probs, token_probs.new_zeros(token_probs.shape[:-1] + (1,))], dim=-1)
+    index = morpheme_index.to(token_probs.device).masked_fill(morpheme_index.lt(0), padded.size(-1) - 1)
+    return padded[..., index].amax(dim=-1)
+
+
+def select_predictions(
+    pred_logits: torch.Tensor,  # (b, cand, seq)
+    pred_boxes: torch.Tensor,  # (b, cand, 4)
+    confidence_threshold: float = 0.0,
+    top_k: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Keeps the `top_k` most confident boxes of each image whose confidence is at least `confidence_threshold`.
+
+    Everything runs as batched tensor ops on the device of the predictions. Returns the confidences (b, k), token
+    probabilities (b, k, seq) and boxes (b, k, 4) sorted by decreasing confidence, and the number of kept boxes of each
+    image (b). As the boxes are sorted, the kept boxes of an image are the first ones.
+    """
+    token_probs = pred_logits.softmax(dim=-1)  # (b, cand, seq)
+    # NULL ターゲットを指す確率を反転させたものが confidence
+    probs = 1 - token_probs[..., -1]  # (b, cand)
+    k = probs.size(1) if top_k <= 0 else min(top_k, probs.size(1))
+    probs, indices = probs.topk(k, dim=-1)  # (b, k)
+    token_probs = token_probs.gather(1, indices.unsqueeze(-1).expand(-1, -1, token_probs.size(-1)))
+    boxes = pred_boxes.gather(1, indices.unsqueeze(-1).expand(-1, -1, pred_boxes.size(-1)))
+    num_kept = probs.ge(confidence_threshold).sum(dim=-1)
+    return probs, token_probs, boxes, num_kept
+
+
 # for output bounding box post-processing
 def box_cxcywh_to_xyxy(
     x: torch.Tensor,  # (N, 4)
@@ -107,97 +329,247 @@ def plot_results(
     plt.show()
 
 
-def predict_mdetr(
-    checkpoint_path: Path, images: list, image_ids: List[str], caption: Document, backbone_name: str, text_encoder: str, batch_size: int = 32
-) -> List[MDETRPrediction]:
-    if len(images) == 0:
-        return []
-    model = _make_detr(backbone_name=backbone_name, text_encoder=text_encoder)
-    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
-    checkpoint = torch.load(str(checkpoint_path), map_location=device)
+def image_content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ImageDataset(torch.utils.data.Dataset):
+    """Opens and transforms input images lazily so that only the batches in flight are held in memory.
+
+    Each item also carries a hash of the image file content, used as key of the ImageFeatureCache.
+    """
+
+    def __init__(self, image_files: List[Path], image_ids: List[str], transform):
+        assert len(image_files) == len(image_ids)
+        self.image_files = image_files
+        self.image_ids = image_ids
+        self.transform = transform
+
+    def __len__(self) -> int:
+        return len(self.image_files)
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, Tuple[int, int], str, str]:
+        data = Path(self.image_files[idx]).read_bytes()
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        return self.transform(image), image.size, self.image_ids[idx], image_content_hash(data)
+
+
+def collate_images(batch) -> Tuple[NestedTensor, List[Tuple[int, int]], List[str], List[str]]:
+    image_tensors, image_sizes, image_ids, image_keys = zip(*batch)
+    # images of different sizes are zero-padded to the largest one in the batch, padding is masked out
+    return NestedTensor.from_tensor_list(list(image_tensors)), list(image_sizes), list(image_ids), list(image_keys)
+
+
+def load_mdetr(
+    checkpoint_path: Path,
+    backbone_name: Optional[str],
+    text_encoder: Optional[str],
+    device: torch.device,
+    quantize: bool = False,
+) -> torch.nn.Module:
+    # inference checkpoints are memory-mapped and carry the model config in their header, backbone_name and
+    # text_encoder only override it when they are given
+    checkpoint = load_checkpoint(checkpoint_path, map_location=device)
+    detr_config = resolve_detr_config(checkpoint, backbone_name=backbone_name, text_encoder=text_encoder)
+    model = _make_detr(**detr_config)
     model.load_state_dict(checkpoint['model'])
+    if quantize:
+        # dynamically quantized modules only run on CPU
+        assert device.type == 'cpu', 'quantized inference is only supported on CPU'
+        model = quantize_dynamic(model)
     model = model.to(device)
     model.eval()
+    return model
+
+
+def get_device(quantize: bool = False) -> torch.device:
+    if quantize or not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device('cuda:0')
 
-    assert caption.is_jumanpp_required() is False
 
+def build_transform():
     # standard PyTorch mean-std input image normalization
-    transform = tt.Compose([tt.Resize(800), tt.ToTensor(), tt.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+    return tt.Compose([tt.Resize(800), tt.ToTensor(), tt.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+
+
+@torch.no_grad()
+def predict_batch(
+    model: torch.nn.Module,
+    samples: NestedTensor,
+    image_sizes: List[Tuple[int, int]],
+    image_ids: List[str],
+    captions: List[Document],
+    text_encoder: str,
+    text_cache: TextMemoryCache,
+    confidence_threshold: float = 0.0,
+    top_k: int = 0,
+    image_keys: Optional[List[Hashable]] = None,
+    image_cache: Optional[ImageFeatureCache] = None,
+    image_index: Optional[List[int]] = None,
+    image_features: Optional[NestedTensor] = None,
+) -> List[MDETRPrediction]:
+    """Grounds captions[j] on the image_index[j]-th image of the batch (the j-th image if image_index is None).
+
+    Several captions can be paired with the same image, in which case the backbone still runs once for this image.
+    Only the `top_k` most confident boxes (all if top_k <= 0) with a confidence of at least `confidence_threshold`
+    are returned for each caption, sorted by decreasing confidence. The backbone output of the images can be given as
+    `image_features`; otherwise, if an `image_cache` is given, the backbone features of the images are looked up by
+    `image_keys` and only computed for the images that are not cached yet.
+    """
+    b = len(captions)
+    assert len(image_sizes) == len(image_ids)
+    if image_index is None:
+        assert len(image_ids) == b
+        image_index = list(range(b))
+    assert len(image_index) == b
+    assert all(caption.is_jumanpp_required() is False for caption in captions)
+    # each distinct caption is encoded once
+    text_attention_mask, text_memory_resized, tokenizations = text_cache.get(
+        model, text_encoder, [caption.text for caption in captions]
+    )
+    text = (text_attention_mask, text_memory_resized, None)
+    if image_features is None and image_cache is not None:
+        assert image_keys is not None and len(image_keys) == len(image_ids)
+        image_features = image_cache.get(model, samples, image_keys)
+    index = None
+    if image_index != list(range(len(image_ids))):
+        index = torch.as_tensor(image_index, device=text_memory_resized.device)
+    # propagate through the model
+    memory_cache = model(samples, text, encode_and_save=True, image_features=image_features, image_index=index)
+    # dict keys: 'pred_logits', 'pred_boxes'
+    # pred_logits: (b, cand, seq)
+    # pred_boxes: (b, cand, 4)
+    # the heads only run on the last decoder layer and the contrastive align projections are not needed
+    outputs: dict = model(
+        samples, text, encode_and_save=False, memory_cache=memory_cache, inference=True, return_projections=False
+    )
+
+    # filter the boxes on the device, only the kept ones are copied to CPU and converted
+    probs, token_probs, boxes, num_kept = select_predictions(
+        outputs['pred_logits'], outputs['pred_boxes'], confidence_threshold, top_k
+    )  # (b, k), (b, k, seq), (b, k, 4), (b)
+    num_kept: List[int] = num_kept.tolist()
+    max_kept = max(num_kept)
+    probs, token_probs, boxes = probs[:, :max_kept], token_probs[:, :max_kept], boxes[:, :max_kept]
+
+    # 単語を構成するサブワードが持つ確率の最大値
+    morpheme_indices = [
+        text_cache.get_morpheme_index(text_encoder, caption, tokenized)
+        for caption, tokenized in zip(captions, tokenizations)
+    ]
+    if all(morpheme_index is morpheme_indices[0] for morpheme_index in morpheme_indices):
+        word_probs = list(project_to_morphemes(token_probs, morpheme_indices[0]).cpu())  # [(kept, word)]
+    else:
+        word_probs = [
+            project_to_morphemes(token_probs[i, :n], morpheme_index).cpu()
+            for i, (n, morpheme_index) in enumerate(zip(num_kept, morpheme_indices))
+        ]
+    probs, boxes = probs.cpu(), boxes.cpu()
 
     predictions: List[MDETRPrediction] = []
-    image_size = images[0].size
-    assert all(im.size == image_size for im in images)
-    # mean-std normalize the input image
-    image_tensors: List[torch.Tensor] = [transform(im) for im in images]  # [(ch, H, W)]
-    for batch_idx in range(math.ceil(len(images) / batch_size)):
-        img = torch.stack(image_tensors[batch_idx * batch_size : (batch_idx + 1) * batch_size], dim=0)  # (b, ch, H, W)
-        img = img.to(device)
-        img_ids = image_ids[batch_idx * batch_size : (batch_idx + 1) * batch_size]
-
-        # propagate through the model
-        memory_cache = model(img, [caption.text] * img.size(0), encode_and_save=True)
-        # dict keys: 'pred_logits', 'pred_boxes', 'proj_queries', 'proj_tokens', 'tokenized'
-        # pred_logits: (b, cand, seq)
-        # pred_boxes: (b, cand, 4)
-        # proj_queries: (b, cand, 64)
-        # proj_tokens: (b, 28, 64)
-        # tokenized: BatchEncoding
-        with torch.no_grad():
-            outputs: dict = model(img, [caption.text] * img.size(0), encode_and_save=False, memory_cache=memory_cache)
-        pred_logits: torch.Tensor = outputs['pred_logits'].cpu()  # (b, cand, seq)
-        pred_boxes: torch.Tensor = outputs['pred_boxes'].cpu()  # (b, cand, 4)
-        tokenized: BatchEncoding = memory_cache['tokenized']
-
-        assert len(pred_logits) == len(pred_boxes) == len(img_ids)
-        for pred_logit, pred_box, image_id in zip(pred_logits, pred_boxes, img_ids):  # (cand, seq), (cand, 4)
-            # NULL ターゲットを指す確率を反転させたものが confidence
-            probs: torch.Tensor = 1 - pred_logit.softmax(dim=-1)[:, -1]  # (cand)
-            # keep only predictions with 0.0+ confidence
-            keep: torch.Tensor = probs.ge(0.0)  # (cand)
-
-            # convert boxes from [0; 1] to image scales
-            bboxes_scaled = rescale_bboxes(pred_box[keep], image_size)  # (kept, 4)
-
-            bounding_boxes = []
-            for prob, bbox, token_probs in zip(
-                probs[keep].tolist(), bboxes_scaled.tolist(), pred_logit[keep].softmax(dim=-1)
-            ):
-                char_probs: List[float] = [0] * len(caption.text)
-                for pos, token_prob in enumerate(token_probs.tolist()):
-                    try:
-                        span: CharSpan = tokenized.token_to_chars(0, pos)
-                    except TypeError:
-                        continue
-                    char_probs[span.start : span.end] = [token_prob] * (span.end - span.start)
-                word_probs: List[float] = []  # 単語を構成するサブワードが持つ確率の最大値
-                char_span = CharSpan(0, 0)
-                for morpheme in caption.morphemes:
-                    char_span = CharSpan(char_span.end, char_span.end + len(morpheme.text))
-                    word_probs.append(np.max(char_probs[char_span.start : char_span.end]).item())
-
-                bounding_boxes.append(
-                    BoundingBox(
-                        image_id=image_id,
-                        rect=Rectangle.from_xyxy(*bbox),
-                        class_name="",
-                        confidence=prob,
-                        word_probs=word_probs,
-                    )
-                )
-            predictions.append(
-                MDETRPrediction(
-                    doc_id=caption.doc_id,
-                    image_id=image_id,
-                    bounding_boxes=bounding_boxes,
-                    words=[m.text for m in caption.morphemes],
-                )
+    for i, (n, caption) in enumerate(zip(num_kept, captions)):
+        image_id = image_ids[image_index[i]]
+        # convert boxes from [0; 1] to the scale of each image
+        bboxes_scaled = rescale_bboxes(boxes[i, :n], image_sizes[image_index[i]])  # (kept, 4)
+        bounding_boxes = [
+            BoundingBox(
+                image_id=image_id,
+                rect=Rectangle.from_xyxy(*bbox),
+                class_name="",
+                confidence=prob,
+                word_probs=box_word_probs,
             )
+            for prob, bbox, box_word_probs in zip(
+                probs[i, :n].tolist(), bboxes_scaled.tolist(), word_probs[i][:n].tolist()
+            )
+        ]
+        predictions.append(
+            MDETRPrediction(
+                doc_id=caption.doc_id,
+                image_id=image_id,
+                bounding_boxes=bounding_boxes,
+                words=[m.text for m in caption.morphemes],
+            )
+        )
     return predictions
 
 
+def predict_mdetr(
+    checkpoint_path: Path,
+    image_files: List[Path],
+    image_ids: List[str],
+    captions: Union[Document, List[Document]],
+    backbone_name: Optional[str],
+    text_encoder: Optional[str],
+    batch_size: int = 32,
+    text_cache: Optional[TextMemoryCache] = None,
+    num_workers: int = 4,
+    prefetch_batches: int = 2,
+    quantize: bool = False,
+    confidence_threshold: float = 0.0,
+    top_k: int = 0,
+    image_cache: Optional[ImageFeatureCache] = None,
+    captions_per_batch: int = 4,
+) -> Iterator[MDETRPrediction]:
+    """Grounds each caption on each image, yielding predictions as soon as each batch is processed.
+
+    The backbone runs once per image. Its output is then paired with up to `captions_per_batch` captions at a time,
+    so that each forward of the cross-modal encoder and the decoder covers batch_size * captions_per_batch pairs.
+
+    Images are loaded and transformed by `num_workers` DataLoader workers, each of which keeps at most
+    `prefetch_batches` batches ready in advance. If `quantize` is set, the model runs on CPU with dynamically
+    quantized int8 linear layers. Passing the same `image_cache` to successive calls avoids running the backbone again
+    on images that were already grounded with another caption.
+    """
+    if len(image_files) == 0:
+        return
+    device = get_device(quantize)
+    model = load_mdetr(checkpoint_path, backbone_name, text_encoder, device, quantize=quantize)
+    # the text encoder actually loaded, which keys the text cache
+    text_encoder = model.transformer.tokenizer.name_or_path
+    if text_cache is None:
+        text_cache = TextMemoryCache()
+
+    loader_kwargs = dict(num_workers=num_workers, prefetch_factor=prefetch_batches) if num_workers > 0 else {}
+    data_loader = DataLoader(
+        ImageDataset(image_files, image_ids, build_transform()),
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=collate_images,
+        pin_memory=device.type == 'cuda',
+        **loader_kwargs,
+    )
+    if isinstance(captions, Document):
+        captions = [captions]
+    for samples, image_sizes, img_ids, image_keys in data_loader:
+        samples = samples.to(device)  # (b, ch, H, W)
+        if image_cache is not None:
+            image_features = image_cache.get(model, samples, image_keys)
+        else:
+            image_features = model.encode_image(samples)
+        for start in range(0, len(captions), captions_per_batch):
+            chunk = captions[start : start + captions_per_batch]
+            yield from predict_batch(
+                model,
+                samples,
+                image_sizes,
+                img_ids,
+                [caption for _ in img_ids for caption in chunk],
+                text_encoder,
+                text_cache,
+                confidence_threshold=confidence_threshold,
+                top_k=top_k,
+                image_index=[i for i in range(len(img_ids)) for _ in chunk],
+                image_features=image_features,
+            )
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--model', '-m', type=str, help='Path to trained model.')
+    parser.add_argument(
+        '--model', '-m', type=str, help='Path to trained model (training checkpoint or exported *.safetensors).'
+    )
     # parser.add_argument('--image-dir', '--img', type=str, help='Path to the directory containing images.')
     parser.add_argument('--image-files', '--img', type=str, nargs='*', help='Path to images files.')
     parser.add_argument(
@@ -205,10 +577,51 @@ def main():
     )
     parser.add_argument('--caption-file', type=str, help='Path to Juman++ file for caption.')
     parser.add_argument(
-        '--backbone-name', type=str, default='timm_tf_efficientnet_b3_ns', help='backbone image encoder name'
+        '--captions-file',
+        type=str,
+        help='Path to a file with one raw caption per line, optionally prefixed by its id and a tab. Each caption is '
+        'grounded on every image and the results are exported to <export-dir>/<caption id>/.',
+    )
+    parser.add_argument('--parse-cache-dir', type=str, help='Directory where Juman++ analyses are cached.')
+    parser.add_argument(
+        '--backbone-name',
+        type=str,
+        default=None,
+        help='backbone image encoder name. Defaults to the one of the checkpoint config.',
+    )
+    parser.add_argument(
+        '--text-encoder',
+        type=str,
+        default=None,
+        help='text encoder name. Defaults to the one of the checkpoint config.',
     )
-    parser.add_argument('--text-encoder', type=str, default='xlm-roberta-base', help='text encoder name')
     parser.add_argument('--batch-size', '--bs', type=int, default=32, help='Batch size.')
+    parser.add_argument(
+        '--captions-per-batch',
+        type=int,
+        default=4,
+        help='Number of captions grounded together on each image batch, sharing its backbone output.',
+    )
+    parser.add_argument('--num-workers', type=int, default=4, help='Number of image loading workers.')
+    parser.add_argument(
+        '--prefetch-batches', type=int, default=2, help='Number of batches each image loading worker prepares ahead.'
+    )
+    parser.add_argument(
+        '--text-cache-mb', type=int, default=256, help='Memory budget in MB for caching encoded captions.'
+    )
+    parser.add_argument(
+        '--image-cache-mb',
+        type=int,
+        default=0,
+        help='Memory budget in MB for caching backbone features of identical image files (0 to disable).',
+    )
+    parser.add_argument('--quantize', action='store_true', help='Run on CPU with dynamic int8 quantization.')
+    parser.add_argument(
+        '--confidence-threshold', type=float, default=0.0, help='Only export boxes with at least this confidence.'
+    )
+    parser.add_argument(
+        '--top-k', type=int, default=0, help='Only export the k most confident boxes per image (0 for all).'
+    )
     parser.add_argument('--export-dir', type=str, help='Path to directory to export results.')
     parser.add_argument('--plot', action='store_true', help='Plot results.')
     args = parser.parse_args()
@@ -221,24 +634,52 @@ def main():
     # image = Image.open(web_image)
 
     image_files = [Path(image_file) for image_file in args.image_files]
-    images: list = [Image.open(image_file) for image_file in image_files]
     image_ids = [image_file.stem for image_file in image_files]
     assert len(image_ids) == len(set(image_ids)), f'Image ids must be unique: {image_ids}'
 
     if args.caption_file is not None:
-        caption = Document.from_jumanpp(Path(args.caption_file).read_text())
+        captions = [Document.from_jumanpp(Path(args.caption_file).read_text())]
     else:
-        caption = Jumanpp().apply_to_document(args.text)
+        # a single Juman++ process analyzes all the captions
+        analyzer = CaptionAnalyzer(args.parse_cache_dir)
+        if args.captions_file is not None:
+            doc_ids, texts = read_captions(Path(args.captions_file))
+            captions = analyzer.analyze_batch(texts)
+            for caption, doc_id in zip(captions, doc_ids):
+                caption.doc_id = doc_id
+            assert len(doc_ids) == len(set(doc_ids)), 'Caption ids must be unique'
+        else:
+            captions = [analyzer.analyze(args.text)]
+    # with several captions, the results of each caption are exported to their own directory
+    caption_dirs = {caption.doc_id: export_dir for caption in captions}
+    if args.captions_file is not None:
+        caption_dirs = {caption.doc_id: export_dir / caption.doc_id for caption in captions}
+        for caption_dir in caption_dirs.values():
+            caption_dir.mkdir(exist_ok=True)
 
     predictions = predict_mdetr(
-        args.model, images, image_ids, caption, args.backbone_name, args.text_encoder, args.batch_size
+        args.model,
+        image_files,
+        image_ids,
+        captions,
+        args.backbone_name,
+        args.text_encoder,
+        args.batch_size,
+        text_cache=TextMemoryCache(args.text_cache_mb * 1024**2),
+        num_workers=args.num_workers,
+        prefetch_batches=args.prefetch_batches,
+        quantize=args.quantize,
+        confidence_threshold=args.confidence_threshold,
+        top_k=args.top_k,
+        image_cache=ImageFeatureCache(args.image_cache_mb * 1024**2) if args.image_cache_mb > 0 else None,
+        captions_per_batch=args.captions_per_batch,
     )
-    if args.plot:
-        for prediction in predictions:
-            plot_results(images[image_ids.index(prediction.image_id)], prediction.image_id, prediction, export_dir)
-
     for prediction in predictions:
-        export_dir.joinpath(f'{prediction.image_id}.json').write_text(prediction.to_json(indent=2, ensure_ascii=False))
+        caption_dir = caption_dirs[prediction.doc_id]
+        caption_dir.joinpath(f'{prediction.image_id}.json').write_text(prediction.to_json(indent=2, ensure_ascii=False))
+        if args.plot:
+            image = Image.open(image_files[image_ids.index(prediction.image_id)])
+            plot_results(image, prediction.image_id, prediction, caption_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""Micro-benchmark of the Hungarian matching of all the decoder layers of a training step, comparing the dense cost
+matrix over the whole batch with the per-image blocks of HungarianMatcher, solved sequentially and on a thread pool.
+tests/test_matcher.py checks that they find the same assignments.
+
+Example:
+    python scripts/benchmark_matcher.py --batch_sizes 4 8 16 32 --max_targets 20 --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from scipy.optimize import linear_sum_assignment
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from models.matcher import HungarianMatcher
+from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--num_queries", type=int, default=100)
+    parser.add_argument("--num_layers", type=int, default=6, help="Final decoder layer and aux layers")
+    parser.add_argument("--num_classes", type=int, default=256, help="Size of the token dimension of the logits")
+    parser.add_argument("--max_targets", type=int, default=20, help="Target boxes per image are drawn in [1, max]")
+    parser.add_argument("--num_workers", type=int, default=4, help="Threads of the thread pool")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser
+
+
+def random_boxes(*shape, device):
+    centers = torch.rand(*shape, 2, device=device) * 0.6 + 0.2
+    sizes = torch.rand(*shape, 2, device=device) * 0.3 + 0.05
+    return torch.cat([centers, sizes], -1)
+
+
+def make_inputs(args, bs, device):
+    outputs_list = [
+        {
+            "pred_logits": torch.randn(bs, args.num_queries, args.num_classes, device=device),
+            "pred_boxes": random_boxes(bs, args.num_queries, device=device),
+        }
+        for _ in range(args.num_layers)
+    ]
+    sizes = torch.randint(1, args.max_targets + 1, (bs,)).tolist()
+    targets = [{"boxes": random_boxes(size, device=device)} for size in sizes]
+    positive_map = torch.zeros(sum(sizes), args.num_classes, device=device)
+    for row in positive_map:
+        beg = int(torch.randint(0, 30, ()))
+        row[beg : beg + int(torch.randint(1, 4, ()))] = 1
+    positive_map = positive_map / positive_map.sum(-1, keepdim=True)
+    return outputs_list, targets, positive_map
+
+
+@torch.no_grad()
+def dense_match(matcher, outputs, targets, positive_map):
+    """The previous implementation: one dense [bs * queries, total targets] cost matrix, split per image on CPU."""
+    bs, num_queries = outputs["pred_logits"].shape[:2]
+    out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)
+    out_bbox = outputs["pred_boxes"].flatten(0, 1)
+    tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    cost_class = -(out_prob.unsqueeze(1) * positive_map.unsqueeze(0)).sum(-1)
+    cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+    cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    C = matcher.cost_bbox * cost_bbox + matcher.cost_class * cost_class + matcher.cost_giou * cost_giou
+    C = C.view(bs, num_queries, -1).cpu()
+    sizes = [len(v["boxes"]) for v in targets]
+    indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+    return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+
+
+def measure(fn, iters, warmup, device):
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        result = fn()
+    return (time.perf_counter() - start) / iters, result
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    sequential = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2)
+    threaded = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_workers=args.num_workers)
+    print(f"{'bs':>4} {'targets':>8} {'dense':>10} {'blocks':>10} {'threaded':>10} {'speedup':>8}")
+    for bs in args.batch_sizes:
+        outputs_list, targets, positive_map = make_inputs(args, bs, device)
+        runners = {
+            "dense": lambda: [dense_match(sequential, out, targets, positive_map) for out in outputs_list],
+            "blocks": lambda: sequential.match_layers(outputs_list, targets, positive_map),
+            "threaded": lambda: threaded.match_layers(outputs_list, targets, positive_map),
+        }
+        results = {name: measure(fn, args.iters, args.warmup, device) for name, fn in runners.items()}
+        dense, blocks, threaded_latency = (results[name][0] * 1000 for name in ("dense", "blocks", "threaded"))
+        print(
+            f"{bs:>4} {len(positive_map):>8} {dense:>8.2f}ms {blocks:>8.2f}ms {threaded_latency:>8.2f}ms "
+            f"{dense / threaded_latency:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
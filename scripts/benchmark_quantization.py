@@ -0,0 +1,135 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""Compare fp32 and dynamically quantized int8 MDETR on CPU: latency and Flickr30k recall@k.
+
+Example:
+    python scripts/benchmark_quantization.py --dataset_config configs/flickr_ja.json --resume checkpoint.pth \
+        --backbone timm_tf_efficientnet_b3_ns --text_encoder_type xlm-roberta-base --ema
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import main as detection
+import util.misc as utils
+from util.checkpoint import load_checkpoint
+from datasets import build_dataset
+from datasets.flickr_eval import FlickrEvaluator
+from engine import evaluate
+from models import build_model
+from models.postprocessors import build_postprocessors
+from models.quantization import quantize_dynamic
+
+
+def get_args_parser():
+    detection_parser = detection.get_args_parser()
+    parser = argparse.ArgumentParser(
+        "Benchmark dynamic int8 quantization on CPU", parents=[detection_parser], add_help=False
+    )
+    parser.add_argument("--latency_batches", type=int, default=20, help="Number of batches used to measure latency")
+    parser.add_argument("--skip_recall", action="store_true", help="Only measure latency")
+    return parser
+
+
+@torch.no_grad()
+def measure_latency(model, data_loader, num_batches: int, num_warmup: int = 2) -> float:
+    """Returns the average time in seconds of the two-phase forward per image."""
+    model.eval()
+    elapsed, num_images = 0.0, 0
+    for i, batch_dict in enumerate(data_loader):
+        if i >= num_batches + num_warmup:
+            break
+        samples = batch_dict["samples"]
+        captions = [t["caption"] for t in batch_dict["targets"]]
+        start = time.perf_counter()
+        memory_cache = model(samples, captions, encode_and_save=True)
+        model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
+        if i >= num_warmup:
+            elapsed += time.perf_counter() - start
+            num_images += len(captions)
+    return elapsed / max(num_images, 1)
+
+
+def main(args):
+    if args.dataset_config is not None:
+        d = vars(args)
+        with open(args.dataset_config, "r") as f:
+            cfg = json.load(f)
+        d.update(cfg)
+    # quantized modules only run on CPU
+    args.device = "cpu"
+    args.distributed = False
+    torch.manual_seed(args.seed)
+    print(args)
+
+    model, _, _, _, _ = build_model(args)
+    checkpoint = load_checkpoint(args.resume)
+    if args.ema and checkpoint.get("model_ema") is not None:
+        model.load_state_dict(checkpoint["model_ema"])
+    else:
+        model.load_state_dict(checkpoint["model"])
+    model.eval()
+    models = {"fp32": model, "int8": quantize_dynamic(model)}
+
+    dset = build_dataset("flickr", image_set="val", args=args)
+    dataloader = DataLoader(
+        dset,
+        args.batch_size,
+        sampler=torch.utils.data.SequentialSampler(dset),
+        drop_last=False,
+        collate_fn=partial(utils.collate_fn, False),
+        num_workers=args.num_workers,
+    )
+
+    results = {}
+    for name, cur_model in models.items():
+        print(f"Benchmarking {name}")
+        results[name] = {"latency_per_image": measure_latency(cur_model, dataloader, args.latency_batches)}
+        if not args.skip_recall:
+            evaluator = FlickrEvaluator(
+                args.flickr_dataset_path, subset="test" if args.test else "val", merge_boxes=args.GT_type == "merged"
+            )
+            stats = evaluate(
+                model=cur_model,
+                criterion=None,
+                contrastive_criterion=None,
+                qa_criterion=None,
+                postprocessors=build_postprocessors(args, "flickr"),
+                weight_dict={},
+                data_loader=dataloader,
+                evaluator_list=[evaluator],
+                device=torch.device("cpu"),
+                args=args,
+            )
+            results[name]["flickr"] = stats["flickr"]
+
+    fp32_latency, int8_latency = results["fp32"]["latency_per_image"], results["int8"]["latency_per_image"]
+    print(
+        f"latency per image: fp32 {fp32_latency * 1000:.1f} ms, int8 {int8_latency * 1000:.1f} ms "
+        f"(speedup x{fp32_latency / int8_latency:.2f})"
+    )
+    if not args.skip_recall:
+        results["recall_delta"] = {
+            k: results["int8"]["flickr"][k] - v for k, v in results["fp32"]["flickr"].items() if k.endswith("_all")
+        }
+        for k, v in results["recall_delta"].items():
+            print(f"{k}: fp32 {results['fp32']['flickr'][k]:.4f}, int8 {results['int8']['flickr'][k]:.4f} ({v:+.4f})")
+
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+        Path(args.output_dir).joinpath("quantization_benchmark.json").write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Quantization benchmark", parents=[get_args_parser()])
+    main(parser.parse_args())
@@ -21,6 +21,7 @@ sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 import main as detection
 import util.dist as dist
 import util.misc as utils
+from util.checkpoint import load_checkpoint
 from datasets import build_dataset
 from datasets.clevr import ALL_ATTRIBUTES
 from engine import evaluate
@@ -63,10 +64,7 @@ def main(args):
     random.seed(seed)
     torch.set_deterministic(True)
 
-    if args.resume.startswith("https"):
-        checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-    else:
-        checkpoint = torch.load(args.resume, map_location="cpu")
+    checkpoint = load_checkpoint(args.resume)
 
     model_args = checkpoint["args"]
     model_args.device = args.device
@@ -21,6 +21,7 @@ sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 import main as detection
 import util.dist as dist
 import util.misc as utils
+from util.checkpoint import load_checkpoint
 from datasets import build_dataset, get_coco_api_from_dataset
 from engine import evaluate
 from models import build_model
@@ -95,10 +96,7 @@ def main(args):
 
     if args.load:
         print("loading from", args.load)
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        checkpoint = load_checkpoint(args.resume)
         if "model_ema" in checkpoint:
             model_without_ddp.load_state_dict(checkpoint["model_ema"], strict=False)
         else:
@@ -107,10 +105,7 @@ def main(args):
 
     output_dir = Path(args.output_dir)
     if args.resume:
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        checkpoint = load_checkpoint(args.resume)
         model_without_ddp.load_state_dict(checkpoint["model"])
         if args.ema:
             if "model_ema" not in checkpoint:
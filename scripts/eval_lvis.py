@@ -21,6 +21,7 @@ sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 import main as detection
 import util.dist as dist
 import util.misc as utils
+from util.checkpoint import load_checkpoint
 from datasets import build_dataset
 from datasets.lvis_eval import LvisDumper, LvisEvaluatorFixedAP
 from models import build_model
@@ -54,10 +55,7 @@ def main(args):
     np.random.seed(seed)
     random.seed(seed)
 
-    if args.resume.startswith("https"):
-        checkpoint = torch.hub.load_state_dict_from_url(args.resume, map_location="cpu", check_hash=True)
-    else:
-        checkpoint = torch.load(args.resume, map_location="cpu")
+    checkpoint = load_checkpoint(args.resume)
 
     model_args = checkpoint["args"]
     for a in vars(args):
@@ -0,0 +1,47 @@
+"""Export the weights of a training checkpoint as a memory-mappable inference checkpoint.
+
+Example:
+    python scripts/export_inference_checkpoint.py checkpoint.pth model.safetensors --dtype float16
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from util.checkpoint import INFERENCE_CHECKPOINT_SUFFIX, export_inference_checkpoint, load_checkpoint
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", type=str, help="Path or url to the training checkpoint.")
+    parser.add_argument("output", type=str, help=f"Path to the output file (*{INFERENCE_CHECKPOINT_SUFFIX}).")
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default="ema",
+        choices=("ema", "model"),
+        help="Which weights to export. Falls back to the raw weights when the checkpoint has no EMA weights.",
+    )
+    parser.add_argument("--dtype", type=str, default=None, choices=DTYPES.keys(), help="Cast the weights to dtype.")
+    args = parser.parse_args()
+
+    assert args.output.endswith(INFERENCE_CHECKPOINT_SUFFIX), f"output must end with {INFERENCE_CHECKPOINT_SUFFIX}"
+    checkpoint = load_checkpoint(args.checkpoint)
+    export_inference_checkpoint(
+        checkpoint,
+        args.output,
+        use_ema=args.weights == "ema",
+        dtype=DTYPES[args.dtype] if args.dtype is not None else None,
+    )
+    print(f"exported to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Export MDETR as two tensor-only graphs (encoder, decoder + heads) to TorchScript and/or ONNX, and optionally
+benchmark them against the eager model on CPU.
+
+Example:
+    python scripts/export_split_graphs.py checkpoint.pth exported/ --format onnx --benchmark \
+        --backbone timm_tf_efficientnet_b3_ns --text_encoder_type xlm-roberta-base
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+import torch
+from PIL import Image
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import datasets.transforms as T
+from hubconf import _make_detr
+from models.export import (
+    DECODER_INPUTS,
+    ENCODER_INPUTS,
+    decoder_output_names,
+    export_onnx,
+    export_torchscript,
+    prepare_inputs,
+)
+from util.checkpoint import load_checkpoint, resolve_detr_config
+from util.misc import NestedTensor
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", type=str, help="Path or url to the checkpoint.")
+    parser.add_argument("output_dir", type=str, help="Directory where the graphs are written.")
+    parser.add_argument(
+        "--backbone",
+        type=str,
+        default=None,
+        help="Defaults to the backbone of the checkpoint config, or timm_tf_efficientnet_b3_ns",
+    )
+    parser.add_argument(
+        "--text_encoder_type",
+        type=str,
+        default=None,
+        help="Defaults to the text encoder of the checkpoint config, or xlm-roberta-base",
+    )
+    parser.add_argument("--format", type=str, default="onnx", choices=("onnx", "torchscript", "both"))
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs=2,
+        default=(800, 1333),
+        metavar=("H", "W"),
+        help="Fixed image canvas of the exported encoder. Smaller images are padded and masked.",
+    )
+    parser.add_argument("--opset_version", type=int, default=12)
+    parser.add_argument("--images", type=str, nargs="*", default=[], help="Images used for tracing and benchmarking")
+    parser.add_argument("--caption", type=str, default="テーブルの上にあるカップ", help="Caption paired with each image")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size when no image is given")
+    parser.add_argument("--benchmark", action="store_true", help="Compare latency and outputs with the eager model")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads of both runtimes")
+    return parser
+
+
+def load_images(args):
+    if len(args.images) == 0:
+        # random images covering the whole canvas
+        return [torch.randn((3,) + tuple(args.image_size)) for _ in range(args.batch_size)]
+    transform = T.Compose(
+        [T.RandomResize([800], max_size=1333), T.ToTensor(), T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])]
+    )
+    return [transform(Image.open(image_file).convert("RGB"), None)[0] for image_file in args.images]
+
+
+def measure(fn: Callable[[], Dict[str, np.ndarray]], iters: int, warmup: int):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        outputs = fn()
+    return (time.perf_counter() - start) / iters, outputs
+
+
+def benchmark(model, inputs: Dict[str, torch.Tensor], paths: Dict[str, tuple], args):
+    captions = [args.caption] * len(inputs["images"])
+    output_names = decoder_output_names(model)
+
+    @torch.no_grad()
+    def run_eager():
+        # tokenization is part of the eager forward, as in run_mdetr
+        samples = NestedTensor(inputs["images"], inputs["image_mask"])
+        memory_cache = model(samples, captions, encode_and_save=True)
+        outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
+        return {name: outputs[name].numpy() for name in output_names}
+
+    runners = {"eager": run_eager}
+    if "torchscript" in paths:
+        encoder, decoder = (torch.jit.load(str(path)) for path in paths["torchscript"])
+
+        @torch.no_grad()
+        def run_torchscript():
+            outputs = decoder(*encoder(*(inputs[name] for name in ENCODER_INPUTS)))
+            return {name: output.numpy() for name, output in zip(output_names, outputs)}
+
+        runners["torchscript"] = run_torchscript
+    if "onnx" in paths:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if args.num_threads is not None:
+            options.intra_op_num_threads = args.num_threads
+        encoder, decoder = (
+            onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+            for path in paths["onnx"]
+        )
+        ort_inputs = {name: inputs[name].numpy() for name in ENCODER_INPUTS}
+
+        def run_onnx():
+            memory = encoder.run(None, ort_inputs)
+            outputs = decoder.run(None, dict(zip(DECODER_INPUTS, memory)))
+            return dict(zip(output_names, outputs))
+
+        runners["onnx"] = run_onnx
+
+    results = {name: measure(fn, args.iters, args.warmup) for name, fn in runners.items()}
+    eager_latency, eager_outputs = results["eager"]
+    for name, (latency, outputs) in results.items():
+        line = f"{name:>12}: {latency * 1000:8.1f} ms/batch (x{eager_latency / latency:.2f})"
+        if name != "eager":
+            diff = max(float(np.abs(outputs[k] - eager_outputs[k]).max()) for k in output_names)
+            line += f", max abs diff {diff:.2e}"
+        print(line)
+
+
+def main(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    checkpoint = load_checkpoint(args.checkpoint)
+    detr_config = resolve_detr_config(checkpoint, backbone_name=args.backbone, text_encoder=args.text_encoder_type)
+    model = _make_detr(**detr_config)
+    model.load_state_dict(checkpoint["model"])
+    model.eval()
+
+    images = load_images(args)
+    inputs = prepare_inputs(model, images, [args.caption] * len(images), tuple(args.image_size))
+    paths = {}
+    if args.format in ("torchscript", "both"):
+        paths["torchscript"] = export_torchscript(model, inputs, args.output_dir)
+    if args.format in ("onnx", "both"):
+        paths["onnx"] = export_onnx(model, inputs, args.output_dir, opset_version=args.opset_version)
+    for path in sum(paths.values(), ()):
+        print(f"exported {path}")
+
+    if args.benchmark:
+        benchmark(model, inputs, paths, args)
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
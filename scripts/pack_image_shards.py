@@ -0,0 +1,37 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""Packs the images of one or more image folders into large shard files with an offset index (see
+datasets/image_shards.py). Train with --image_shards pointing to the output directory.
+
+The images are indexed by their absolute path, so give the image folders as they are found from the machines that
+train, e.g. the coco_path/train2014 and vg_img_path folders of the dataset config.
+
+Example:
+    python scripts/pack_image_shards.py --out_path shards/coco_vg /data/coco/train2014 /data/vg/images
+"""
+import argparse
+import os
+import sys
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from datasets.image_shards import list_images, write_image_shards
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_dirs", type=str, nargs="+", help="Image folders, searched recursively")
+    parser.add_argument("--out_path", type=str, required=True, help="Directory of the shard set")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Approximate size of each shard")
+    return parser
+
+
+def main(args):
+    paths = list_images(args.image_dirs)
+    num_shards = write_image_shards(paths, args.out_path, shard_size=args.shard_size_mb << 20)
+    print(f"packed {len(paths)} images into {num_shards} shards in {args.out_path}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
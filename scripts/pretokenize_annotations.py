@@ -0,0 +1,42 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""Tokenizes the captions of modulated detection annotation files offline, and writes their token stores (see
+datasets/token_store.py). Train with --token_store_path pointing to the same output directory and the same
+--text_encoder_type.
+
+Example:
+    python scripts/pretokenize_annotations.py --text_encoder_type roberta-base --out_path token_stores \
+        mdetr_annotations/final_mixed_train.json mdetr_annotations/final_flickr_separateGT_val.json
+"""
+import argparse
+import os
+import sys
+
+from pycocotools.coco import COCO
+from transformers import AutoTokenizer
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from datasets.token_store import write_token_store
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("ann_files", type=str, nargs="+", help="Annotation files in the coco format of MDETR")
+    parser.add_argument("--text_encoder_type", type=str, default="roberta-base")
+    parser.add_argument("--out_path", type=str, required=True, help="Root of the token stores")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Number of captions tokenized at once")
+    return parser
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.text_encoder_type)
+    for ann_file in args.ann_files:
+        coco = COCO(ann_file)
+        store_dir = write_token_store(coco, ann_file, tokenizer, args.out_path, batch_size=args.batch_size)
+        print(f"wrote the tokens of {len(coco.imgs)} images to {store_dir}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
@@ -0,0 +1,310 @@
+"""Long-lived local MDETR grounding server.
+
+The model is loaded once at startup. Clients POST JSON requests of the form
+    {"image_file": "path/to/image.jpg", "text": "caption", "image_id": "optional id"}
+(or {"caption": "<Juman++ output>", ...} instead of "text") to /ground, and receive the MDETRPrediction JSON.
+Concurrent requests are coalesced into micro-batches that are run as soon as either `--max-batch-size` requests are
+queued or the oldest request has waited `--max-latency-ms`.
+
+Example:
+    python serve_mdetr.py -m checkpoint.pth --port 8080
+    curl -X POST localhost:8080/ground -d '{"image_file": "dog.jpg", "text": "犬が走っている"}'
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+from PIL import Image
+from rhoknp import Document, Jumanpp
+
+from run_mdetr import (
+    ImageFeatureCache,
+    MDETRPrediction,
+    TextMemoryCache,
+    build_transform,
+    get_device,
+    image_content_hash,
+    load_mdetr,
+    predict_batch,
+)
+from util.misc import NestedTensor
+
+
+@dataclass
+class GroundingRequest:
+    image_file: Path
+    image_id: str
+    caption: Document
+    future: Future = field(default_factory=Future)
+    arrival_time: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+    """Runs the model on a background thread, coalescing queued requests into micro-batches.
+
+    Args:
+        model: MDETR model in eval mode.
+        text_encoder: name of the text encoder of the model, used as cache key.
+        device: device the model lives on.
+        max_batch_size: maximum number of requests run together.
+        max_latency: maximum time in seconds the first request of a batch waits for other requests to arrive.
+        text_cache: cache of encoded captions.
+        image_cache: cache of backbone features, so that images grounded again with another caption skip the backbone.
+            Disabled if None.
+        confidence_threshold: only boxes with at least this confidence are returned.
+        top_k: only the k most confident boxes are returned (all if k <= 0).
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        text_encoder: str,
+        device: torch.device,
+        max_batch_size: int = 16,
+        max_latency: float = 0.01,
+        text_cache: Optional[TextMemoryCache] = None,
+        image_cache: Optional[ImageFeatureCache] = None,
+        confidence_threshold: float = 0.0,
+        top_k: int = 0,
+    ):
+        self.model = model
+        self.text_encoder = text_encoder
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.text_cache = text_cache if text_cache is not None else TextMemoryCache()
+        self.image_cache = image_cache
+        self.confidence_threshold = confidence_threshold
+        self.top_k = top_k
+        self.transform = build_transform()
+        self._queue: "queue.Queue[Optional[GroundingRequest]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request: GroundingRequest) -> Future:
+        self._queue.put(request)
+        return request.future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self) -> Optional[List[GroundingRequest]]:
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # process what is already queued, then stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _run_batch(self, batch: List[GroundingRequest]) -> None:
+        image_tensors, image_sizes, image_keys, requests = [], [], [], []
+        for request in batch:
+            try:
+                data = request.image_file.read_bytes()
+                image = Image.open(io.BytesIO(data)).convert('RGB')
+            except OSError as e:
+                request.future.set_exception(e)
+                continue
+            image_tensors.append(self.transform(image))
+            image_sizes.append(image.size)
+            image_keys.append(image_content_hash(data))
+            requests.append(request)
+        if len(requests) == 0:
+            return
+        samples = NestedTensor.from_tensor_list(image_tensors).to(self.device)
+        predictions = predict_batch(
+            self.model,
+            samples,
+            image_sizes,
+            [request.image_id for request in requests],
+            [request.caption for request in requests],
+            self.text_encoder,
+            self.text_cache,
+            confidence_threshold=self.confidence_threshold,
+            top_k=self.top_k,
+            image_keys=image_keys,
+            image_cache=self.image_cache,
+        )
+        for request, prediction in zip(requests, predictions):
+            request.future.set_result(prediction)
+
+
+class GroundingRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'MDETRServer/0.1'
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/ground':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            request = self.server.build_request(payload)
+        except (ValueError, KeyError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, explain=str(e))
+            return
+        try:
+            future = self.server.batcher.submit(request)
+            prediction: MDETRPrediction = future.result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, explain=repr(e))
+            return
+        body = prediction.to_json(ensure_ascii=False).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is an empty string for unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class _ServerMixin:
+    daemon_threads = True
+
+    def setup_grounding(self, batcher: MicroBatcher, jumanpp: Optional[Jumanpp], timeout: float):
+        self.batcher = batcher
+        self.jumanpp = jumanpp
+        # handler threads share the Juman++ instance, which is not thread-safe
+        self.jumanpp_lock = threading.Lock()
+        self.request_timeout = timeout
+
+    def build_request(self, payload: dict) -> GroundingRequest:
+        image_file = Path(payload['image_file'])
+        if 'caption' in payload:
+            caption = Document.from_jumanpp(payload['caption'])
+        else:
+            if self.jumanpp is None:
+                raise ValueError('raw text requests are not supported, send Juman++ output as "caption"')
+            with self.jumanpp_lock:
+                caption = self.jumanpp.apply_to_document(payload['text'])
+        if 'doc_id' in payload:
+            caption.doc_id = payload['doc_id']
+        image_id = payload.get('image_id', image_file.stem)
+        return GroundingRequest(image_file=image_file, image_id=image_id, caption=caption)
+
+
+class GroundingHTTPServer(_ServerMixin, ThreadingHTTPServer):
+    pass
+
+
+class GroundingUnixServer(_ServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', '-m', type=str, required=True, help='Path to trained model.')
+    parser.add_argument(
+        '--backbone-name',
+        type=str,
+        default=None,
+        help='backbone image encoder name. Defaults to the one of the checkpoint config.',
+    )
+    parser.add_argument(
+        '--text-encoder',
+        type=str,
+        default=None,
+        help='text encoder name. Defaults to the one of the checkpoint config.',
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--unix-socket', type=str, help='Listen on this unix socket instead of host:port.')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='Maximum number of requests per batch.')
+    parser.add_argument(
+        '--max-latency-ms', type=float, default=10, help='Maximum time a request waits for a batch to fill up.'
+    )
+    parser.add_argument('--timeout', type=float, default=60, help='Timeout in seconds of a single request.')
+    parser.add_argument(
+        '--text-cache-mb', type=int, default=256, help='Memory budget in MB for caching encoded captions.'
+    )
+    parser.add_argument(
+        '--image-cache-mb',
+        type=int,
+        default=1024,
+        help='Memory budget in MB for caching backbone features of already seen images (0 to disable).',
+    )
+    parser.add_argument(
+        '--confidence-threshold', type=float, default=0.0, help='Only return boxes with at least this confidence.'
+    )
+    parser.add_argument(
+        '--top-k', type=int, default=0, help='Only return the k most confident boxes per image (0 for all).'
+    )
+    parser.add_argument('--quantize', action='store_true', help='Run on CPU with dynamic int8 quantization.')
+    parser.add_argument('--no-jumanpp', action='store_true', help='Only accept requests with Juman++ captions.')
+    args = parser.parse_args()
+
+    device = get_device(args.quantize)
+    model = load_mdetr(Path(args.model), args.backbone_name, args.text_encoder, device, quantize=args.quantize)
+    batcher = MicroBatcher(
+        model,
+        model.transformer.tokenizer.name_or_path,
+        device,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency_ms / 1000,
+        text_cache=TextMemoryCache(args.text_cache_mb * 1024**2),
+        image_cache=ImageFeatureCache(args.image_cache_mb * 1024**2) if args.image_cache_mb > 0 else None,
+        confidence_threshold=args.confidence_threshold,
+        top_k=args.top_k,
+    )
+    jumanpp = None if args.no_jumanpp else Jumanpp()
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = GroundingUnixServer(args.unix_socket, GroundingRequestHandler)
+        print(f'Serving on {args.unix_socket}')
+    else:
+        server = GroundingHTTPServer((args.host, args.port), GroundingRequestHandler)
+        print(f'Serving on http://{args.host}:{args.port}')
+    server.setup_grounding(batcher, jumanpp, args.timeout)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
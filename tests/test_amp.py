@@ -0,0 +1,70 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.abspath("."))
+from models.mdetr import MLP, SetCriterion  # type: ignore  # noqa: E402
+from util.amp import (  # type: ignore  # noqa: E402
+    autocast,
+    autocast_support_error,
+    build_grad_scaler,
+    load_grad_scaler_state,
+    to_float,
+)
+
+
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="bf16 autocast on CPU requires torch >= 1.10")
+def test_bf16_autocast_cpu() -> None:
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    assert autocast_support_error(device.type, "bf16") is None
+    bbox_embed = MLP(16, 16, 4, 3)
+    criterion = SetCriterion(num_classes=255, matcher=None, eos_coef=0.1, losses=["boxes"], temperature=0.07)
+    scaler = build_grad_scaler(device, "bf16")
+    assert not scaler.is_enabled()
+
+    targets = [{"boxes": torch.tensor([[0.5, 0.5, 0.2, 0.3], [0.3, 0.6, 0.1, 0.2]])}]
+    indices = [(torch.as_tensor([1, 4]), torch.as_tensor([0, 1]))]
+    with autocast(device, "bf16"):
+        outputs = {"pred_boxes": bbox_embed(torch.randn(1, 5, 16)).sigmoid()}
+        assert outputs["pred_boxes"].dtype == torch.bfloat16
+        losses = criterion.loss_boxes(to_float(outputs), targets, None, indices, num_boxes=2)
+    loss = sum(losses.values())
+    assert loss.dtype == torch.float32 and torch.isfinite(loss)
+    scaler.scale(loss).backward()
+    for param in bbox_embed.parameters():
+        assert param.grad is not None and param.grad.dtype == torch.float32
+
+
+def test_autocast_unsupported() -> None:
+    assert autocast_support_error("cpu", None) is None
+    if hasattr(torch, "autocast"):
+        assert autocast_support_error("cpu", "bf16") is None
+    else:
+        assert autocast_support_error("cuda", "fp16") is None
+        assert "torch >= 1.10" in autocast_support_error("cpu", "bf16")
+        with pytest.raises(RuntimeError):
+            autocast(torch.device("cuda"), "bf16")
+
+
+def test_resume_grad_scaler() -> None:
+    # a checkpoint of a run without fp16 AMP has the empty state of a disabled scaler
+    state = build_grad_scaler(torch.device("cpu"), None).state_dict()
+    assert state == {}
+    load_grad_scaler_state(build_grad_scaler(torch.device("cpu"), "bf16"), state)
+    load_grad_scaler_state(build_grad_scaler(torch.device("cpu"), None), None)
+    if not torch.cuda.is_available():
+        return
+    # turning fp16 on when resuming keeps the initial scale
+    scaler = build_grad_scaler(torch.device("cuda"), "fp16")
+    assert scaler.is_enabled()
+    load_grad_scaler_state(scaler, state)
+    assert scaler.get_scale() == 2.0 ** 16
+    # and the state of an fp16 run is restored
+    saved = build_grad_scaler(torch.device("cuda"), "fp16")
+    saved.scale(torch.ones((), device="cuda"))
+    saved.update(new_scale=128.0)
+    load_grad_scaler_state(scaler, saved.state_dict())
+    assert scaler.get_scale() == 128.0
@@ -0,0 +1,66 @@
+import os
+import sys
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.abspath("."))
+from datasets.coco import resolve_token_spans, token_spans_to_tensor  # type: ignore  # noqa: E402
+from models.mdetr import SetCriterion  # type: ignore  # noqa: E402
+
+
+class Encoding:
+    """Stands for the tokenization of a caption: two characters per token, after a leading special token."""
+
+    def __init__(self, caption: str):
+        self.caption = caption
+
+    def char_to_token(self, char_index: int) -> Optional[int]:
+        if not 0 <= char_index < len(self.caption):
+            return None
+        return char_index // 2 + 1
+
+
+class BatchEncoding:
+    def __init__(self, captions: List[str]):
+        self.encodings = [Encoding(caption) for caption in captions]
+
+    def char_to_token(self, batch_index: int, char_index: int) -> Optional[int]:
+        return self.encodings[batch_index].char_to_token(char_index)
+
+
+def test_contrastive_align_token_spans() -> None:
+    torch.manual_seed(0)
+    captions = ["a dog and a red cat", "two birds on a branch"]
+    tokens_positive = [
+        # the second box has one span less than the first one, so its token_spans entry is padded
+        [[[0, 5], [12, 19]], [[10, 15]], [[6, 9]]],
+        # the second box has no span
+        [[[0, 9]], [], [[15, 21]]],
+    ]
+    indices = [
+        (torch.as_tensor([3, 0, 7]), torch.as_tensor([1, 0, 2])),
+        (torch.as_tensor([5, 2]), torch.as_tensor([1, 2])),
+    ]
+    num_queries, num_tokens, hdim = 10, 14, 8
+    outputs = {
+        "proj_queries": F.normalize(torch.randn(2, num_queries, hdim), dim=-1),
+        "proj_tokens": F.normalize(torch.randn(2, num_tokens, hdim), dim=-1),
+        "tokenized": BatchEncoding(captions),
+    }
+    legacy_targets = [{"tokens_positive": tokens} for tokens in tokens_positive]
+    # the spans resolved by the dataset, see ConvertCocoPolysToMask
+    targets = [
+        {"token_spans": token_spans_to_tensor(resolve_token_spans(Encoding(caption), tokens))}
+        for caption, tokens in zip(captions, tokens_positive)
+    ]
+    assert targets[0]["token_spans"].shape == (3, 2, 2) and targets[0]["token_spans"][1, 1].eq(0).all()
+    assert targets[1]["token_spans"][1].eq(0).all()
+
+    criterion = SetCriterion(
+        num_classes=255, matcher=None, eos_coef=0.1, losses=["contrastive_align"], temperature=0.07
+    )
+    legacy_loss = criterion.loss_contrastive_align(outputs, legacy_targets, None, indices, num_boxes=5)
+    loss = criterion.loss_contrastive_align(outputs, targets, None, indices, num_boxes=5)
+    assert torch.allclose(loss["loss_contrastive_align"], legacy_loss["loss_contrastive_align"])
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+import torch
+from scipy.optimize import linear_sum_assignment
+
+sys.path.append(os.path.abspath("."))
+from models.matcher import HungarianMatcher  # type: ignore  # noqa: E402
+from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou  # type: ignore  # noqa: E402
+
+
+def random_boxes(*shape):
+    centers = torch.rand(*shape, 2) * 0.6 + 0.2
+    sizes = torch.rand(*shape, 2) * 0.3 + 0.05
+    return torch.cat([centers, sizes], -1)
+
+
+@torch.no_grad()
+def dense_match(matcher, outputs, targets, positive_map):
+    """The previous HungarianMatcher.forward: one dense [bs * queries, total targets] cost matrix, split per image."""
+    bs, num_queries = outputs["pred_logits"].shape[:2]
+    out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)
+    out_bbox = outputs["pred_boxes"].flatten(0, 1)
+    tgt_bbox = torch.cat([v["boxes"] for v in targets])
+    cost_class = -(out_prob.unsqueeze(1) * positive_map.unsqueeze(0)).sum(-1)
+    cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
+    cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+    C = matcher.cost_bbox * cost_bbox + matcher.cost_class * cost_class + matcher.cost_giou * cost_giou
+    C = C.view(bs, num_queries, -1).cpu()
+    sizes = [len(v["boxes"]) for v in targets]
+    indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+    return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+
+
+@pytest.mark.parametrize("num_workers", [0, 4])
+def test_match_layers_matches_dense_forward(num_workers: int) -> None:
+    torch.manual_seed(0)
+    num_layers, num_queries, num_tokens = 6, 20, 32
+    matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_workers=num_workers)
+    # images without boxes, and with more boxes than queries
+    for sizes in ([3, 0, 7, 1], [0, 5], [25, 2, 0]):
+        bs = len(sizes)
+        outputs_list = [
+            {"pred_logits": torch.randn(bs, num_queries, num_tokens), "pred_boxes": random_boxes(bs, num_queries)}
+            for _ in range(num_layers)
+        ]
+        targets = [{"boxes": random_boxes(size)} for size in sizes]
+        positive_map = torch.zeros(sum(sizes), num_tokens)
+        for row in positive_map:
+            beg = int(torch.randint(0, num_tokens - 4, ()))
+            row[beg : beg + int(torch.randint(1, 4, ()))] = 1
+        positive_map = positive_map / positive_map.sum(-1, keepdim=True)
+
+        layer_indices = matcher.match_layers(outputs_list, targets, positive_map)
+        assert len(layer_indices) == num_layers
+        for outputs, indices in zip(outputs_list, layer_indices):
+            # with random costs there are no ties, so the assignments must be the same
+            expected = dense_match(matcher, outputs, targets, positive_map)
+            assert len(indices) == bs
+            for (src, tgt), (expected_src, expected_tgt), size in zip(indices, expected, sizes):
+                assert len(src) == min(size, num_queries)
+                assert torch.equal(src, expected_src) and torch.equal(tgt, expected_tgt)
+        # forward matches a single layer
+        indices = matcher(outputs_list[0], targets, positive_map)
+        expected = dense_match(matcher, outputs_list[0], targets, positive_map)
+        for (src, tgt), (expected_src, expected_tgt) in zip(indices, expected):
+            assert torch.equal(src, expected_src) and torch.equal(tgt, expected_tgt)
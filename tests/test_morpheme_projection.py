@@ -0,0 +1,80 @@
+import os
+import sys
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import torch
+from transformers import CharSpan
+
+sys.path.append(os.path.abspath("."))
+from run_mdetr import build_morpheme_index, project_to_morphemes  # type: ignore  # noqa: E402
+
+
+@dataclass
+class Morpheme:
+    text: str
+
+
+@dataclass
+class Caption:
+    text: str
+    morphemes: List[Morpheme]
+
+
+class Tokenized:
+    """Stands for the BatchEncoding of a single caption, built from a hand-written offset mapping."""
+
+    def __init__(self, offsets: List[Optional[CharSpan]]):
+        self.offsets = offsets
+        self.input_ids = [list(range(len(offsets)))]
+
+    def token_to_chars(self, batch_index: int, pos: int) -> CharSpan:
+        assert batch_index == 0
+        if self.offsets[pos] is None:
+            # as transformers does for special tokens
+            raise TypeError
+        return self.offsets[pos]
+
+
+def reference_word_probs(token_probs: List[float], tokenized: Tokenized, caption: Caption) -> List[float]:
+    """The per-token loop replaced by build_morpheme_index and project_to_morphemes."""
+    char_probs: List[float] = [0] * len(caption.text)
+    for pos, token_prob in enumerate(token_probs):
+        try:
+            span: CharSpan = tokenized.token_to_chars(0, pos)
+        except TypeError:
+            continue
+        char_probs[span.start : span.end] = [token_prob] * (span.end - span.start)
+    word_probs: List[float] = []
+    char_span = CharSpan(0, 0)
+    for morpheme in caption.morphemes:
+        char_span = CharSpan(char_span.end, char_span.end + len(morpheme.text))
+        word_probs.append(np.max(char_probs[char_span.start : char_span.end]).item())
+    return word_probs
+
+
+def test_project_to_morphemes() -> None:
+    # 「白い犬が走る。」: 白い|犬|が|走る|。
+    caption = Caption("白い犬が走る。", [Morpheme("白い"), Morpheme("犬"), Morpheme("が"), Morpheme("走る"), Morpheme("。")])
+    tokenized = Tokenized(
+        [
+            None,  # <s>
+            CharSpan(0, 1),  # 白
+            CharSpan(1, 3),  # い犬: spans two morphemes
+            CharSpan(2, 3),  # 犬: covers a character of the previous token, the last token wins
+            CharSpan(4, 6),  # 走る
+            None,  # </s>: が and 。 are covered by no token
+            None,  # <pad>
+        ]
+    )
+    morpheme_index = build_morpheme_index(tokenized, caption)
+    torch.manual_seed(0)
+    token_probs = torch.rand(3, 4, len(tokenized.offsets)).softmax(-1)  # (b, cand, seq)
+    word_probs = project_to_morphemes(token_probs, morpheme_index)
+    assert word_probs.shape == (3, 4, len(caption.morphemes))
+    for probs, expected in zip(token_probs.flatten(0, 1), word_probs.flatten(0, 1)):
+        reference = reference_word_probs(probs.tolist(), tokenized, caption)
+        assert torch.allclose(expected, torch.as_tensor(reference, dtype=expected.dtype))
+    # morphemes covered by no token get 0
+    assert word_probs[..., 2].eq(0).all() and word_probs[..., 4].eq(0).all()
@@ -0,0 +1,55 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from torch.utils.data import BatchSampler, DistributedSampler
+
+sys.path.append(os.path.abspath("."))
+from datasets.samplers import ResumableBatchSampler  # type: ignore  # noqa: E402
+from util.checkpoint import AsyncCheckpointWriter  # type: ignore  # noqa: E402
+
+
+def test_resumable_batch_sampler_skip() -> None:
+    sampler = DistributedSampler(range(50), num_replicas=1, rank=0, seed=3)
+    batch_sampler = ResumableBatchSampler(BatchSampler(sampler, batch_size=4, drop_last=True))
+    sampler.set_epoch(2)
+    batches = list(batch_sampler)
+    assert len(batches) == len(batch_sampler) == 12
+
+    # a resumed epoch yields exactly the remaining batches of the same epoch
+    batch_sampler.skip(5)
+    assert list(batch_sampler) == batches[5:]
+    assert len(batch_sampler) == 12
+    # skip only applies to the next iteration
+    assert list(batch_sampler) == batches
+    # the next epoch starts from the beginning, in another order
+    sampler.set_epoch(3)
+    assert len(list(batch_sampler)) == 12 and list(batch_sampler) != batches
+
+
+def test_async_checkpoint_writer_rotation(tmp_path: Path) -> None:
+    writer = AsyncCheckpointWriter()
+    for step in range(5):
+        checkpoint = {"step": step, "weight": torch.full((3,), float(step))}
+        writer.save(checkpoint, tmp_path / f"checkpoint_step{step:09d}.pth", rotate=("checkpoint_step*.pth", 2))
+    writer.save({"epoch": 0}, tmp_path / "checkpoint_0.pth")
+    writer.wait()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "checkpoint_0.pth",
+        "checkpoint_step000000003.pth",
+        "checkpoint_step000000004.pth",
+    ]
+    assert torch.load(tmp_path / "checkpoint_step000000004.pth")["weight"].eq(4).all()
+
+
+def test_async_checkpoint_writer_error(tmp_path: Path) -> None:
+    writer = AsyncCheckpointWriter()
+    writer.save({"step": 0}, tmp_path / "missing_dir" / "checkpoint.pth")
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    # the error is only raised once, the writer can be used again
+    writer.save({"step": 1}, tmp_path / "checkpoint.pth")
+    writer.wait()
+    assert torch.load(tmp_path / "checkpoint.pth")["step"] == 1
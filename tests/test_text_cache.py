@@ -0,0 +1,62 @@
+import os
+import sys
+from types import SimpleNamespace
+from typing import List
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+sys.path.append(os.path.abspath("."))
+from run_mdetr import TextMemoryCache  # type: ignore  # noqa: E402
+from util.cache import nbytes  # type: ignore  # noqa: E402
+
+CAPTIONS = ["a dog", "a man rides a red bike near the old tree", "two dogs play"]
+HIDDEN_DIM = 8
+
+
+class TextEncoder:
+    """Stands for model.transformer: encodes the captions into random memories."""
+
+    def __init__(self):
+        words = sorted({word for caption in CAPTIONS for word in caption.split()})
+        tokenizer = Tokenizer(models.WordLevel({word: i for i, word in enumerate(["[UNK]", "[PAD]"] + words)}, "[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+        self.tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]")
+        self.num_calls = 0
+
+    def encode_text(self, text: List[str]):
+        self.num_calls += 1
+        tokenized = self.tokenizer.batch_encode_plus(text, padding="longest", return_tensors="pt")
+        text_attention_mask = tokenized["attention_mask"].ne(1)
+        text_memory_resized = torch.randn(tokenized["input_ids"].shape[1], len(text), HIDDEN_DIM)
+        return text_attention_mask, text_memory_resized, tokenized
+
+
+def test_text_cache_entries_are_per_caption() -> None:
+    torch.manual_seed(0)
+    model = SimpleNamespace(transformer=TextEncoder())
+    cache = TextMemoryCache()
+    text_attention_mask, text_memory_resized, tokenizations = cache.get(model, "test", CAPTIONS)
+    assert model.transformer.num_calls == 1
+    assert text_attention_mask.shape == (3, 9) and text_memory_resized.shape == (9, 3, HIDDEN_DIM)
+
+    # each entry only holds the unpadded slices of its caption
+    expected_bytes = 0
+    for caption, tokenized in zip(CAPTIONS, tokenizations):
+        alone = model.transformer.tokenizer(caption, return_tensors="pt")
+        assert torch.equal(tokenized["input_ids"], alone["input_ids"])
+        assert [tokenized.token_to_chars(0, pos) for pos in range(len(caption.split()))] == [
+            alone.token_to_chars(0, pos) for pos in range(len(caption.split()))
+        ]
+        length = alone["input_ids"].shape[1]
+        expected_bytes += nbytes(alone["input_ids"]) + nbytes(alone["attention_mask"])
+        expected_bytes += length * (1 + HIDDEN_DIM * text_memory_resized.element_size())
+    assert cache.cache.total_bytes == expected_bytes
+
+    # cached captions are padded to the batches they appear in
+    mask, memory, _ = cache.get(model, "test", [CAPTIONS[2], CAPTIONS[0]])
+    assert model.transformer.num_calls == 1
+    assert mask.shape == (2, 3) and mask[1, 2] and not mask[1, :2].any()
+    assert torch.equal(memory[:3, 0], text_memory_resized[:3, 2])
+    assert torch.equal(memory[:2, 1], text_memory_resized[:2, 0]) and memory[2, 1].eq(0).all()
@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from PIL import Image
+from pycocotools.coco import COCO
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+sys.path.append(os.path.abspath("."))
+from datasets.coco import ConvertCocoPolysToMask, resolve_token_spans  # type: ignore  # noqa: E402
+from datasets.token_store import TokenStore, annotation_hash, write_token_store  # type: ignore  # noqa: E402
+
+CAPTIONS = {1: "a man rides a red bike", 2: "two dogs play near the old tree"}
+
+
+def build_tokenizer() -> PreTrainedTokenizerFast:
+    words = sorted({word for caption in CAPTIONS.values() for word in caption.split()})
+    vocab = {word: i for i, word in enumerate(["[UNK]"] + words)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, name_or_path="test/word-level")
+
+
+def annotation(ann_id, image_id, bbox, tokens_positive, iscrowd=0):
+    return {
+        "id": ann_id,
+        "image_id": image_id,
+        "bbox": bbox,
+        "area": bbox[2] * bbox[3],
+        "iscrowd": iscrowd,
+        "category_id": 1,
+        "tokens_positive": tokens_positive,
+    }
+
+
+def write_annotations(path: Path) -> None:
+    images = [
+        {"id": 1, "width": 64, "height": 48, "caption": CAPTIONS[1], "tokens_positive_eval": [[[2, 5]], [[14, 22]]]},
+        {"id": 2, "width": 32, "height": 32, "caption": CAPTIONS[2], "tokens_positive_eval": [[[0, 8]]]},
+    ]
+    annotations = [
+        annotation(1, 1, [1, 2, 10, 20], [[2, 5]]),
+        # crowd box, dropped by ConvertCocoPolysToMask
+        annotation(2, 1, [5, 5, 10, 10], [[14, 17]], iscrowd=1),
+        # degenerate box, dropped by ConvertCocoPolysToMask
+        annotation(3, 1, [20, 5, 0, 10], [[0, 1]]),
+        annotation(4, 1, [30, 10, 20, 30], [[12, 13], [14, 22]]),
+        annotation(5, 2, [0, 0, 16, 16], [[4, 8]]),
+        annotation(6, 2, [8, 8, 0, 0], [[9, 13]]),
+        annotation(7, 2, [4, 4, 20, 20], [[27, 31], [4, 8]], iscrowd=1),
+        annotation(8, 2, [2, 3, 20, 20], [[23, 31]]),
+    ]
+    categories = [{"id": 1, "name": "object"}]
+    with open(path, "w") as f:
+        json.dump({"images": images, "annotations": annotations, "categories": categories}, f)
+
+
+def test_token_store_matches_tokenizer(tmp_path: Path) -> None:
+    ann_file = tmp_path / "final_test.json"
+    write_annotations(ann_file)
+    coco = COCO(ann_file)
+    tokenizer = build_tokenizer()
+    store = TokenStore(write_token_store(coco, ann_file, tokenizer, tmp_path / "stores"), annotation_hash(ann_file))
+    assert len(store) == len(coco.imgs)
+
+    with_tokenizer = ConvertCocoPolysToMask(return_tokens=True, tokenizer=tokenizer)
+    with_store = ConvertCocoPolysToMask(return_tokens=True)
+    for image_id, img in coco.imgs.items():
+        image = Image.new("RGB", (img["width"], img["height"]))
+        anns = coco.loadAnns(coco.getAnnIds(imgIds=image_id))
+        target = {"image_id": image_id, "annotations": anns, "caption": img["caption"]}
+        _, expected = with_tokenizer(image, target)
+        _, result = with_store(image, {**target, "token_spans": store.token_spans(image_id)})
+        assert len(result["boxes"]) < len(anns)
+        for key in ("boxes", "positive_map", "token_spans"):
+            assert torch.equal(result[key], expected[key]), key
+
+        tokenized = tokenizer(img["caption"], return_tensors="pt")
+        expected_eval = resolve_token_spans(tokenized, img["tokens_positive_eval"])
+        assert store.eval_token_spans(image_id) == [[list(span) for span in spans] for spans in expected_eval]
+        assert store.input_ids(image_id).tolist() == tokenized["input_ids"][0].tolist()
+
+
+def test_token_store_rejects_other_annotations(tmp_path: Path) -> None:
+    ann_file = tmp_path / "final_test.json"
+    write_annotations(ann_file)
+    store_dir = write_token_store(COCO(ann_file), ann_file, build_tokenizer(), tmp_path / "stores")
+    with open(ann_file, "a") as f:
+        f.write("\n")
+    with pytest.raises(ValueError):
+        TokenStore(store_dir, annotation_hash(ann_file))
@@ -0,0 +1,63 @@
+# Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
+"""Utilities for automatic mixed precision (AMP) training and evaluation."""
+import contextlib
+from typing import Any, Dict, Optional
+
+import torch
+
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def autocast_support_error(device_type: str, amp: Optional[str]) -> Optional[str]:
+    """Returns why autocast with the AMP mode is not available on the device type with the installed torch, or None."""
+    if amp is None or hasattr(torch, "autocast"):
+        return None
+    # before torch 1.10, only fp16 autocast on cuda is available
+    if device_type != "cuda" or amp != "fp16":
+        return f"{amp} autocast on {device_type} requires torch >= 1.10"
+    return None
+
+
+def autocast(device: torch.device, amp: Optional[str]):
+    """Returns the autocast context manager for the device and the given AMP mode ("fp16", "bf16" or None).
+
+    With None, mixed precision is disabled and a null context is returned. With torch >= 1.10, bf16 also works on CPU.
+    """
+    if amp is None:
+        return contextlib.nullcontext()
+    error = autocast_support_error(device.type, amp)
+    if error is not None:
+        raise RuntimeError(error)
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[amp])
+    return torch.cuda.amp.autocast()
+
+
+def build_grad_scaler(device: torch.device, amp: Optional[str]) -> torch.cuda.amp.GradScaler:
+    """Returns the loss scaler of the AMP mode.
+
+    Only fp16 needs loss scaling, bf16 has the same exponent range as fp32. With other modes the scaler is disabled,
+    in which case all its methods are no-ops and scale() returns the loss unchanged.
+    """
+    return torch.cuda.amp.GradScaler(enabled=amp == "fp16" and device.type == "cuda")
+
+
+def load_grad_scaler_state(scaler: torch.cuda.amp.GradScaler, state: Optional[Dict[str, Any]]) -> None:
+    """Loads the scaler state of a checkpoint, if it has one.
+
+    A disabled scaler saves an empty state, e.g. in a checkpoint of a run without fp16 AMP. Loading it into an enabled
+    scaler raises, so the scaler then keeps its initial state.
+    """
+    if state:
+        scaler.load_state_dict(state)
+
+
+def to_float(obj: Any) -> Any:
+    """Casts the reduced precision floating point tensors contained in ``obj`` (recursing into containers) to fp32."""
+    if isinstance(obj, torch.Tensor):
+        return obj.float() if obj.dtype in (torch.float16, torch.bfloat16) else obj
+    if isinstance(obj, dict):
+        return {k: to_float(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_float(v) for v in obj)
+    return obj
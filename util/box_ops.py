@@ -4,7 +4,6 @@
 Utilities for bounding box manipulation and GIoU.
 """
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -21,16 +20,17 @@ def box_xyxy_to_cxcywh(x):
 
 # modified from torchvision to also return the union
 def box_iou(boxes1, boxes2):
-    area1 = box_area(boxes1)
-    area2 = box_area(boxes2)
+    # same as torchvision's box_area, which only supports [N, 4] boxes
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
@@ -43,19 +43,19 @@ def generalized_box_iou(boxes1, boxes2):
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2). Batches of boxes [..., N, 4] and [..., M, 4] give a [..., N, M] matrix.
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+    assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
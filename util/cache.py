@@ -0,0 +1,76 @@
+"""Small in-memory caches used to reuse intermediate tensors at inference time."""
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Hashable, Optional
+
+import torch
+
+
+def nbytes(obj: Any) -> int:
+    """Returns the number of bytes held by the tensors contained in ``obj`` (recursing into containers)."""
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, Mapping):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+class LRUCache:
+    """Least-recently-used mapping whose capacity is a budget on the total byte size of its values.
+
+    Args:
+        max_bytes: maximum total size of the cached values. Values larger than the budget are never stored.
+        sizeof: function returning the size in bytes of a value.
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if key in self._entries:
+            self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        while self.total_bytes + size > self.max_bytes:
+            self.pop(next(iter(self._entries)))
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.total_bytes += size
+
+    def pop(self, key: Hashable) -> Any:
+        self.total_bytes -= self._sizes.pop(key)
+        return self._entries.pop(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}(entries={len(self)}, bytes={self.total_bytes}/{self.max_bytes}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
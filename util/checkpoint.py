@@ -0,0 +1,251 @@
+"""Inference-only checkpoints that can be memory-mapped instead of unpickled, and asynchronous writes of training
+checkpoints.
+
+The file layout of inference checkpoints follows the safetensors format: an 8-byte little-endian header length, a JSON
+header mapping each tensor name to its dtype, shape and byte range, then the raw tensor data. The `__metadata__` entry
+of the header holds the `_make_detr` config and the training args as JSON strings.
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+METADATA_KEY = "__metadata__"
+INFERENCE_CHECKPOINT_SUFFIX = ".safetensors"
+
+_DTYPES = {
+    torch.float32: ("F32", np.float32),
+    torch.float16: ("F16", np.float16),
+    # numpy has no bfloat16, the raw bits are stored as int16
+    torch.bfloat16: ("BF16", np.int16),
+    torch.float64: ("F64", np.float64),
+    torch.int64: ("I64", np.int64),
+    torch.int32: ("I32", np.int32),
+    torch.int16: ("I16", np.int16),
+    torch.int8: ("I8", np.int8),
+    torch.uint8: ("U8", np.uint8),
+    torch.bool: ("BOOL", np.bool_),
+}
+_DTYPES_BY_NAME = {name: (torch_dtype, np_dtype) for torch_dtype, (name, np_dtype) in _DTYPES.items()}
+
+
+def save_tensors(path: Union[str, Path], tensors: Dict[str, torch.Tensor], metadata: Dict[str, str]) -> None:
+    header: Dict[str, Any] = {METADATA_KEY: metadata}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.element_size() * tensor.nelement()
+        header[name] = {
+            "dtype": _DTYPES[tensor.dtype][0],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    # align the data section on 8 bytes
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors.values():
+            tensor = tensor.detach().cpu().contiguous()
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+
+
+def read_header(path: Union[str, Path]) -> Tuple[Dict[str, Any], int]:
+    """Returns the header of the file and the offset at which the tensor data starts."""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def load_tensors(path: Union[str, Path]) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Memory-maps the tensors stored in the file.
+
+    The tensors share memory with a copy-on-write mapping of the file, so pages are only read from disk when the
+    tensors are accessed (e.g. when they are copied into the parameters of a model).
+    """
+    header, data_start = read_header(path)
+    metadata = header.pop(METADATA_KEY, {})
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start) if header else None
+    tensors = {}
+    for name, info in header.items():
+        torch_dtype, np_dtype = _DTYPES_BY_NAME[info["dtype"]]
+        begin, end = info["data_offsets"]
+        array = data[begin:end].view(np_dtype).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor
+    return tensors, metadata
+
+
+# `hubconf._make_detr` arguments of the models released with this repository, used for checkpoints without config
+DEFAULT_DETR_CONFIG = {"backbone_name": "timm_tf_efficientnet_b3_ns", "text_encoder": "xlm-roberta-base"}
+
+
+def resolve_detr_config(checkpoint: Dict[str, Any], **overrides: Optional[Any]) -> Dict[str, Any]:
+    """Returns the `hubconf._make_detr` keyword arguments of the checkpoint.
+
+    They are read from the header of inference checkpoints, or default to DEFAULT_DETR_CONFIG. The overrides which are
+    not None (e.g. explicitly passed command line options) are applied on top.
+    """
+    detr_config = dict(checkpoint.get("detr_config") or DEFAULT_DETR_CONFIG)
+    detr_config.update({k: v for k, v in overrides.items() if v is not None})
+    return detr_config
+
+
+def detr_config_from_args(args) -> Dict[str, Any]:
+    """Returns the `hubconf._make_detr` keyword arguments matching the model built by `models.build` from args."""
+    qa_dataset = None
+    if args.do_qa:
+        qa_dataset = "gqa" if "gqa" in args.combine_datasets else "clevr"
+    return {
+        "backbone_name": args.backbone,
+        "num_queries": args.num_queries,
+        "mask": args.mask_model != "none",
+        "qa_dataset": qa_dataset,
+        "predict_final": args.predict_final,
+        "text_encoder": args.text_encoder_type,
+        "contrastive_align_loss": args.contrastive_align_loss,
+    }
+
+
+def export_inference_checkpoint(
+    checkpoint: Dict[str, Any],
+    path: Union[str, Path],
+    use_ema: bool = True,
+    dtype: Optional[torch.dtype] = None,
+    detr_config: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Writes the weights of a training checkpoint as a memory-mappable inference checkpoint.
+
+    Args:
+        checkpoint: training checkpoint, as saved by main.py
+        path: output file
+        use_ema: export the EMA weights if the checkpoint has them, the raw weights otherwise
+        dtype: if given, floating point weights are cast to this dtype (e.g. torch.float16 or torch.bfloat16)
+        detr_config: `_make_detr` keyword arguments. Derived from the training args of the checkpoint by default.
+    """
+    use_ema = use_ema and checkpoint.get("model_ema") is not None
+    state_dict = checkpoint["model_ema"] if use_ema else checkpoint["model"]
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+    metadata = {"weights": "model_ema" if use_ema else "model"}
+    args = checkpoint.get("args")
+    if detr_config is None and args is not None:
+        detr_config = detr_config_from_args(args)
+    if detr_config is not None:
+        metadata["detr_config"] = json.dumps(detr_config)
+    if args is not None:
+        metadata["args"] = json.dumps(vars(args), default=str)
+    save_tensors(path, state_dict, metadata)
+
+
+def is_inference_checkpoint(path: Union[str, Path]) -> bool:
+    return str(path).endswith(INFERENCE_CHECKPOINT_SUFFIX)
+
+
+def load_checkpoint(path: Union[str, Path], map_location="cpu") -> Dict[str, Any]:
+    """Loads either a training checkpoint or an inference checkpoint.
+
+    Inference checkpoints are memory-mapped and returned in the same layout as training checkpoints, that is with
+    the "model" (and "model_ema" if EMA weights were exported) and "args" keys, plus "detr_config".
+    """
+    path = str(path)
+    if path.startswith("https"):
+        return torch.hub.load_state_dict_from_url(path, map_location=map_location, check_hash=True)
+    if not is_inference_checkpoint(path):
+        return torch.load(path, map_location=map_location)
+    state_dict, metadata = load_tensors(path)
+    checkpoint: Dict[str, Any] = {"model": state_dict}
+    if metadata.get("weights") == "model_ema":
+        checkpoint["model_ema"] = state_dict
+    if "args" in metadata:
+        checkpoint["args"] = argparse.Namespace(**json.loads(metadata["args"]))
+    if "detr_config" in metadata:
+        checkpoint["detr_config"] = json.loads(metadata["detr_config"])
+    return checkpoint
+
+
+def get_rng_states() -> Dict[str, Any]:
+    """Returns the states of the python, numpy and torch (CPU and cuda) random number generators of this process."""
+    states = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict[str, Any]) -> None:
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def cpu_snapshot(obj: Any) -> Any:
+    """Copies the tensors contained in obj (recursing into containers) to CPU, so that obj can be written while the
+    training goes on."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """Writes training checkpoints with torch.save on a background thread.
+
+    save() takes a CPU snapshot of the checkpoint, then returns while it is written. A checkpoint is first written to a
+    temporary file then renamed, so that a preempted write never leaves a truncated checkpoint behind. Only one write is
+    in flight: save() and wait() first wait for the previous one, and raise its error if it failed.
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def save(self, checkpoint: Dict[str, Any], path: Union[str, Path], rotate: Optional[Tuple[str, int]] = None):
+        """Writes checkpoint to path.
+
+        Args:
+            rotate: optional (glob pattern, n). Once written, only the n last files (by name) matching the pattern in
+                the directory of path are kept.
+        """
+        self.wait()
+        snapshot = cpu_snapshot(checkpoint)
+        self._thread = threading.Thread(target=self._write, args=(snapshot, Path(path), rotate))
+        self._thread.start()
+
+    def _write(self, checkpoint: Dict[str, Any], path: Path, rotate: Optional[Tuple[str, int]]):
+        try:
+            tmp_path = path.with_name(path.name + ".tmp")
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, path)
+            if rotate is not None:
+                pattern, keep = rotate
+                for old_path in sorted(path.parent.glob(pattern))[: -max(keep, 1)]:
+                    old_path.unlink()
+        except BaseException as e:
+            self._error = e
+
+    def wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing the checkpoint failed") from error
+
@@ -5,11 +5,12 @@ Various utilities related to track and report metrics
 import datetime
 import time
 from collections import defaultdict, deque
+from typing import Dict, List
 
 import torch
 import torch.distributed as dist
 
-from util.dist import is_dist_avail_and_initialized
+from util.dist import get_world_size, is_dist_avail_and_initialized
 
 
 class SmoothedValue:
@@ -72,6 +73,41 @@ class SmoothedValue:
         )
 
 
+class DeferredReducer:
+    """Accumulates dicts of scalar tensors (e.g. the losses of each step) on their device, and averages them over all
+    the processes only when flushed.
+
+    Compared to calling util.dist.reduce_dict and .item() at every step, a single all-reduce and a single device to host
+    copy are done per flush, so the steps in between neither block on a collective nor synchronize the device.
+    """
+
+    def __init__(self):
+        self.names = None
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, values: Dict[str, torch.Tensor]) -> None:
+        # sort the keys so that they are consistent across processes
+        names = sorted(values.keys())
+        assert self.names is None or names == self.names, "all the steps must have the same values"
+        self.names = names
+        self.pending.append(torch.stack([values[k].detach().float() for k in names]))
+
+    def flush(self) -> List[Dict[str, float]]:
+        """Returns the values added since the last flush, averaged over the processes, in the order they were added."""
+        if len(self.pending) == 0:
+            return []
+        values = torch.stack(self.pending)
+        self.pending = []
+        world_size = get_world_size()
+        if world_size > 1:
+            dist.all_reduce(values)
+            values /= world_size
+        return [dict(zip(self.names, row)) for row in values.tolist()]
+
+
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
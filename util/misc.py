@@ -7,9 +7,12 @@ Mostly copy-paste from torchvision references.
 """
 import os
 import subprocess
+import types
+from functools import partial
 from typing import Any, Dict, List, Optional
 
 import torch
+import torch.utils.checkpoint
 from torch import Tensor
 
 
@@ -55,6 +58,15 @@ def collate_fn(do_round, batch):
         assert cur_count == len(batched_pos_map)
         # assert batched_pos_map.sum().item() == sum([v["positive_map"].sum().item() for v in batch[1]])
         final_batch["positive_map"] = batched_pos_map.float()
+    if "token_spans" in batch[1][0]:
+        # pad the token spans of all the targets to the same number of spans per box, so that the loss can concatenate
+        # them. Padding spans are empty.
+        max_spans = max([v["token_spans"].shape[1] for v in batch[1]])
+        for v in batch[1]:
+            cur_spans = v["token_spans"]
+            if cur_spans.shape[1] < max_spans:
+                padding = cur_spans.new_zeros((len(cur_spans), max_spans - cur_spans.shape[1], 2))
+                v["token_spans"] = torch.cat([cur_spans, padding], 1)
     if "positive_map_eval" in batch[1][0]:
         # we batch the positive maps here
         # Since in general each batch element will have a different number of boxes,
@@ -92,6 +104,10 @@ class NestedTensor(object):
         cast_mask = self.mask.to(*args, **kwargs) if self.mask is not None else None
         return type(self)(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        # called by the DataLoader when pin_memory=True
+        return type(self)(self.tensors.pin_memory(), self.mask.pin_memory() if self.mask is not None else None)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -126,6 +142,39 @@ class NestedTensor(object):
         return repr(self.tensors)
 
 
+def checkpoint_call(function, *args, **kwargs):
+    """Calls function(*args, **kwargs) with activation checkpointing: the intermediate activations are not stored but
+    recomputed during backward.
+
+    A dummy input requiring grad is added, so that the parameters used by function get their gradients even if none of
+    the inputs requires grad (e.g. the first stage of a backbone).
+    """
+    names = list(kwargs.keys())
+    num_args = len(args)
+
+    def run(_, *inputs):
+        return function(*inputs[:num_args], **dict(zip(names, inputs[num_args:])))
+
+    dummy = torch.ones(1, requires_grad=True)
+    return torch.utils.checkpoint.checkpoint(run, dummy, *args, *kwargs.values())
+
+
+def checkpoint_module(module: torch.nn.Module) -> torch.nn.Module:
+    """Enables activation checkpointing on the forward of module, when training with grad enabled.
+
+    The forward of the instance is replaced, so that the parameters and the state dict keys are left unchanged.
+    """
+    forward = type(module).forward
+
+    def checkpointed_forward(self, *args, **kwargs):
+        if not (self.training and torch.is_grad_enabled()):
+            return forward(self, *args, **kwargs)
+        return checkpoint_call(partial(forward, self), *args, **kwargs)
+
+    module.forward = types.MethodType(checkpointed_forward, module)
+    return module
+
+
 def interpolate(input, size=None, scale_factor=None, mode="nearest", align_corners=None):
     # type: (Tensor, Optional[List[int]], Optional[float], str, Optional[bool]) -> Tensor
     """
@@ -145,17 +194,109 @@ def interpolate(input, size=None, scale_factor=None, mode="nearest", align_corne
 
 
 
+# keys of the target dicts that are not moved to the device
+TARGET_EXCLUDED_KEYS = (
+    "questionId",
+    "tokens_positive",
+    "tokens",
+    "dataset_name",
+    "sentence_id",
+    "original_img_id",
+    "nb_eval",
+    "task_id",
+    "original_id",
+)
+
+
 def targets_to(targets: List[Dict[str, Any]], device):
     """Moves the target dicts to the given device."""
-    excluded_keys = [
-        "questionId",
-        "tokens_positive",
-        "tokens",
-        "dataset_name",
-        "sentence_id",
-        "original_img_id",
-        "nb_eval",
-        "task_id",
-        "original_id",
+    return [
+        {k: v.to(device) if k not in TARGET_EXCLUDED_KEYS else v for k, v in t.items() if k != "caption"}
+        for t in targets
     ]
-    return [{k: v.to(device) if k not in excluded_keys else v for k, v in t.items() if k != "caption"} for t in targets]
+
+
+def batch_to(batch: Dict[str, Any], device, non_blocking: bool = False) -> Dict[str, Any]:
+    """Moves the tensors of a batch built by collate_fn to the given device.
+
+    Unlike targets_to, the captions are kept in the targets. With non_blocking=True and a pinned batch, the copies are
+    asynchronous with respect to the host.
+    """
+    moved = {}
+    for key, value in batch.items():
+        if key == "targets":
+            value = [
+                {
+                    k: v.to(device, non_blocking=non_blocking)
+                    if isinstance(v, Tensor) and k not in TARGET_EXCLUDED_KEYS
+                    else v
+                    for k, v in t.items()
+                }
+                for t in value
+            ]
+        elif key == "answers":
+            value = {k: v.to(device, non_blocking=non_blocking) for k, v in value.items()}
+        elif isinstance(value, (Tensor, NestedTensor)):
+            value = value.to(device, non_blocking=non_blocking)
+        moved[key] = value
+    return moved
+
+
+def _record_stream(batch: Dict[str, Any], stream) -> None:
+    """Marks the device tensors of a batch as used by the given stream, see torch.Tensor.record_stream."""
+    for key, value in batch.items():
+        if key == "targets":
+            tensors = [v for t in value for v in t.values() if isinstance(v, Tensor)]
+        elif key == "answers":
+            tensors = list(value.values())
+        elif isinstance(value, NestedTensor):
+            tensors = [value.tensors] + ([value.mask] if value.mask is not None else [])
+        elif isinstance(value, Tensor):
+            tensors = [value]
+        else:
+            tensors = []
+        for tensor in tensors:
+            if tensor.is_cuda:
+                tensor.record_stream(stream)
+
+
+class DevicePrefetcher:
+    """Wraps a DataLoader using collate_fn, and yields its batches already moved to the device (see batch_to).
+
+    On cuda, the host to device copies of batch i+1 are issued on a side stream while batch i is processed, so that
+    they overlap with the compute. The DataLoader should be built with pin_memory=True for the copies to be
+    asynchronous. On other devices, the batches are simply moved before being yielded.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return batch_to(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield batch_to(batch, self.device)
+            return
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # the compute stream must wait for the copies, and the memory of the batch must not be reused by the
+            # caching allocator of the side stream before the compute stream is done with it
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+            next_batch = self._preload(iterator)
+            yield batch
@@ -5,24 +5,85 @@ from bisect import bisect_right
 import torch
 
 
-def update_ema(model, model_ema, decay):
-    """Apply exponential moving average update.
+class ModelEma:
+    """Fused exponential moving average of the weights of a model.
 
-    The  weights are updated in-place as follow:
+    The floating point parameters and buffers of both models are collected once, and each update runs two multi-tensor
+    kernels instead of a loop over the state dict:
     w_ema = w_ema * decay + (1 - decay) * w
+    The other buffers (e.g. integer counters) are copied.
+
     Args:
         model: active model that is being optimized
-        model_ema: running average model
-        decay: exponential decay parameter
+        model_ema: running average model, a copy of model. It can be kept on CPU to save device memory, the weights
+                   are then copied to pinned memory before each update.
+        decay: exponential decay parameter, per optimization step
+        interval: the average is only updated every `interval` steps, with decay ** interval, so that it spans the same
+                  number of steps
+        use_stream: on cuda, run the updates on a side stream, overlapping with the next forward pass. wait() must then
+                    be called before model is modified or model_ema is read.
     """
-    with torch.no_grad():
+
+    def __init__(self, model, model_ema, decay: float, interval: int = 1, use_stream: bool = False):
         if hasattr(model, "module"):
             # unwrapping DDP
             model = model.module
+        self.model_ema = model_ema
+        self.decay = decay
+        self.interval = max(interval, 1)
+        self.num_steps = 0
+
         msd = model.state_dict()
+        self.ema_float, self.model_float, self.ema_other, self.model_other = [], [], [], []
         for k, ema_v in model_ema.state_dict().items():
             model_v = msd[k].detach()
-            ema_v.copy_(ema_v * decay + (1.0 - decay) * model_v)
+            if ema_v.is_floating_point():
+                self.ema_float.append(ema_v)
+                self.model_float.append(model_v)
+            else:
+                self.ema_other.append(ema_v)
+                self.model_other.append(model_v)
+
+        device = self.model_float[0].device
+        self.staging = None
+        if self.ema_float[0].device != device:
+            assert device.type == "cuda" and self.ema_float[0].device.type == "cpu", "EMA offloading requires cuda"
+            self.staging = [torch.empty(v.shape, dtype=v.dtype, pin_memory=True) for v in self.model_float]
+        self.stream = None
+        if use_stream and self.staging is None and device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+
+    @torch.no_grad()
+    def update(self):
+        """Counts an optimization step, and updates the average if the interval is reached."""
+        self.num_steps += 1
+        if self.num_steps % self.interval != 0:
+            return
+        decay = self.decay ** self.interval
+        if self.stream is None:
+            self._update(decay)
+            return
+        # the weights must be read after the optimizer step that produced them
+        self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+        with torch.cuda.stream(self.stream):
+            self._update(decay)
+
+    def _update(self, decay: float):
+        model_float = self.model_float
+        if self.staging is not None:
+            for buf, model_v in zip(self.staging, self.model_float):
+                buf.copy_(model_v, non_blocking=True)
+            torch.cuda.current_stream(self.model_float[0].device).synchronize()
+            model_float = self.staging
+        torch._foreach_mul_(self.ema_float, decay)
+        torch._foreach_add_(self.ema_float, model_float, alpha=1.0 - decay)
+        for ema_v, model_v in zip(self.ema_other, self.model_other):
+            ema_v.copy_(model_v)
+
+    def wait(self):
+        """Makes the current stream wait for the pending update, if it runs on a side stream."""
+        if self.stream is not None:
+            torch.cuda.current_stream(self.stream.device).wait_stream(self.stream)
 
 
 def adjust_learning_rate(